@@ -15,6 +15,9 @@ Output:
         - gal_type: galaxy type (central or satellite)
         - hostid: host halo ID
 
+If bias.hod.seeds is a list of HOD seeds, each snapshot is loaded once and
+populated for every seed, writing one galaxies/hod{hod_seed}.h5 per seed.
+
 NOTE:
     - TODO: Allow cosmology-dependent HOD priors
 """
@@ -22,12 +25,15 @@ NOTE:
 import numpy as np
 import logging
 import os
+from copy import deepcopy
 from os.path import join
 import hydra
 import h5py
 from omegaconf import DictConfig, OmegaConf
 from .tools.hod import (
-    build_halo_catalog, build_HOD_model, parse_hod)
+    build_halo_catalog, build_HOD_model, parse_hod, populate_galaxies,
+    halo_properties)
+from .tools.catalog import read_catalog_dataset, save_catalog_snapshot
 from ..utils import (
     get_source_path, timing_decorator, cosmo_to_astropy, save_cfg)
 from ..nbody.tools import parse_nbody_config
@@ -39,7 +45,10 @@ def populate_hod(
     cosmo, L, redshift,
     model, theta,
     hmeta=None,
-    seed=0, mdef='vir'
+    seed=0, mdef='vir',
+    engine='halotools',
+    halo_props=None,
+    catalog=None
 ):
     cosmo = cosmo_to_astropy(cosmo)
 
@@ -50,11 +59,21 @@ def populate_hod(
         logging.info('Using halo-concentration relation...')
         hconc = None
 
-    BoxSize = L*np.ones(3)
-    catalog = build_halo_catalog(
-        hpos, hvel, 10**hmass, redshift, BoxSize, cosmo,
-        mdef=mdef, conc=hconc
-    )
+    if engine == 'native':
+        return populate_galaxies(
+            hpos, hvel, 10**hmass, redshift, L, cosmo,
+            model=model, theta=theta, conc=hconc, mdef=mdef, seed=seed,
+            halo_props=halo_props
+        )
+    elif engine != 'halotools':
+        raise NotImplementedError(f'HOD engine {engine} not implemented.')
+
+    if catalog is None:
+        BoxSize = L*np.ones(3)
+        catalog = build_halo_catalog(
+            hpos, hvel, 10**hmass, redshift, BoxSize, cosmo,
+            mdef=mdef, conc=hconc
+        )
 
     hod = build_HOD_model(
         cosmo,
@@ -66,41 +85,72 @@ def populate_hod(
     hod.populate_mock(catalog, seed=seed, halo_mass_column_key=f'halo_m{mdef}')
     galcat = hod.mock.galaxy_table.as_array()
 
-    return galcat
-
-
-def run_snapshot(hpos, hvel, hmass, a, cfg, hmeta=None):
+    gpos = np.array(
+        [galcat['x'], galcat['y'], galcat['z']]).T  # comoving [Mpc/h]
+    gvel = np.array(
+        [galcat['vx'], galcat['vy'], galcat['vz']]).T  # physical [km/s]
+    return gpos, gvel, galcat['gal_type'], galcat['halo_id']
+
+
+def get_halo_properties(hmass, a, cfg, hmeta=None):
+    # Halo radii, concentrations and virial velocities for the native
+    # engine, shared by all HOD seeds of a snapshot
+    if cfg.bias.hod.get('engine', 'halotools') != 'native':
+        return None
+    hconc = None
+    if cfg.bias.hod.use_conc and (hmeta is not None):
+        hconc = hmeta.get('concentration', None)
+    return halo_properties(
+        10**hmass, (1/a)-1, cosmo_to_astropy(cfg.nbody.cosmo),
+        conc=hconc, mdef=cfg.bias.hod.mdef)
+
+
+def get_halo_catalog(hpos, hvel, hmass, a, cfg, hmeta=None):
+    # Halotools halo catalog, shared by all HOD seeds of a snapshot.
+    # populate_mock selects a copy of its halo table, so it can be reused
+    if cfg.bias.hod.get('engine', 'halotools') != 'halotools':
+        return None
+    hconc = None
+    if cfg.bias.hod.use_conc and (hmeta is not None):
+        hconc = hmeta.get('concentration', None)
+    return build_halo_catalog(
+        hpos, hvel, 10**hmass, (1/a)-1, cfg.nbody.L*np.ones(3),
+        cosmo_to_astropy(cfg.nbody.cosmo),
+        mdef=cfg.bias.hod.mdef, conc=hconc)
+
+
+def run_snapshot(hpos, hvel, hmass, a, cfg, hmeta=None, halo_props=None,
+                 catalog=None):
     # Populate HOD
     logging.info('Populating HOD...')
-    hod = populate_hod(
+    gpos, gvel, gal_type, hostid = populate_hod(
         hpos, hvel, hmass,
         cfg.nbody.cosmo, cfg.nbody.L, (1/a)-1,
         cfg.bias.hod.model, cfg.bias.hod.theta,
         seed=cfg.bias.hod.seed,
         hmeta=hmeta if cfg.bias.hod.use_conc else None,
-        mdef=cfg.bias.hod.mdef
+        mdef=cfg.bias.hod.mdef,
+        engine=cfg.bias.hod.get('engine', 'halotools'),
+        halo_props=halo_props,
+        catalog=catalog
     )
 
     # Organize outputs
-    gpos = np.array(
-        [hod['x'], hod['y'], hod['z']]).T  # comoving positions [Mpc/h]
-    gvel = np.array(
-        [hod['vx'], hod['vy'], hod['vz']]).T  # physical velocities [km/s]
-    meta = {'gal_type': hod['gal_type'], 'hostid': hod['halo_id']}
+    meta = {'gal_type': gal_type, 'hostid': hostid}
     return gpos, gvel, meta
 
 
 def load_snapshot(source_path, a):
     with h5py.File(join(source_path, 'halos.h5'), 'r') as f:
         group = f[f'{a:.6f}']
-        hpos = group['pos'][...]    # comoving positions [Mpc/h]
-        hvel = group['vel'][...]    # physical velocities [km/s]
-        hmass = group['mass'][...]  # log10(Mass) [Msun/h]
+        hpos = read_catalog_dataset(group['pos'])    # comoving [Mpc/h]
+        hvel = read_catalog_dataset(group['vel'])    # physical [km/s]
+        hmass = read_catalog_dataset(group['mass'])  # log10(Mass) [Msun/h]
 
         hmeta = {}
         for key in group.keys():
             if key not in ['pos', 'vel', 'mass']:
-                hmeta[key] = group[key][...]
+                hmeta[key] = read_catalog_dataset(group[key])
     return hpos, hvel, hmass, hmeta
 
 
@@ -115,13 +165,9 @@ def save_parameters(outpath, **params):
             f.attrs[key] = value
 
 
-def save_snapshot(outpath, a, gpos, gvel, **meta):
-    with h5py.File(outpath, 'a') as f:
-        group = f.create_group(f'{a:.6f}')
-        group.create_dataset('pos', data=gpos)
-        group.create_dataset('vel', data=gvel)
-        for key, value in meta.items():
-            group.create_dataset(key, data=value)
+def save_snapshot(outpath, a, gpos, gvel, storage=None, L=None, **meta):
+    save_catalog_snapshot(
+        outpath, a, storage=storage, L=L, pos=gpos, vel=gvel, **meta)
 
 
 @ timing_decorator
@@ -131,9 +177,22 @@ def main(cfg: DictConfig) -> None:
     cfg = OmegaConf.masked_copy(
         cfg, ['meta', 'sim', 'multisnapshot', 'nbody', 'bias'])
 
-    # Build run config
+    # Build run config, one for each HOD seed
     cfg = parse_nbody_config(cfg)
-    cfg = parse_hod(cfg)
+    seeds = cfg.bias.hod.get('seeds', None)
+    if seeds is None:
+        cfgs = [parse_hod(cfg)]
+    else:
+        cfgs = []
+        for seed in seeds:
+            cfg_i = deepcopy(cfg)
+            cfg_i.bias.hod.seed = seed
+            cfgs.append(parse_hod(cfg_i))
+    cfg = cfgs[-1]
+    if seeds is not None:
+        # record the (resolved) seeds of all realizations. Their parameters
+        # are saved in each galaxies/hod*.h5
+        cfg.bias.hod.seeds = [c.bias.hod.seed for c in cfgs]
     logging.info('Running with config:\n' + OmegaConf.to_yaml(cfg))
 
     # Setup save directory
@@ -143,27 +202,37 @@ def main(cfg: DictConfig) -> None:
     )
     save_path = join(source_path, 'galaxies')
     os.makedirs(save_path, exist_ok=True)
-    save_file = join(save_path, f'hod{cfg.bias.hod.seed:05}.h5')
-    logging.info(f'Saving to {save_file}...')
+    save_files = [join(save_path, f'hod{c.bias.hod.seed:05}.h5')
+                  for c in cfgs]
 
-    # Delete existing outputs
-    delete_outputs(save_file)
+    for c, save_file in zip(cfgs, save_files):
+        logging.info(f'Saving to {save_file}...')
 
-    # Save parameters
-    save_parameters(save_file, **cfg.bias.hod.theta)
+        # Delete existing outputs
+        delete_outputs(save_file)
+
+        # Save parameters
+        save_parameters(save_file, **c.bias.hod.theta)
 
     # Run each snapshot
     for i, a in enumerate(cfg.nbody.asave):
         logging.info(f'Running snapshot {i} at a={a:.6f}...')
 
-        # Load snapshot
+        # Load snapshot, once for all HOD seeds
         hpos, hvel, hmass, hmeta = load_snapshot(source_path, a)
-
-        # Populate HOD
-        gpos, gvel, gmeta = run_snapshot(hpos, hvel, hmass, a, cfg, hmeta=hmeta)
-
-        # Save snapshot
-        save_snapshot(save_file, a, gpos, gvel, **gmeta)
+        halo_props = get_halo_properties(hmass, a, cfg, hmeta=hmeta)
+        catalog = get_halo_catalog(hpos, hvel, hmass, a, cfg, hmeta=hmeta)
+
+        for c, save_file in zip(cfgs, save_files):
+            # Populate HOD
+            gpos, gvel, gmeta = run_snapshot(
+                hpos, hvel, hmass, a, c, hmeta=hmeta, halo_props=halo_props,
+                catalog=catalog)
+
+            # Save snapshot
+            save_snapshot(save_file, a, gpos, gvel,
+                          storage=cfg.bias.hod.get('storage', None),
+                          L=cfg.nbody.L, **gmeta)
 
     save_cfg(source_path, cfg, field='bias')
     logging.info('Done!')
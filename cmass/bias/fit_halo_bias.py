@@ -23,7 +23,6 @@ import logging
 from os.path import join
 import hydra
 from omegaconf import DictConfig, OmegaConf
-import tqdm
 import h5py
 
 from .tools.quijote import load_quijote_halos
@@ -35,6 +34,17 @@ from ..nbody.tools import parse_nbody_config
 
 @timing_decorator
 def load_halo_histogram(cfg):
+    """Sparse histogram of the Quijote halos in voxels and mass bins.
+
+    Halos are binned with a single np.bincount over the linearized
+    (voxel, mass bin) index of the non-empty voxels, so no dense
+    N^3 x Nm grid is built.
+
+    Returns:
+        voxels (np.array): flat indices of the non-empty voxels, (nvox,)
+        counts (np.array): int32 halo counts in each voxel, (nvox, Nm)
+        medges (np.array): mass bin edges, (Nm+1,)
+    """
     # setup metadata
     snapdir = join(
         cfg.meta.wdir,
@@ -44,6 +54,7 @@ def load_halo_histogram(cfg):
     L = cfg.nbody.L
     N, Nm = cfg.nbody.N, cfg.fit.Nm
     mmin, mmax = cfg.fit.logMmin, cfg.fit.logMmax
+    medges = np.linspace(mmin, mmax, Nm+1)
 
     # load quijote halos
     pos_h, mass, _, _ = load_quijote_halos(snapdir, z=cfg.nbody.zf)
@@ -51,14 +62,21 @@ def load_halo_histogram(cfg):
     # offset quijote halos by half a voxel (see issue #8)
     pos_h = (pos_h + L/(2*N)) % L
 
-    # compute histogram
-    posm = np.concatenate([pos_h, np.log10(mass)[:, None]], axis=1)
-    h, edges = np.histogramdd(
-        posm,
-        (N,)*3+(Nm,),
-        range=[(0, L)]*3+[(mmin, mmax)]
-    )
-    return h, edges[-1]
+    # voxel and mass bin of each halo, as in np.histogramdd
+    ijk = np.clip((pos_h * (N/L)).astype(np.int64), 0, N-1)
+    voxel = np.ravel_multi_index(ijk.T, (N,)*3)
+    logm = np.log10(mass)
+    mbin = np.searchsorted(medges, logm, side='right') - 1
+    mbin[logm == mmax] = Nm - 1  # right edge is included in the last bin
+    mask = (mbin >= 0) & (mbin < Nm)
+    voxel, mbin = voxel[mask], mbin[mask]
+    del pos_h, mass, ijk, logm
+
+    # compute histogram of the non-empty voxels
+    voxels, ind = np.unique(voxel, return_inverse=True)
+    counts = np.bincount(ind*Nm + mbin, minlength=len(voxels)*Nm)
+    counts = counts.reshape(len(voxels), Nm).astype(np.int32)
+    return voxels, counts, medges
 
 
 @timing_decorator
@@ -87,23 +105,15 @@ def load_rho(cfg):
         return rho
 
 
-def fit_mass_bin(rho, hcounts, verbose=False, attempts=5):
-    law = TruncatedPowerLaw()
-    return law.fit(rho.flatten(), hcounts.flatten(),
-                   verbose=verbose, attempts=attempts)
-
-
 @timing_decorator
-def fit_bias_params(rho, hcounts, verbose=True, attempts=5):
-    # fit the bias parameters for using the 1 Gpc Quijote sims
+def fit_bias_params(rho, hcounts, verbose=True, attempts=5, nbins=None,
+                    voxels=None):
+    # fit the bias parameters for using the 1 Gpc Quijote sims, for all
+    # mass bins and attempts at once
     logging.info('Fitting power law...')
-    Nm = hcounts.shape[-1]
-    params = []
-    for i in tqdm.trange(Nm, desc='Fitting mass bins', disable=not verbose):
-        pi, _ = fit_mass_bin(rho, hcounts[..., i],
-                             verbose=verbose, attempts=attempts)
-        params.append(pi)
-    return np.stack(params, axis=0)
+    law = TruncatedPowerLaw()
+    return law.fit_bins(rho, hcounts, verbose=verbose, attempts=attempts,
+                        nbins=nbins, voxels=voxels)
 
 
 def save_bias(source_path, a, medges, popt):
@@ -123,11 +133,12 @@ def main(cfg: DictConfig) -> None:
     cfg = parse_nbody_config(cfg)
     logging.info('Running with config:\n' + OmegaConf.to_yaml(cfg))
 
-    hcounts, medges = load_halo_histogram(cfg)
+    voxels, hcounts, medges = load_halo_histogram(cfg)
 
     rho = load_rho(cfg)
 
-    popt = fit_bias_params(rho, hcounts, cfg.fit.verbose, cfg.fit.attempts)
+    popt = fit_bias_params(rho, hcounts, cfg.fit.verbose, cfg.fit.attempts,
+                           nbins=cfg.fit.get('nbins', None), voxels=voxels)
 
     logging.info('Saving...')
     source_path = get_source_path(
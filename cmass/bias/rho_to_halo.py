@@ -23,25 +23,31 @@ NOTE:
 """
 
 import os  # noqa
+import sys  # noqa
 os.environ['OPENBLAS_NUM_THREADS'] = '1'  # noqa, must go before jax
 
 import numpy as np
 import logging
 import hydra
 import h5py
+import multiprocessing as mp
 from copy import deepcopy
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from omegaconf import DictConfig, OmegaConf
 from os.path import join
-from scipy.integrate import quad
 from scipy.interpolate import InterpolatedUnivariateSpline as IUS
 from .tools.halo_models import TruncatedPowerLaw
 from .tools.halo_sampling import (
-    pad_3d, sample_3d,
+    sample_3d_batch, plane_sums,
     sample_velocities_density,
     sample_velocities_kNN,
     sample_velocities_CIC)
-from ..utils import get_source_path, timing_decorator, save_cfg
-from ..nbody.tools import parse_nbody_config
+from .tools.catalog import save_catalog_snapshot
+from ..utils import (
+    get_source_path, timing_decorator, save_cfg, get_nthreads,
+    get_available_memory)
+from ..nbody.tools import parse_nbody_config, read_nbody_field
 
 
 def load_bias_params(bias_path, a):
@@ -53,28 +59,25 @@ def load_bias_params(bias_path, a):
     return popt, medges
 
 
-@timing_decorator
 def sample_counts(rho, popt):
-    # sample the halo counts from the bias model
+    # mean halo counts of all mass bins from the bias model, evaluated
+    # lazily one x-plane at a time to avoid storing the (N, N, N, 10) cube
     law = TruncatedPowerLaw()
-    return np.stack([law.predict(rho, popt[i]) for i in range(10)],
-                    axis=-1)
+    popt = np.asarray(popt)
+
+    def hcount(x):
+        return law.predict_bins(rho[x], popt)
+    return hcount
 
 
 @timing_decorator
 def sample_positions(hsamp, cfg):
-    # sample the halo positions from the halo count field
-    hpos = []
-    for i in range(10):
-        Nbin = np.random.poisson(np.sum(hsamp[..., i]))
-        if Nbin == 0:
-            hpos.append([])
-            continue
-        xtrue, _, _ = sample_3d(
-            hsamp[..., i], Nbin,
-            cfg.nbody.L, 0, np.zeros(3))
-        hpos.append(xtrue.T)
-    return hpos
+    # sample the halo positions from the halo count field, for all mass
+    # bins at once
+    sums = plane_sums(hsamp)
+    Nbin = np.random.poisson(sums.sum(axis=0))
+    hpos = sample_3d_batch(hsamp, Nbin, cfg.nbody.L, np.zeros(3), sums=sums)
+    return [x if len(x) > 0 else [] for x in hpos]
 
 
 @timing_decorator
@@ -94,53 +97,90 @@ def sample_velocities(hpos, cfg, rho=None, fvel=None, ppos=None, pvel=None):
         # Not used often
         if (ppos is None) or (pvel is None):
             raise ValueError('No particles found for kNN interpolation.')
-        ppos, pvel = pad_3d(ppos, pvel, Lbox=cfg.L, Lpad=10)
-        hvel = sample_velocities_kNN(hpos, ppos, pvel)
+        hvel = sample_velocities_kNN(
+            hpos, ppos, pvel, L=cfg.nbody.L,
+            subsample=cfg.bias.halo.get('knn_subsample', None),
+            chunk_size=cfg.bias.halo.get('knn_chunk_size', None))
     else:
         raise NotImplementedError(
             f'Velocity type {cfg.bias.halo.vel} not implemented.')
     return hvel
 
 
-@timing_decorator
-def sample_masses(Nsamp, medg, order=1):
-    """Interpolate the mass PDF and sample it continuously."""
+# Gauss-Legendre nodes and weights on [-1, 1]
+GL_NODES, GL_WEIGHTS = np.polynomial.legendre.leggauss(8)
+
+
+def integrate_exp(f, x):
+    """Cumulative integral of exp(f) on the sorted grid x.
+
+    Uses Gauss-Legendre quadrature on every interval of x at once, which is
+    accurate to machine precision when f is a polynomial on each interval.
+    """
+    half = (x[1:] - x[:-1])/2
+    nodes = ((x[1:] + x[:-1])/2)[:, None] + half[:, None]*GL_NODES
+    vals = np.exp(f(nodes.ravel())).reshape(nodes.shape)
+    return np.concatenate([[0], np.cumsum(half * (vals @ GL_WEIGHTS))])
+
+
+def mass_cdf(medg, Nsamp, order=1):
+    """Tabulated CDF of the interpolated mass PDF.
+
+    Args:
+        medg (array): mass bin edges
+        Nsamp (array): number of halos in each mass bin
+        order (int, optional): spline order of the log mass PDF
+
+    Returns:
+        be (np.array): mass grid of the CDF
+        cdf (np.array): CDF on the mass grid
+        perc (np.array): CDF percentile of each mass bin edge
+    """
+    medg, Nsamp = np.array(medg), np.array(Nsamp)
     mcen = (medg[1:] + medg[:-1])/2
 
     # don't interpolate unresolved bins at low/high mass
-    mask = np.array(Nsamp) > 0
+    mask = Nsamp > 0
     l, r = mask.argmax(), mask.size - (mask[::-1].argmax())
     maskedg, maskcen, maskN = medg[l:r], mcen[l:r], Nsamp[l:r]
 
     # interpolate the mass PDF
     pdf = IUS(maskcen, np.log(maskN), k=order, ext=0)
 
-    # sample the CDF at high resolution
+    # integrate it on a grid containing the spline knots, so that the
+    # integrand is smooth on every interval
     be = np.linspace(maskedg[0], maskedg[-1], 1000)
-    ipdf = [0] + [quad(lambda x: np.exp(pdf(x)), be[i], be[i+1])[0]
-                  for i in range(len(be)-1)]
-    cdf = np.cumsum(ipdf)
-    cdf /= cdf[-1]
+    grid = np.unique(np.concatenate([be, medg, maskcen]))
+    F = integrate_exp(pdf, grid)
 
-    # invert the CDF
-    invcdf = IUS(cdf, be, k=order, ext=3)
+    # sample the CDF at high resolution
+    cdf = F[np.searchsorted(grid, be)]
+    cdf -= cdf[0]
+    cdf /= cdf[-1]
 
     # calculate percentiles for each mass bin edge
-    perc = [0] + [quad(lambda x: np.exp(pdf(x)), medg[i], medg[i+1])[0]
-                  for i in range(len(medg)-1)]
-    perc = np.cumsum(perc)
+    perc = F[np.searchsorted(grid, medg)]
+    perc -= perc[0]
     perc /= perc[-1]
+    return be, cdf, perc
+
+
+@timing_decorator
+def sample_masses(Nsamp, medg, order=1):
+    """Interpolate the mass PDF and sample it continuously."""
+    Nsamp = np.asarray(Nsamp, dtype=int)
+    be, cdf, perc = mass_cdf(medg, Nsamp, order)
+
+    # sample the invcdf, for all bins at once
+    ibin = np.repeat(np.arange(len(Nsamp)), Nsamp)
+    u = np.random.uniform(low=perc[ibin], high=perc[ibin+1])
+    if order == 1:
+        m = np.interp(u, cdf, be)
+    else:
+        m = IUS(cdf, be, k=order, ext=3)(u)
 
-    # sample the invcdf
-    hmass = []
-    for i in range(len(Nsamp)):
-        if Nsamp[i] == 0:
-            hmass.append([])
-            continue
-        u = np.random.uniform(low=perc[i], high=perc[i+1], size=Nsamp[i])
-        m = invcdf(u)
-        hmass.append(m)
-    return hmass
+    hmass = np.split(m, np.cumsum(Nsamp)[:-1])
+    return [x if len(x) > 0 else [] for x in hmass]
 
 
 def load_transfer(source_path):
@@ -151,22 +191,54 @@ def load_transfer(source_path):
 
 def batch_cube(x, Nsub, width, stride):
     """Batches a cube x into Nsub sub-cubes per side, with width and stride."""
-    batches = []
+    return np.stack(list(iter_subboxes(x, Nsub, width, stride)), axis=0)
+
+
+@lru_cache(maxsize=None)
+def get_charm_interface():
+    # load the CHARM model once per process
+    from charm.infer_halos_from_PM import get_model_interface
+    return get_model_interface()
+
+
+def iter_subboxes(x, Nsub, width, stride, axes=(0, 1, 2)):
+    """Lazily yields views of the Nsub**3 sub-cubes of x, in (i, j, k) order.
+
+    Args:
+        x (np.array): array to split
+        Nsub (int): number of sub-cubes per side
+        width (int): width of each sub-cube
+        stride (int): stride between sub-cubes
+        axes (tuple, optional): the three spatial axes of x
+    """
     for i in range(Nsub):
         for j in range(Nsub):
             for k in range(Nsub):
-                batches.append(x[i*stride:i*stride+width,
-                                 j*stride:j*stride+width,
-                                 k*stride:k*stride+width])
-    return np.stack(batches, axis=0)
+                index = [slice(None)] * x.ndim
+                for ax, l in zip(axes, (i, j, k)):
+                    index[ax] = slice(l*stride, l*stride+width)
+                yield x[tuple(index)]
+
 
+def apply_charm(rho, fvel, charm_cfg, L, cosmo, nworkers=1, seed=None):
+    """Apply CHARM, accounting for the pre-trained resolution.
 
-def apply_charm(rho, fvel, charm_cfg, L, cosmo):
-    """Apply CHARM, accounting for the pre-trained resolution."""
+    Sub-boxes are windows into a single padded copy of the inputs. They are
+    processed one at a time by default, or concurrently by a pool of
+    nworkers threads on CPU.
+
+    Args:
+        nworkers (int, optional): number of sub-boxes processed at once.
+            Set to 1 on GPU, where each sub-box holds its own activations.
+        seed (int, optional): if given, the torch and numpy random streams
+            are reseeded from it for each sub-box, so results are
+            reproducible and do not depend on the other sub-boxes. Only
+            supported with nworkers=1, as the streams are global.
+    """
 
     # Load CHARM
-    from charm.infer_halos_from_PM import get_model_interface
-    charm_interface = get_model_interface()
+    import torch
+    charm_interface = get_charm_interface()
 
     # Hard-code the pre-trained CHARM configuration
     Npix = 128  # pre-trained resolution
@@ -178,51 +250,85 @@ def apply_charm(rho, fvel, charm_cfg, L, cosmo):
     assert N % Npix == 0, 'Input must be divisible by Npix'  # TODO: generalize
 
     Nsub = N//Npix  # number of sub-boxes
+    Nbatch = Nsub**3
 
-    # Pad the input density field
+    # Pad the input density and velocity fields, once
     rho_pad = np.pad(rho, pad, mode='wrap')
-    fvel_pad = np.pad(fvel, [(pad, pad)]*3+[(0, 0)], mode='wrap')
-
-    # Split the inputs into batches
-    batch_rho = batch_cube(rho, Nsub, Npix, Npix)
-    batch_rho_pad = batch_cube(rho_pad, Nsub, Npad, Npix)
-    batch_fvel = batch_cube(fvel, Nsub, Npix, Npix)
-    batch_fvel_pad = batch_cube(fvel_pad, Nsub, Npad, Npix)
-
-    # Run CHARM on each batch and append outputs
-    hposs, hmasss, hvels, hconcs = [], [], [], []
-    for i in range(len(batch_rho)):
-        logging.info(f'Processing CHARM batch {i+1}/{len(batch_rho)}...')
+    fvel_pad = np.pad(
+        np.moveaxis(fvel, -1, 0), [(0, 0)]+[(pad, pad)]*3, mode='wrap')
+    core = slice(pad, -pad)
+
+    # Lazy views of the (padded) sub-boxes
+    boxes = zip(
+        iter_subboxes(rho_pad[core, core, core], Nsub, Npix, Npix),
+        iter_subboxes(fvel_pad[:, core, core, core], Nsub, Npix, Npix,
+                      axes=(1, 2, 3)),
+        iter_subboxes(rho_pad, Nsub, Npad, Npix),
+        iter_subboxes(fvel_pad, Nsub, Npad, Npix, axes=(1, 2, 3)),
+    )
+
+    # Independent seeds for each sub-box
+    if seed is not None:
+        seeds = [s.generate_state(1)[0]
+                 for s in np.random.SeedSequence(seed).spawn(Nbatch)]
+
+    def process(args):
+        i, (brho, bvel, brho_pad, bvel_pad) = args
+        logging.info(f'Processing CHARM batch {i+1}/{Nbatch}...')
+        if seed is not None:
+            torch.manual_seed(int(seeds[i]))
+            np.random.seed(seeds[i])
         hpos, hmass, hvel, hconc = charm_interface.process_input_density(
-            rho_m_zg=batch_rho[i],
-            rho_m_vel_zg=np.stack([batch_fvel[i, ..., j]
-                                  for j in range(3)], axis=0),
-            rho_m_pad_zg=batch_rho_pad[i],
-            rho_m_vel_pad_zg=np.stack(
-                [batch_fvel_pad[i, ..., j] for j in range(3)], axis=0),
+            rho_m_zg=np.ascontiguousarray(brho),
+            rho_m_vel_zg=np.ascontiguousarray(bvel),
+            rho_m_pad_zg=np.ascontiguousarray(brho_pad),
+            rho_m_vel_pad_zg=np.ascontiguousarray(bvel_pad),
             cosmology_array=np.array(cosmo),
             BoxSize=Lcharm
         )
         mask = hmass > np.log10(5e12)  # charm minimum mass threshold
-        hposs.append(hpos[mask])
-        hmasss.append(hmass[mask])
-        hvels.append(hvel[mask])
-        hconcs.append(hconc[mask])
-
-    # Shift the positions to the original box
-    l = 0
-    for i in range(Nsub):
-        for j in range(Nsub):
-            for k in range(Nsub):
-                hposs[l] += np.array([i, j, k])*Lcharm
-                l += 1
-
-    # Combine the outputs
-    hposs, hmasss, hvels, hconcs = map(
-        np.concatenate, [hposs, hmasss, hvels, hconcs])
+        return hpos[mask], hmass[mask], hvel[mask], hconc[mask]
+
+    # Run CHARM on the sub-boxes
+    nworkers = min(max(int(nworkers), 1), Nbatch)
+    if (nworkers > 1) and torch.cuda.is_available():
+        logging.warning(
+            'Concurrent CHARM sub-boxes are not supported on GPU. '
+            'Using nworkers=1.')
+        nworkers = 1
+    if (nworkers > 1) and (seed is not None):
+        raise ValueError('Seeded CHARM requires nworkers=1.')
+    if nworkers == 1:
+        outputs = list(map(process, enumerate(boxes)))
+    else:
+        # split torch intra-op threads between the workers
+        torch_threads = torch.get_num_threads()
+        try:
+            torch.set_num_threads(max(get_nthreads() // nworkers, 1))
+            with ThreadPoolExecutor(nworkers) as pool:
+                outputs = list(pool.map(process, enumerate(boxes)))
+        finally:
+            torch.set_num_threads(torch_threads)
+
+    # Combine the outputs into preallocated arrays
+    Nh = sum(len(out[1]) for out in outputs)
+    hposs = np.empty((Nh, 3), dtype=outputs[0][0].dtype)
+    hvels = np.empty((Nh,)+outputs[0][2].shape[1:], dtype=outputs[0][2].dtype)
+    hmasss = np.empty(Nh, dtype=outputs[0][1].dtype)
+    hconcs = np.empty(Nh, dtype=outputs[0][3].dtype)
+    start = 0
+    for (hpos, hmass, hvel, hconc), ijk in zip(
+            outputs, np.ndindex(Nsub, Nsub, Nsub)):
+        end = start + len(hmass)
+        # Shift the positions to the original box
+        np.add(hpos, np.array(ijk)*Lcharm, out=hposs[start:end])
+        hmasss[start:end] = hmass
+        hvels[start:end] = hvel
+        hconcs[start:end] = hconc
+        start = end
 
     # ensure periodicity
-    hposs = hposs % L
+    hposs %= L
 
     # save misc halo metadata
     meta = {'concentration': hconcs}
@@ -230,8 +336,10 @@ def apply_charm(rho, fvel, charm_cfg, L, cosmo):
     return hposs, hmasss, hvels, meta
 
 
-def apply_limd(rho, fvel, cfg, ppos=None, pvel=None):
-    # Load bias parameters
+def get_bias_params(cfg):
+    # load the LIMD bias parameters of the base suite (None for CHARM)
+    if cfg.bias.halo.model != "LIMD":
+        return None
     bcfg = deepcopy(cfg)
     bcfg.nbody.suite = bcfg.bias.halo.base_suite
     bcfg.nbody.L = bcfg.bias.halo.L
@@ -242,7 +350,14 @@ def apply_limd(rho, fvel, cfg, ppos=None, pvel=None):
     )
 
     logging.info('Loading bias parameters...')
-    popt, medges = load_bias_params(bias_path, cfg.nbody.af)
+    return load_bias_params(bias_path, cfg.nbody.af)
+
+
+def apply_limd(rho, fvel, cfg, ppos=None, pvel=None, bias_params=None):
+    # Load bias parameters, unless given
+    if bias_params is None:
+        bias_params = get_bias_params(cfg)
+    popt, medges = bias_params
 
     # Sample halo counts
     logging.info('Sampling power law...')
@@ -270,7 +385,7 @@ def apply_limd(rho, fvel, cfg, ppos=None, pvel=None):
 
 
 @timing_decorator
-def run_snapshot(rho, fvel, a, cfg, ppos=None, pvel=None):
+def run_snapshot(rho, fvel, a, cfg, ppos=None, pvel=None, bias_params=None):
     if cfg.bias.halo.model == "CHARM":
         logging.info('Using CHARM model...')
 
@@ -279,11 +394,14 @@ def run_snapshot(rho, fvel, a, cfg, ppos=None, pvel=None):
             rho,
             fvel*a/1e3,  # CHARM vel normalization (physical velocities Mm/s)
             cfg.bias.halo.config_charm,
-            cfg.nbody.L, cfg.nbody.cosmo
+            cfg.nbody.L, cfg.nbody.cosmo,
+            nworkers=cfg.bias.halo.get('nworkers_charm', 1),
+            seed=cfg.bias.halo.get('seed_charm', None)
         )
     elif cfg.bias.halo.model == "LIMD":
         logging.info('Using LIMD model...')
-        hpos, hmass, hvel = apply_limd(rho, fvel, cfg, ppos, pvel)
+        hpos, hmass, hvel = apply_limd(
+            rho, fvel, cfg, ppos, pvel, bias_params=bias_params)
         meta = {}
     else:
         raise NotImplementedError(
@@ -294,34 +412,131 @@ def run_snapshot(rho, fvel, a, cfg, ppos=None, pvel=None):
 
 def load_snapshot(source_path, a):
     with h5py.File(join(source_path, 'nbody.h5'), 'r') as f:
-        group = f[f'{a:.6f}']
-        rho = group['rho'][...]
-        fvel = group['fvel'][...]
-        if 'ppos' in group:
-            ppos = group['ppos'][...]
-            pvel = group['pvel'][...]
-        else:
-            ppos, pvel = None, None
+        has_particles = 'ppos' in f[f'{a:.6f}']
+    rho = read_nbody_field(source_path, a, 'rho')
+    fvel = read_nbody_field(source_path, a, 'fvel')
+    if has_particles:
+        ppos = read_nbody_field(source_path, a, 'ppos')
+        pvel = read_nbody_field(source_path, a, 'pvel')
+    else:
+        ppos, pvel = None, None
     return rho, fvel, ppos, pvel
 
 
+def process_snapshot(source_path, a, cfg, bias_params=None):
+    rho, fvel, ppos, pvel = load_snapshot(source_path, a)
+    return (a,) + run_snapshot(
+        rho, fvel, a, cfg, ppos, pvel, bias_params=bias_params)
+
+
+# Approximate peak memory of processing one snapshot, in bytes per grid cell
+SNAPSHOT_BYTES_PER_CELL = 64
+
+
+def get_snapshot_workers(cfg, nsnap):
+    """Number of snapshots to process in parallel.
+
+    Set by cfg.bias.halo.nworkers (default 1, or -1 for automatic), and
+    bounded by the number of snapshots, cores and available memory.
+    """
+    nworkers = cfg.bias.halo.get('nworkers', 1)
+    if (nworkers == 1) or (nsnap <= 1):
+        return 1
+    ncores = get_nthreads()
+    if (nworkers is None) or (nworkers < 1):
+        nworkers = ncores
+    nworkers = min(nworkers, nsnap, ncores)
+    mem = get_available_memory()
+    if mem is not None:
+        nworkers = min(
+            nworkers, mem // (SNAPSHOT_BYTES_PER_CELL * cfg.nbody.N**3))
+    return max(int(nworkers), 1)
+
+
+# threading variables read by numpy, jax and torch when they are imported
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def _init_worker(nthreads):
+    # the thread variables are inherited from the parent (see
+    # iter_snapshots), as the worker imports this module, and thus its
+    # libraries, before running this initializer
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(nthreads)
+
+
+def _process_task(args):
+    return process_snapshot(*args)
+
+
+def iter_snapshots(source_path, asave, cfg, nworkers=1, bias_params=None):
+    """Yields (a, hpos, hvel, hmass, meta) for each snapshot.
+
+    The LIMD bias parameters (see get_bias_params) are shared by all
+    snapshots, and loaded here if not given.
+
+    With one worker, snapshots are processed in order, and the next one is
+    loaded in the background while the current one is sampled. Otherwise,
+    snapshots are processed on a pool of nworkers processes, and yielded
+    as they finish.
+    """
+    if bias_params is None:
+        bias_params = get_bias_params(cfg)
+
+    if nworkers > 1:
+        nthreads = max(get_nthreads() // nworkers, 1)
+        logging.info(f'Processing {len(asave)} snapshots with {nworkers} '
+                     f'workers of {nthreads} threads...')
+        ctx = mp.get_context('spawn')  # jax and torch are not fork-safe
+
+        # spawned workers copy the environment when the pool starts
+        environ = {k: os.environ.get(k) for k in THREAD_ENV_VARS}
+        os.environ.update({k: str(nthreads) for k in THREAD_ENV_VARS})
+        try:
+            pool = ctx.Pool(nworkers, initializer=_init_worker,
+                            initargs=(nthreads,))
+        finally:
+            for k, v in environ.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        with pool:
+            yield from pool.imap_unordered(
+                _process_task,
+                [(source_path, a, cfg, bias_params) for a in asave])
+        return
+
+    with ThreadPoolExecutor(1) as loader:
+        future = None
+        if len(asave) > 0:
+            future = loader.submit(load_snapshot, source_path, asave[0])
+        for i, a in enumerate(asave):
+            rho, fvel, ppos, pvel = future.result()
+            if i + 1 < len(asave):
+                future = loader.submit(load_snapshot, source_path, asave[i+1])
+
+            logging.info(f'Running snapshot {i} at a={a:.6f}...')
+            yield (a,) + run_snapshot(
+                rho, fvel, a, cfg, ppos, pvel, bias_params=bias_params)
+            del rho, fvel, ppos, pvel
+
+
 def delete_outputs(outdir):
     outpath = join(outdir, 'halos.h5')
     if os.path.isfile(outpath):
         os.remove(outpath)
 
 
-def save_snapshot(outdir, a, hpos, hvel, hmass, **meta):
-
-    with h5py.File(join(outdir, 'halos.h5'), 'a') as f:
-        group = f.create_group(f'{a:.6f}')
-        group.create_dataset('pos', data=hpos)  # comoving positions [Mpc/h]
-        group.create_dataset('vel', data=hvel)  # physical velocities [km/s]
-        group.create_dataset('mass', data=hmass)  # halo masses [Msun/h]
-
-        # save other halo metadata (e.g. concentration)
-        for key, val in meta.items():
-            group.create_dataset(key, data=val)
+def save_snapshot(outdir, a, hpos, hvel, hmass, storage=None, L=None,
+                  **meta):
+    save_catalog_snapshot(
+        join(outdir, 'halos.h5'), a, storage=storage, L=L,
+        pos=hpos,    # comoving positions [Mpc/h]
+        vel=hvel,    # physical velocities [km/s]
+        mass=hmass,  # halo masses [Msun/h]
+        **meta       # other halo metadata (e.g. concentration)
+    )
 
 
 @timing_decorator
@@ -342,18 +557,15 @@ def main(cfg: DictConfig) -> None:
     # Delete existing outputs
     delete_outputs(source_path)
 
-    for i, a in enumerate(cfg.nbody.asave):
-        logging.info(f'Running snapshot {i} at a={a:.6f}...')
-        rho, fvel, ppos, pvel = load_snapshot(source_path, a)
-
-        # Apply bias model
-        hpos, hvel, hmass, meta = run_snapshot(
-            rho, fvel, a,
-            cfg, ppos, pvel
-        )
-
-        logging.info(f'Saving halo catalog to {source_path}')
-        save_snapshot(source_path, a, hpos, hvel, hmass, **meta)
+    # Apply bias model, writing each snapshot as it finishes
+    asave = list(cfg.nbody.asave)
+    nworkers = get_snapshot_workers(cfg, len(asave))
+    for a, hpos, hvel, hmass, meta in iter_snapshots(
+            source_path, asave, cfg, nworkers):
+        logging.info(f'Saving halo catalog at a={a:.6f} to {source_path}')
+        save_snapshot(source_path, a, hpos, hvel, hmass,
+                      storage=cfg.bias.halo.get('storage', None),
+                      L=cfg.nbody.L, **meta)
 
     save_cfg(source_path, cfg, field='bias')
     logging.info('Done!')
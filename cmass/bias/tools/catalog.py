@@ -0,0 +1,153 @@
+"""
+Storage of halo and galaxy catalogs (halos.h5 and galaxies/hod*.h5).
+
+By default, catalogs are saved as given, in contiguous datasets. With a
+storage profile, each snapshot group is saved with compact dtypes in
+chunked, compressed datasets, and tagged with CATALOG_SCHEMA_VERSION.
+read_catalog_dataset decodes both layouts.
+"""
+
+import numpy as np
+import h5py
+
+from ...nbody.tools import get_compression
+
+
+# Version of the compact catalog layout, saved in the attributes of each
+# snapshot group written with a storage profile
+CATALOG_SCHEMA_VERSION = 1
+
+# Galaxy types, stored as an uint8 enum
+GAL_TYPES = ('centrals', 'satellites')
+GAL_TYPE_DTYPE = h5py.enum_dtype(
+    {name: i for i, name in enumerate(GAL_TYPES)}, basetype='u1')
+
+# Opt-in storage profiles for catalogs, giving the on-disk dtype of each
+# dataset. Unsigned integer positions are saved in fixed point, relative to
+# the box size. Datasets which are not listed keep their dtype, except
+# float64 which is saved as float32.
+CATALOG_PROFILES = {
+    'compressed': {
+        'pos': 'f4', 'vel': 'f4', 'hostid': 'u4', 'gal_type': GAL_TYPE_DTYPE},
+    'compressed_fixed': {
+        'pos': 'u2', 'vel': 'f2', 'hostid': 'u4', 'gal_type': GAL_TYPE_DTYPE},
+}
+
+# Target size of the chunks of compressed datasets, in bytes
+CATALOG_CHUNK_BYTES = 2**20
+
+
+def _encode_gal_type(gal_type):
+    # map 'centrals'/'satellites' (str or bytes) to the enum values
+    gal_type = np.asarray(gal_type)
+    if gal_type.dtype.kind in 'iub':
+        return gal_type.astype('u1')
+    gal_type = np.char.decode(gal_type.astype('S'), 'ascii')
+    codes = np.full(gal_type.shape, len(GAL_TYPES), dtype='u1')
+    for i, name in enumerate(GAL_TYPES):
+        codes[gal_type == name] = i
+    if np.any(codes == len(GAL_TYPES)):
+        raise ValueError(
+            f'Unknown galaxy types {set(gal_type[codes == len(GAL_TYPES)])}.'
+            f' Expected one of {GAL_TYPES}.')
+    return codes
+
+
+def create_catalog_dataset(group, key, data, storage=None, L=None):
+    """Save a catalog dataset using the given storage profile.
+
+    The on-disk dtype, source dtype and compression are recorded in the
+    dataset attributes, so that read_catalog_dataset can decode it.
+
+    Args:
+        group (h5py.Group): snapshot group
+        key (str): dataset name
+        data (array): dataset values
+        storage (str, optional): catalog storage profile, one of
+            CATALOG_PROFILES. If None, save data as given.
+        L (float, optional): box size in Mpc/h, required for fixed point
+            positions
+    """
+    if storage is None:
+        return group.create_dataset(key, data=data)
+    if storage not in CATALOG_PROFILES:
+        raise ValueError(
+            f'Unknown catalog storage profile "{storage}". '
+            f'Choose from {list(CATALOG_PROFILES)}.')
+
+    data = np.asarray(data)
+    source_dtype = data.dtype
+    default = 'f4' if source_dtype == np.float64 else source_dtype
+    dtype = np.dtype(CATALOG_PROFILES[storage].get(key, default))
+
+    scale = None
+    if h5py.check_enum_dtype(dtype) is not None:
+        data = _encode_gal_type(data)
+    elif (dtype.kind == 'u') and (source_dtype.kind == 'f'):
+        # fixed point, in units of L / 2^bits, wrapped into the box
+        if L is None:
+            raise ValueError(
+                f'Box size L is required to save {key} in fixed point.')
+        scale = L / 2.**(8*dtype.itemsize)
+        data = np.floor(np.mod(data, L) / scale)
+        data = np.minimum(data, np.iinfo(dtype).max)
+
+    compression, kws = get_compression()
+    nrow = max(1, CATALOG_CHUNK_BYTES //
+               (dtype.itemsize * int(np.prod(data.shape[1:]))))
+    chunks = (min(nrow, len(data)),) + data.shape[1:]
+    if len(data) == 0:  # empty datasets cannot be chunked
+        chunks, kws = None, {}
+    dset = group.create_dataset(
+        key, data=data.astype(dtype, copy=False), dtype=dtype,
+        chunks=chunks, **kws)
+    dset.attrs['storage'] = storage
+    dset.attrs['source_dtype'] = source_dtype.str
+    dset.attrs['compression'] = compression
+    if scale is not None:
+        dset.attrs['scale'] = scale
+    return dset
+
+
+def read_catalog_dataset(dset, index=Ellipsis):
+    """Read and decode a catalog dataset saved by create_catalog_dataset.
+
+    Datasets without a storage profile are returned as saved. Compact
+    float datasets are returned as float32, fixed point positions at the
+    center of their cell, and galaxy types as bytes, as in the default
+    layout.
+
+    Args:
+        dset (h5py.Dataset): catalog dataset
+        index (optional): selection of rows to read
+    """
+    out = dset[index]
+    if 'storage' not in dset.attrs:
+        return out
+    if 'scale' in dset.attrs:
+        return ((out + 0.5) * dset.attrs['scale']).astype(np.float32)
+    if h5py.check_enum_dtype(dset.dtype) is not None:
+        return np.array(GAL_TYPES, dtype='S').astype(object)[out]
+    if out.dtype == np.float16:
+        return out.astype(np.float32)
+    return out
+
+
+def save_catalog_snapshot(filepath, a, storage=None, L=None, **datasets):
+    """Append a snapshot group to a halo or galaxy catalog file.
+
+    Args:
+        filepath (str): path to the catalog file
+        a (float): scale factor of the snapshot
+        storage (str, optional): catalog storage profile, one of
+            CATALOG_PROFILES. If None, save datasets as given.
+        L (float, optional): box size in Mpc/h, required by fixed point
+            profiles
+        **datasets: datasets of the snapshot (pos, vel, mass, ...)
+    """
+    with h5py.File(filepath, 'a') as f:
+        group = f.create_group(f'{a:.6f}')
+        if storage is not None:
+            group.attrs['schema_version'] = CATALOG_SCHEMA_VERSION
+        for key, value in datasets.items():
+            create_catalog_dataset(group, key, value, storage=storage, L=L)
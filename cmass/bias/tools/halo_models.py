@@ -3,9 +3,113 @@ import numpy as np
 import jax
 import jax.numpy as jnp
 from jax.scipy.optimize import minimize
+from functools import partial
 import logging
 
 
+@partial(jax.jit, static_argnums=0)
+def _predict_bins(get_mean_ngal, rho, params):
+    # evaluate several parameter sets in a single fused pass over rho
+    ngal_mean = jax.vmap(
+        get_mean_ngal, in_axes=(None, 0), out_axes=-1)(rho, params)
+    return ngal_mean.astype(jnp.float32)
+
+
+def _weighted_loss(get_mean_ngal, params, delta, weights, delta_c, counts,
+                   scale=1):
+    # mean Poisson loss per cell. The expected counts are summed over the
+    # groups of cells delta with the given number of cells (weights, or one
+    # cell each if None), and the log-likelihood of the counts over the
+    # groups delta_c with the given total counts
+    ngal_mean = get_mean_ngal(delta, params)
+    if weights is None:
+        expected, ncells = jnp.sum(ngal_mean), delta.size
+    else:
+        expected, ncells = jnp.sum(weights * ngal_mean), jnp.sum(weights)
+    loss = expected - jnp.sum(counts * jnp.log(get_mean_ngal(delta_c, params)))
+    return loss / ncells / scale
+
+
+@partial(jax.jit, static_argnums=0)
+def _fit_batch(get_mean_ngal, x0, scale, delta, weights, delta_c, counts):
+    # BFGS fits of several bins (axis 0 of x0 and counts) with the same loss
+    # scale, in a single vmapped program
+    loss = partial(_weighted_loss, get_mean_ngal)
+
+    def fit_one(x0, counts):
+        result = minimize(
+            loss, x0, args=(delta, weights, delta_c, counts, scale),
+            method='BFGS', tol=1e-4)
+        return result.x, result.success, result.fun * scale
+
+    return jax.vmap(fit_one)(x0, counts)
+
+
+def sufficient_statistics(delta, counts, voxels=None, nbins=None):
+    """Compress the density and count fields for the Poisson loss.
+
+    The loss is split into the expected counts of all cells and the
+    log-likelihood of the non-empty cells. If nbins is None, the first term
+    is evaluated on every cell and the second on every non-empty cell, so
+    the loss is exact. Otherwise, as an opt-in approximation, the cells are
+    grouped in nbins equal-width bins of log(1+delta), each represented by
+    its mean log(1+delta), its number of cells and its total halo counts in
+    every mass bin, so the loss is evaluated on nbins points instead of N^3
+    cells. Empty cells (delta <= -1) are kept as a separate group at
+    delta = -1.
+
+    Args:
+        delta (array): density contrast field
+        counts (array): halo counts, either dense with shape
+            delta.shape + (Nm,), or of the non-empty voxels only with shape
+            (nvox, Nm)
+        voxels (array, optional): flat indices into delta of the non-empty
+            voxels, if counts is sparse
+        nbins (int, optional): number of log(1+delta) bins
+
+    Returns:
+        delta (np.array): representative density contrasts, shape (n,)
+        weights (np.array): number of cells in each group, shape (n,), or
+            None if each delta is a single cell
+        delta_c (np.array): density contrasts of the counts, shape (m,)
+        counts (np.array): total counts in each group, shape (Nm, m)
+    """
+    delta = np.ravel(delta)
+    counts = np.asarray(counts)
+    if voxels is None:
+        counts = counts.reshape(len(delta), -1)
+        voxels = np.flatnonzero(counts.any(axis=1))
+        counts = counts[voxels]
+    counts = counts.T.astype(np.float64)
+
+    if nbins is None:
+        return delta, None, delta[voxels], counts
+
+    # bin the non-empty cells in log(1+delta), and put the empty ones in
+    # an extra bin at delta = -1
+    empty = delta <= -1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logd = np.log1p(delta, dtype=np.float64)
+    finite = logd[~empty]
+    if len(finite) == 0:
+        finite = np.zeros(1)
+    edges = np.linspace(finite.min(), finite.max(), nbins + 1)
+    ind = np.clip(np.searchsorted(edges, logd, side='right') - 1,
+                  0, nbins - 1)
+    ind[empty] = nbins
+    logd[empty] = 0
+    weights = np.bincount(ind, minlength=nbins+1).astype(np.float64)
+    logd = np.bincount(ind, weights=logd, minlength=nbins+1)
+    counts = np.stack([np.bincount(ind[voxels], weights=c, minlength=nbins+1)
+                       for c in counts])
+
+    mask = weights > 0
+    delta = np.expm1(logd[mask] / weights[mask])
+    if empty.any():
+        delta[-1] = -1  # the last group holds the empty cells
+    return delta, weights[mask], delta, counts[:, mask]
+
+
 class PowerLaw:
     @staticmethod
     @jax.jit
@@ -64,10 +168,92 @@ class PowerLaw:
             logging.info(f"Power law bias fit params: {params}")
         return params, result
 
+    def fit_bins(self, delta, counts, verbose=False, attempts=5,
+                 nbins=None, voxels=None):
+        """Fit all mass bins at once, with several restarts each.
+
+        As in fit, each attempt rescales the loss to help convergence, and
+        bins are refit only until their first successful attempt. At each
+        attempt, all bins still to fit are optimized together in a single
+        vmapped BFGS program. If all attempts fail, the lowest loss is kept.
+
+        Args:
+            delta (array): density contrast field
+            counts (array): halo counts, shape delta.shape + (Nm,), or
+                (nvox, Nm) for the non-empty voxels given by voxels
+            verbose (bool, optional): log the best-fit parameters
+            attempts (int, optional): maximum number of attempts per bin
+            nbins (int, optional): if given, fit the sufficient statistics
+                in nbins bins of log(1+delta) (see sufficient_statistics)
+            voxels (array, optional): flat indices into delta of the rows
+                of a sparse counts array
+
+        Returns:
+            np.array: best-fit parameters, shape (Nm, nparams)
+        """
+        ncells = np.size(delta)
+        x, weights, x_c, counts = sufficient_statistics(
+            delta, counts, voxels=voxels, nbins=nbins)
+        Nm = len(counts)
+        x = jnp.asarray(x, dtype=jnp.float64)
+        x_c = jnp.asarray(x_c, dtype=jnp.float64)
+        if weights is not None:
+            weights = jnp.asarray(weights)
+
+        popt = np.stack([self.get_default()] * Nm).astype(np.float64)
+        best = np.full(Nm, np.nan)  # lowest loss of each bin
+        todo = np.flatnonzero(counts.sum(axis=1) > 0)
+        for i in range(attempts):
+            if len(todo) == 0:
+                break
+            if i <= attempts//2:  # initial loss is not good sometimes
+                scale = 10.**i
+            else:
+                scale = 10.**(attempts//2 - i)
+
+            x0 = np.stack([self.get_initial_guess(
+                np.full(1, counts[j].sum() / ncells)) for j in todo])
+            params, success, loss = map(np.asarray, _fit_batch(
+                self._get_mean_ngal, jnp.asarray(x0, dtype=jnp.float64),
+                scale, x, weights, x_c, jnp.asarray(counts[todo])))
+
+            loss = np.where(np.isnan(loss), np.inf, loss)
+            keep = success | np.isnan(best[todo]) | (loss < best[todo])
+            popt[todo[keep]] = params[keep]
+            best[todo[keep]] = loss[keep]
+            if not success.all():
+                logging.warning(
+                    f"Fit of mass bins {todo[~success].tolist()} failed. "
+                    f"Retrying {i+1}/{attempts}.")
+            todo = todo[~success]
+
+        if len(todo) > 0:
+            logging.warning(
+                f"Fit of mass bins {todo.tolist()} failed in all {attempts} "
+                "attempts. Keeping the lowest loss.")
+        fitted = ~np.isnan(best)
+        popt[fitted] = [self._post(p) for p in popt[fitted]]
+        if verbose:
+            logging.info(f"Power law bias fit params: {popt}")
+        return popt
+
     def predict(self, delta, params):
         ngal_mean = self._get_mean_ngal(delta, params)
         return np.array(ngal_mean)
 
+    def predict_bins(self, delta, params):
+        """Predict the mean counts of several bins at once.
+
+        Args:
+            delta (array): density contrast field
+            params (array): parameters of each bin, shape (nbins, nparams)
+
+        Returns:
+            np.array: float32 mean counts, shape delta.shape + (nbins,)
+        """
+        return np.asarray(_predict_bins(
+            self._get_mean_ngal, jnp.asarray(delta), jnp.asarray(params)))
+
     def sample(self, delta, params):
         ngal_mean = self.predict(delta, params)
         return np.random.poisson(ngal_mean)
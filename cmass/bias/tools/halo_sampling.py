@@ -6,54 +6,15 @@ import numpy as np
 import astropy.units as apu
 from astropy.coordinates import SkyCoord
 import scipy
-import tqdm
-from sklearn.neighbors import KNeighborsRegressor
+import scipy.fft
+import scipy.spatial
 import jax.numpy as jnp
 import jax.scipy.ndimage
 import jax
-from functools import partial
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import warnings
-from ...utils import timing_decorator, cosmo_to_astropy
-
-
-# General
-
-@timing_decorator
-def pad_3d(ppos, pvel, Lbox, Lpad):
-    # pad a 3d particle cube with periodic boundary conditions
-
-    def offset(*inds):
-        # calculate the offset vector for a given region
-        out = np.zeros(3)
-        out[list(inds)] = Lbox
-        return out
-
-    def recursive_padding(ipos, idig, ivel, index=0):
-        # recursively pad the cube
-        if index >= 3:
-            return []
-        padded = []
-        for i, dir in [(1, 1), (3, -1)]:
-            mask = idig[:, index] == i
-            ippad, ivpad = ipos[mask] + dir*offset(index), ivel[mask]
-            padded += [(ippad, ivpad)]
-            padded += recursive_padding(ippad, idig[mask], ivpad, index+1)
-            padded += recursive_padding(ippad, idig[mask], ivpad, index+2)
-        return padded
-
-    regions = np.digitize(ppos, bins=[0, Lpad, Lbox - Lpad, Lbox])
-    padlist = [(ppos, pvel)]
-    padlist += recursive_padding(ppos, regions, pvel, index=0)
-    padlist += recursive_padding(ppos, regions, pvel, index=1)
-    padlist += recursive_padding(ppos, regions, pvel, index=2)
-    padpos, padvel = zip(*padlist)
-    padpos = np.concatenate(padpos)
-    padvel = np.concatenate(padvel)
-
-    logging.info(
-        f'len(pad)/len(original): {len(padpos)}/{len(ppos)}'
-        f' = {len(padpos)/len(ppos):.3f}')
-    return padpos, padvel
+from ...utils import timing_decorator, cosmo_to_astropy, get_nthreads
 
 
 # Deaglan's halo positioning
@@ -112,7 +73,8 @@ def sample_uniform(N: int, Nt: int, L: float, frac_sig_x: float, origin: np.ndar
     return xtrue, xmeas, sigma_mu
 
 
-def draw_linear(nsamp: int, alpha: float, beta: float, u0: float, u1: float) -> np.ndarray:
+def draw_linear(nsamp: int, alpha: float, beta: float, u0: float, u1: float,
+                rng: np.random.Generator = None) -> np.ndarray:
     """
     Draw a sample from the probability distribution:
     p(u) \propto alpha (u1 - u) + beta (u - u0)
@@ -124,11 +86,16 @@ def draw_linear(nsamp: int, alpha: float, beta: float, u0: float, u1: float) ->
         - beta (float): The coefficient of (u - u0) in p(u).
         - u0 (float): The minimum allowed value of u.
         - u1 (float): The maximum allowed value of u.
+        - rng (np.random.Generator, optional): Random generator to use.
+            Defaults to the global numpy random state.
 
     Return:
         - np.ndarray: The samples from p(u).
     """
-    n = scipy.stats.uniform(0, 1).rvs(nsamp)
+    if rng is None:
+        n = scipy.stats.uniform(0, 1).rvs(nsamp)
+    else:
+        n = rng.random(nsamp)
     if isinstance(alpha, np.ndarray):
         res = np.zeros(alpha.shape)
         m = alpha != beta
@@ -143,42 +110,165 @@ def draw_linear(nsamp: int, alpha: float, beta: float, u0: float, u1: float) ->
             return u0 + (u1 - u0) * n
 
 
-def periodic_index(index: np.ndarray, shape: tuple) -> np.ndarray:
+def _as_planes(phi) -> tuple:
     """
-    Apply periodic boundary conditions to an array of indices.
+    Plane accessor, grid size and number of bins of a field, given either
+    as an array of shape (N, N, N, nbins) or as a function returning the
+    (N, N, nbins) x-plane of the field at a given index.
+    """
+    if callable(phi):
+        shape = np.shape(phi(0))
+        return phi, shape[0], shape[-1]
+    return (lambda x: phi[x]), phi.shape[0], phi.shape[-1]
+
+
+def plane_sums(phi, nthreads: int = None) -> np.ndarray:
+    """
+    Sum of each x-plane of the fields phi, per bin.
 
     Args:
-        - index (np.ndarray): The indices to transform. Shape = (ndim, nvals). 
-        - shape (tuple): The shape of the box used for periodic boundary conditions (N0, N1, ...)
+        - phi (np.ndarray or callable): The fields, as an array of shape
+            (N, N, N, nbins) or a function returning the x-plane of index x.
+        - nthreads (int): Number of threads. Defaults to all cores.
 
     Returns:
-        - new_index (np.ndarray): The values in index after applying periodic boundary conditions, such that for dimension i, the values are in the range [0, Ni)
+        - np.ndarray: The plane sums, shape (N, nbins).
     """
-    assert index.shape[0] == len(shape)
-    new_index = index.copy()
-    for i in range(len(shape)):
-        new_index[i, :] = np.mod(new_index[i, :], shape[i])
-    return new_index
+    if not callable(phi):
+        return phi.sum(axis=(1, 2), dtype=np.float64)
+    plane, N, _ = _as_planes(phi)
+    with ThreadPoolExecutor(get_nthreads(nthreads)) as pool:
+        return np.stack(list(pool.map(
+            lambda x: np.sum(plane(x), axis=(0, 1), dtype=np.float64),
+            range(N))))
 
 
-def get_new_index(index: np.ndarray, shape: tuple, subscript: tuple) -> np.ndarray:
+def _sample_plane(P0: np.ndarray, P1: np.ndarray, x: int, counts: np.ndarray,
+                  rng: np.random.Generator) -> tuple:
     """
-    If each entry of index corresponds to (0,0,0), find the index corresponding to the point given by subscript.
+    Sample points in the cells between planes x and x+1 of phi, for all bins.
 
     Args:
-        - index (np.ndarray): The indices to transform. Shape = (ndim, nvals). 
-        - shape (tuple): The shape of the box used (N0, N1, ...).
-        - subscript (tuple): The coordinate to find, relative to the values given in index.
+        - P0 (np.ndarray): The plane x of the fields, shape (N, N, nbins).
+        - P1 (np.ndarray): The plane x+1 of the fields, shape (N, N, nbins).
+        - x (int): The plane index.
+        - counts (np.ndarray): The number of points per bin in this plane.
+        - rng (np.random.Generator): Random generator for this plane.
 
     Returns:
-        - new_index (np.ndarray): The new index values.
+        - pos (np.ndarray): The grid coordinates of the points, shape (n, 3).
+        - bins (np.ndarray): The bin of each point, shape (n,).
+    """
+    N = P0.shape[0]
+
+    # Sum of the eight cell corners, with in-place periodic stencils
+    mean = np.add(P0, P1, dtype=np.float64)
+    for axis in range(2):
+        first = mean.take(0, axis=axis).copy()
+        head = [slice(None)] * 3
+        tail = [slice(None)] * 3
+        head[axis], tail[axis] = slice(None, -1), slice(1, None)
+        mean[tuple(head)] += mean[tuple(tail)]
+        head[axis] = -1
+        mean[tuple(head)] += first
+
+    # Draw cells from the cumulative sums, bin by bin
+    cells, bins = [], []
+    for b in np.flatnonzero(counts):
+        cdf = np.cumsum(mean[..., b])
+        u = rng.random(counts[b]) * cdf[-1]
+        cells.append(np.minimum(np.searchsorted(cdf, u, side='right'),
+                                N * N - 1))
+        bins.append(np.full(counts[b], b))
+    cells, bins = np.concatenate(cells), np.concatenate(bins)
+    j, k = np.divmod(cells, N)
+    j1, k1 = (j + 1) % N, (k + 1) % N
+    Nt = len(cells)
+
+    # Gather the eight corners (p_xyz) once, for all bins
+    p000, p001 = P0[j, k, bins], P0[j, k1, bins]
+    p010, p011 = P0[j1, k, bins], P0[j1, k1, bins]
+    p100, p101 = P1[j, k, bins], P1[j, k1, bins]
+    p110, p111 = P1[j1, k, bins], P1[j1, k1, bins]
+
+    # Find the x values
+    xd = draw_linear(Nt, p000 + p001 + p010 + p011,
+                     p100 + p101 + p110 + p111, 0., 1., rng=rng)
+
+    # Find the y values
+    phi00, phi01 = p000 * (1 - xd) + p100 * xd, p001 * (1 - xd) + p101 * xd
+    phi10, phi11 = p010 * (1 - xd) + p110 * xd, p011 * (1 - xd) + p111 * xd
+    yd = draw_linear(Nt, phi00 + phi01, phi10 + phi11, 0., 1., rng=rng)
+
+    # Find the z values
+    zd = draw_linear(Nt, phi00 * (1 - yd) + phi10 * yd,
+                     phi01 * (1 - yd) + phi11 * yd, 0., 1., rng=rng)
+
+    pos = np.stack([x + xd, j + yd, k + zd], axis=-1)
+    return pos, bins
 
+
+@timing_decorator
+def sample_3d_batch(phi, Nt: np.ndarray, L: float,
+                    origin: np.ndarray = np.zeros(3), nthreads: int = None,
+                    seed: int = None, sums: np.ndarray = None) -> list:
     """
-    new_index = index.copy()
-    for i in range(len(subscript)):
-        new_index[i, :] += subscript[i]
-    new_index = periodic_index(new_index, shape)
-    return new_index
+    Sample points for several fields at once, assuming that the points of
+    each field are drawn from a Poisson process given by phi[..., b], with
+    linear interpolation between grid points (as in sample_3d).
+
+    Points are assigned to x-planes from the plane sums of phi, and then
+    sampled plane by plane in parallel threads, using cumulative-sum tables
+    of the cell corner sums, shared by all points of a plane. Results are
+    independent of the number of threads. If phi is given as a function of
+    the plane index, only a few planes are held in memory at once.
+
+    Args:
+        - phi (np.ndarray or callable): The fields, as an array of shape
+            (N, N, N, nbins) or a function returning the (N, N, nbins)
+            x-plane of index x.
+        - Nt (np.ndarray): The number of tracers to generate per field.
+        - L (float): The side-length of the box (Mpc/h).
+        - origin (np.ndarray): The coordinates of the origin of the box (Mpc/h).
+        - nthreads (int): Number of threads. Defaults to all cores.
+        - seed (int): Random seed. Defaults to a draw from the global
+            numpy random state.
+        - sums (np.ndarray): Precomputed plane_sums(phi), shape (N, nbins).
+
+    Returns:
+        - xtrue (list): The coordinates (Mpc/h) of the tracers of each
+            field, each of shape (Nt[b], 3).
+    """
+    plane, N, nbins = _as_planes(phi)
+    Nt = np.asarray(Nt, dtype=np.int64)
+    nthreads = get_nthreads(nthreads)
+    if seed is None:
+        seed = np.random.randint(0, 2**31)
+    seeds = np.random.SeedSequence(seed).spawn(N + 1)
+
+    # Number of points in the cells between planes x and x+1
+    S = plane_sums(phi, nthreads) if sums is None else sums
+    T = S + np.roll(S, -1, axis=0)
+    rng = np.random.default_rng(seeds[-1])
+    counts = np.zeros((N, nbins), dtype=np.int64)
+    for b in np.flatnonzero(Nt):
+        counts[:, b] = rng.multinomial(Nt[b], T[:, b] / T[:, b].sum())
+
+    # Sample plane by plane
+    def sample(x):
+        return _sample_plane(plane(x), plane((x + 1) % N), x, counts[x],
+                             np.random.default_rng(seeds[x]))
+    planes = np.flatnonzero(counts.sum(axis=1))
+    with ThreadPoolExecutor(nthreads) as pool:
+        out = list(pool.map(sample, planes))
+
+    # Split by bin
+    if len(out) > 0:
+        pos, bins = map(np.concatenate, zip(*out))
+    else:
+        pos, bins = np.zeros((0, 3)), np.zeros(0, dtype=int)
+    pos = pos[np.argsort(bins, kind='stable')] * (L / N) + origin
+    return np.split(pos, np.cumsum(Nt)[:-1])
 
 
 def sample_3d(phi: np.ndarray, Nt: int, L: float, frac_sig_x: float, origin: np.ndarray) -> np.ndarray:
@@ -201,90 +291,11 @@ def sample_3d(phi: np.ndarray, Nt: int, L: float, frac_sig_x: float, origin: np.
         - sigma_mu (float):  The uncertainty in the distance moduli of the tracers.
     """
 
-    N = phi.shape[0]
     h = 1
 
-    # (1) Find which cell each point lives in
-    mean = phi + \
-        np.roll(phi, -1, axis=0) + \
-        np.roll(phi, -1, axis=1) + \
-        np.roll(phi, -1, axis=2) + \
-        np.roll(phi, -1, axis=(0, 1)) + \
-        np.roll(phi, -1, axis=(0, 2)) + \
-        np.roll(phi, -1, axis=(1, 2)) + \
-        np.roll(phi, -1, axis=(0, 1, 2))
-    prob = mean.flatten() / mean.sum()
-    i = np.arange(prob.shape[0])
-    a1d = np.random.choice(i, Nt, p=prob)
-    a3d = np.array(np.unravel_index(a1d, (N, N, N)))
-
-    # (2) Find the x values
-    shape = (N, N, N)
-    alpha = np.zeros(Nt)
-    for subscript in [(0, 0, 0), (0, 0, 1), (0, 1, 0), (0, 1, 1)]:
-        idx = get_new_index(a3d, shape, subscript)
-        alpha += phi[idx[0, :], idx[1, :], idx[2, :]]
-    beta = np.zeros(Nt)
-    for subscript in [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]:
-        idx = get_new_index(a3d, shape, subscript)
-        beta += phi[idx[0, :], idx[1, :], idx[2, :]]
-    u0 = a3d[0, :]
-    u1 = a3d[0, :] + 1
-    xtrue = draw_linear(Nt, alpha, beta, u0, u1)
-
-    # (3) Find the y values
-    shape = (N, N, N)
-    alpha = np.zeros(Nt)
-    for subscript in [(0, 0, 0), (0, 0, 1)]:
-        idx = get_new_index(a3d, shape, subscript)
-        alpha += phi[idx[0, :], idx[1, :], idx[2, :]] * (a3d[0, :] + 1 - xtrue)
-    for subscript in [(1, 0, 0), (1, 0, 1)]:
-        idx = get_new_index(a3d, shape, subscript)
-        alpha += phi[idx[0, :], idx[1, :], idx[2, :]] * (xtrue - a3d[0, :])
-    beta = np.zeros(Nt)
-    for subscript in [(0, 1, 0), (0, 1, 1)]:
-        idx = get_new_index(a3d, shape, subscript)
-        beta += phi[idx[0, :], idx[1, :], idx[2, :]] * (a3d[0, :] + 1 - xtrue)
-    for subscript in [(1, 1, 0), (1, 1, 1)]:
-        idx = get_new_index(a3d, shape, subscript)
-        beta += phi[idx[0, :], idx[1, :], idx[2, :]] * (xtrue - a3d[0, :])
-    u0 = a3d[1, :]
-    u1 = a3d[1, :] + 1
-    ytrue = draw_linear(Nt, alpha, beta, u0, u1)
-
-    # (4) Find the z values
-    xd = (xtrue - a3d[0, :])  # x1-x0=1 so xd = x - x0
-    yd = (ytrue - a3d[1, :])  # y1-y0=1 so yd = y - y0
-    ia = get_new_index(a3d, shape, (0, 0, 0))
-    ib = get_new_index(a3d, shape, (1, 0, 0))
-    phi00 = phi[ia[0, :], ia[1, :], ia[2, :]] * (1 - xd) + \
-        phi[ib[0, :], ib[1, :], ib[2, :]] * xd
-    ia = get_new_index(a3d, shape, (0, 0, 1))
-    ib = get_new_index(a3d, shape, (1, 0, 1))
-    phi01 = phi[ia[0, :], ia[1, :], ia[2, :]] * (1 - xd) + \
-        phi[ib[0, :], ib[1, :], ib[2, :]] * xd
-    ia = get_new_index(a3d, shape, (0, 1, 0))
-    ib = get_new_index(a3d, shape, (1, 1, 0))
-    phi10 = phi[ia[0, :], ia[1, :], ia[2, :]] * (1 - xd) + \
-        phi[ib[0, :], ib[1, :], ib[2, :]] * xd
-    ia = get_new_index(a3d, shape, (0, 1, 1))
-    ib = get_new_index(a3d, shape, (1, 1, 1))
-    phi11 = phi[ia[0, :], ia[1, :], ia[2, :]] * (1 - xd) + \
-        phi[ib[0, :], ib[1, :], ib[2, :]] * xd
-    alpha = phi00 * (1 - yd) + phi10 * yd  # alpha = phi0
-    beta = phi01 * (1 - yd) + phi11 * yd   # beta = phi1
-    u0 = a3d[2, :]
-    u1 = a3d[2, :] + 1
-    ztrue = draw_linear(Nt, alpha, beta, u0, u1)
-
-    # Convert to coordinates, and move relative to origin
-    xtrue *= L / N  # Mpc/h
-    ytrue *= L / N  # Mpc/h
-    ztrue *= L / N  # Mpc/h
-
-    xtrue += origin[0]
-    ytrue += origin[1]
-    ztrue += origin[2]
+    # Sample the points, relative to origin
+    xtrue, ytrue, ztrue = sample_3d_batch(
+        phi[..., np.newaxis], [Nt], L, origin)[0].T
 
     # Convert to RA, Dec, Distance
     rtrue = np.sqrt(xtrue ** 2 + ytrue ** 2 + ztrue ** 2)   # Mpc/h
@@ -334,14 +345,11 @@ def sample_velocities_CIC(
         v_theory = np.transpose(v_theory, (1, 2, 3, 0))
         fvel[np.isnan(fvel)] = v_theory[np.isnan(fvel)]
 
-    # Interpolate to halo positions
-    hvel = []
-    for i in range(len(hpos)):
-        if len(hpos[i]) == 0:
-            hvel.append([])
-        else:
-            hvel.append(
-                interp_field(fvel.T, hpos[i], L, np.zeros(3), order=1).T)
+    # Interpolate to halo positions. Note, this keeps the convention of
+    # interpolating fvel.T, i.e. with the field axes in reverse order
+    hvel = interp_field_batched(
+        fvel, [x if len(x) == 0 else np.asarray(x)[:, ::-1] for x in hpos],
+        L, np.zeros(3))
 
     for i in range(len(hvel)):
         if np.any(np.isnan(hvel[i])):
@@ -353,50 +361,85 @@ def sample_velocities_CIC(
 
 
 @timing_decorator
-def sample_velocities_kNN(hpos, ppos, pvel):
-    knn = KNeighborsRegressor(
-        n_neighbors=5, leaf_size=1000,
-        algorithm='ball_tree', weights='distance', n_jobs=-1)
-    knn.fit(ppos, pvel)
-    vtrues = [knn.predict(x) for x in tqdm.tqdm(hpos)]
-    return vtrues
-
-
-@timing_decorator
-def sample_velocities_density(hpos, rho, L, smooth_R, cosmo, z):
-    cosmo = cosmo_to_astropy(params=cosmo)
-    vel = get_vtheory(rho, L, smooth_R, f=cosmo.Om(z)**0.55)
-    hvel = [interp_field(vel, hpos[i], L, np.zeros(3), order=1).T
-            for i in range(len(hpos))]
-    return hvel
-
+def sample_velocities_kNN(hpos, ppos, pvel, L, k=5, subsample=None,
+                          chunk_size=None, nthreads=None, seed=None):
+    """Halo velocities from the k nearest particles, in a periodic box.
 
-def Fourier_ks(N_BOX: int, l: float) -> jnp.ndarray:
-    """
-    Compute the Fourier k grid for a given box
+    A periodic cKDTree is built over the particles, so no padded copies of
+    the particles near the faces are made, and the halos of all mass bins
+    are queried in one threaded call. Velocities are averaged with inverse
+    distance weights. If chunk_size is given, the particles are streamed in
+    chunks of that size, building one tree per chunk and keeping the k
+    nearest neighbours found so far.
 
     Args:
-        - N_BOX (int): The number of grid points per side of the box
-        - l (float): The side-length of the box
+        hpos (list): halo positions (Nh, 3) of each mass bin
+        ppos (array-like): (Np, 3) particle positions (Mpc/h)
+        pvel (array-like): (Np, 3) particle velocities
+        L (float): box size (Mpc/h)
+        k (int, optional): number of neighbours
+        subsample (float, optional): fraction of the particles to use
+        chunk_size (int, optional): number of particles per tree
+        nthreads (int, optional): number of query threads
+        seed (int, optional): seed of the particle subsampling
 
     Returns:
-        - jnp.ndarray: Array of k values for the Fourier grid
-
+        hvel (list): halo velocities (Nh, 3) of each mass bin
     """
-    kx = 2*np.pi*np.fft.fftfreq(N_BOX, d=l)
-    ky = 2*np.pi*np.fft.fftfreq(N_BOX, d=l)
-    kz = 2*np.pi*np.fft.fftfreq(N_BOX, d=l)
-
-    N_BOX_Z = (N_BOX//2 + 1)
+    nthreads = get_nthreads(nthreads)
+    rng = np.random.default_rng(seed)
+    Nh = [len(x) for x in hpos]
+    x = np.concatenate([np.reshape(x, (-1, 3)) for x in hpos])
+    x = np.mod(x, L)
+    x[x >= L] = 0  # np.mod can round up to L
+
+    num_particles = len(ppos)
+    if chunk_size is None:
+        chunk_size = num_particles
+    dist = np.full((len(x), k), np.inf)
+    vel = np.zeros((len(x), k, 3), dtype=np.float32)
+    for start in range(0, num_particles, chunk_size):
+        end = min(start + chunk_size, num_particles)
+        pos_chunk = np.asarray(ppos[start:end], dtype=np.float64)
+        vel_chunk = np.asarray(pvel[start:end], dtype=np.float32)
+        if subsample is not None:
+            mask = rng.random(len(pos_chunk)) < subsample
+            pos_chunk, vel_chunk = pos_chunk[mask], vel_chunk[mask]
+        if len(pos_chunk) == 0 or len(x) == 0:
+            continue
+        pos_chunk = np.mod(pos_chunk, L)
+        pos_chunk[pos_chunk >= L] = 0
+
+        tree = scipy.spatial.cKDTree(pos_chunk, boxsize=L)
+        kq = min(k, len(pos_chunk))
+        d, ind = tree.query(x, k=[*range(1, kq+1)], workers=nthreads)
+        del tree
+
+        # keep the k nearest of the previous and new neighbours
+        d = np.concatenate([dist, d], axis=1)
+        v = np.concatenate([vel, vel_chunk[ind]], axis=1)
+        order = np.argsort(d, axis=1, kind='stable')[:, :k]
+        dist = np.take_along_axis(d, order, axis=1)
+        vel = np.take_along_axis(v, order[..., None], axis=1)
+
+    # inverse distance weights, or only exact matches if there are any
+    with np.errstate(divide='ignore'):
+        w = 1 / dist
+    exact = dist == 0
+    hasexact = exact.any(axis=1)
+    w[hasexact] = exact[hasexact]
+    hvel = np.einsum('ij,ijk->ik', w, vel) / w.sum(axis=1, keepdims=True)
+
+    return np.split(hvel.astype(np.float32), np.cumsum(Nh)[:-1])
 
-    kx_vec = np.tile(kx[:, None, None], (1, N_BOX, N_BOX_Z))
-    ky_vec = np.tile(ky[None, :, None], (N_BOX, 1, N_BOX_Z))
-    kz_vec = np.tile(kz[None, None, :N_BOX_Z], (N_BOX, N_BOX, 1))
 
-    k_norm = np.sqrt(kx_vec**2 + ky_vec**2 + kz_vec**2)
-    k_norm[(k_norm < 1e-10)] = 1e-15
-
-    return jnp.array([kx_vec, ky_vec, kz_vec]), jnp.array(k_norm)
+@timing_decorator
+def sample_velocities_density(hpos, rho, L, smooth_R, cosmo, z):
+    cosmo = cosmo_to_astropy(params=cosmo)
+    vel = get_vtheory(rho, L, smooth_R, f=cosmo.Om(z)**0.55)
+    hvel = interp_field_batched(
+        np.asarray(vel), hpos, L, np.zeros(3), channel_axis=0)
+    return hvel
 
 
 @partial(jax.jit, static_argnames=['order'])
@@ -458,6 +501,93 @@ def interp_field(input_array: jnp.ndarray, coords: jnp.ndarray, L: float, origin
     return out_array
 
 
+def trilinear_gather(field: np.ndarray, coords: np.ndarray, L: float,
+                     origin: np.ndarray, channel_axis: int = -1,
+                     chunk_size: int = 2**20, nthreads: int = None) -> np.ndarray:
+    """
+    Periodic trilinear interpolation of all components of a vector field.
+
+    Equivalent to interp_field with order=1 on each component, but gathers
+    the eight corners of all components at once, in fixed-size chunks of
+    points processed in parallel threads.
+
+    Args:
+        - field (np.ndarray): The field, shape (N, N, N, C) or (C, N, N, N).
+        - coords (np.ndarray shape=(npoint, 3)): coordinates to evaluate at
+        - L (float): length of box
+        - origin (np.ndarray, shape=(3,)): position corresponding to index [0,0,0]
+        - channel_axis (int): The component axis of field, 0 or -1.
+        - chunk_size (int): Number of points per chunk.
+        - nthreads (int): Number of threads. Defaults to all cores.
+
+    Returns:
+        - out_array (np.ndarray, shape=(npoint, C)): field evaluated at coords
+    """
+    if channel_axis == 0:
+        C, N = field.shape[0], field.shape[1]
+        flat = field.reshape(C, -1)
+    else:
+        C, N = field.shape[-1], field.shape[0]
+        flat = field.reshape(-1, C)
+    coords = np.asarray(coords)
+    out = np.empty((len(coords), C), dtype=field.dtype)
+
+    def gather(start):
+        pos = (coords[start:start+chunk_size] - origin) * (N / L)
+        i0 = np.floor(pos)
+        w1 = pos - i0
+        w0 = 1 - w1
+        i0 = i0.astype(np.int64) % N
+        i1 = (i0 + 1) % N
+        res = 0
+        for dx in (0, 1):
+            ix = (i1 if dx else i0)[:, 0] * N
+            wx = (w1 if dx else w0)[:, 0]
+            for dy in (0, 1):
+                iy = (ix + (i1 if dy else i0)[:, 1]) * N
+                wxy = wx * (w1 if dy else w0)[:, 1]
+                for dz in (0, 1):
+                    idx = iy + (i1 if dz else i0)[:, 2]
+                    w = wxy * (w1 if dz else w0)[:, 2]
+                    if channel_axis == 0:
+                        res = res + flat[:, idx].T * w[:, None]
+                    else:
+                        res = res + flat[idx] * w[:, None]
+        out[start:start+chunk_size] = res
+
+    with ThreadPoolExecutor(get_nthreads(nthreads)) as pool:
+        list(pool.map(gather, range(0, len(coords), chunk_size)))
+    return out
+
+
+def interp_field_batched(field: np.ndarray, coords: list, L: float,
+                         origin: np.ndarray, channel_axis: int = -1) -> list:
+    """
+    Periodic trilinear interpolation of a vector field at several sets of
+    coordinates (e.g. one per mass bin), with a single call to
+    trilinear_gather.
+
+    Args:
+        - field (np.ndarray): The field, shape (N, N, N, C) or (C, N, N, N).
+        - coords (list): arrays of coordinates, each of shape (npoint_i, 3).
+            Empty entries are returned as empty lists.
+        - L (float): length of box
+        - origin (np.ndarray, shape=(3,)): position corresponding to index [0,0,0]
+        - channel_axis (int): The component axis of field, 0 or -1.
+
+    Returns:
+        - list: field evaluated at each set of coords, shape (npoint_i, C)
+    """
+    sizes = [len(x) for x in coords]
+    nonempty = [np.asarray(x) for x in coords if len(x) > 0]
+    if len(nonempty) == 0:
+        return [[] for _ in coords]
+    out = trilinear_gather(
+        field, np.concatenate(nonempty), L, origin, channel_axis)
+    out = np.split(out, np.cumsum(sizes)[:-1])
+    return [x if len(x) > 0 else [] for x in out]
+
+
 @jax.jit
 def project_radial(vec: jnp.ndarray, coords: jnp.ndarray, origin: jnp.ndarray) -> jnp.ndarray:
     """
@@ -478,85 +608,67 @@ def project_radial(vec: jnp.ndarray, coords: jnp.ndarray, origin: jnp.ndarray) -
     return vr
 
 
-def get_vtheory(delta: jnp.ndarray, L_BOX: float, smooth_R: float, f: float) -> jnp.ndarray:
+# a single kernel is kept, as it is as large as the Fourier-space field
+@lru_cache(maxsize=1)
+def vtheory_kernel(N: int, L: float, smooth_R: float, dtype=np.float32) -> tuple:
     """
-    Convert an overdensity field to a velocity field
+    Cached Fourier-space quantities for get_vtheory, on the rfft grid.
 
     Args:
-        - delta (jnp.ndarray): The overdensity field
+        - N (int): The number of grid points per side of the box
+        - L (float): Box length along each axis (Mpc/h)
+        - smooth_R (float): Smoothing scale (Mpc/h)
+        - dtype (np.dtype): Floating point precision
+
+    Returns:
+        - k (tuple): 1-D kx, ky, kz vectors, shaped to broadcast against the
+            (N, N, N//2+1) grid
+        - kernel (np.ndarray): exp(-(k R)^2) / k^2, zero at k = 0
+    """
+    kx = 2*np.pi*np.fft.fftfreq(N, d=L/N).astype(dtype)
+    kz = 2*np.pi*np.fft.rfftfreq(N, d=L/N).astype(dtype)
+    k = (kx[:, None, None], kx[None, :, None], kz[None, None, :])
+    k2 = k[0]**2 + k[1]**2 + k[2]**2
+    kernel = np.exp(-k2 * np.asarray(smooth_R**2, dtype=dtype))
+    kernel[0, 0, 0] = 0.
+    k2[0, 0, 0] = 1.
+    kernel /= k2
+    return k, kernel
+
+
+def get_vtheory(delta: np.ndarray, L_BOX: float, smooth_R: float, f: float,
+                dtype=np.float32, nthreads: int = None) -> np.ndarray:
+    """
+    Convert an overdensity field to a velocity field, using linear theory
+
+        v(k) = 100 i f delta(k) k / k^2 exp(-(k R)^2)
+
+    Args:
+        - delta (np.ndarray): The overdensity field
         - L_BOX (float): Box length along each axis (Mpc/h)
         - smooth_R (float): Smoothing scale (Mpc/h) to smooth density field before velocity computation
         - f (float): The logarithmic growth rate
+        - dtype (np.dtype): Floating point precision. Defaults to float32.
+        - nthreads (int): Number of FFT threads. Defaults to all cores.
 
     Returns:
-        - jnp.ndarray: The corresponding velocity field (km/s)
+        - np.ndarray: The corresponding velocity field (km/s), shape (3, N, N, N)
     """
-
-    # Some useful quantities
     N_SIDE = delta.shape[0]
-    N_Z = N_SIDE // 2 + 1
-    l = L_BOX / N_SIDE
-    dV = l ** 3
-    V = L_BOX ** 3
-
-    # Precommpute quantities for FFT calculation
-    k, k_norm = Fourier_ks(N_SIDE, l)
-    mask = np.ones((N_SIDE, N_SIDE, N_Z))
-    mask[N_Z:, :, 0] = 0.
-    mask[N_Z:, :, -1] = 0.
-    Fourier_mask = mask
-    prior_mask = np.array([mask, mask])
-    zero_ny_ind = [0, N_Z - 1]
-    for a in zero_ny_ind:
-        for b in zero_ny_ind:
-            for c in zero_ny_ind:
-                prior_mask[0, a, b, c] = 0.5 * prior_mask[0, a, b, c]
-                prior_mask[1, a, b, c] = 0.
-    update_index_real_0 = jnp.index_exp[0, N_Z:, :, 0]
-    update_index_real_ny = jnp.index_exp[0, N_Z:, :, N_Z - 1]
-    update_index_imag_0 = jnp.index_exp[1, N_Z:, :, 0]
-    update_index_imag_ny = jnp.index_exp[1, N_Z:, :, N_Z - 1]
-    flip_indices = -np.arange(N_SIDE)
-    flip_indices[N_Z - 1] = -flip_indices[N_Z - 1]
-    flip_indices = jnp.array(flip_indices.tolist())
-
-    # FFT
-    delta_k_complex = dV / V * jnp.fft.rfftn(delta)
-    delta_k = jnp.array([delta_k_complex.real, delta_k_complex.imag])
-
-    # Symmetrise
-    delta_k = Fourier_mask[jnp.newaxis] * delta_k
-    delta_k = delta_k.at[update_index_real_0].set(
-        jnp.take(jnp.flip(delta_k[0, 1:(N_Z-1), :, 0],
-                 axis=0), flip_indices, axis=1)
-    )
-    delta_k = delta_k.at[update_index_real_ny].set(
-        jnp.take(jnp.flip(delta_k[0, 1:(N_Z-1), :,
-                 N_Z - 1], axis=0), flip_indices, axis=1)
-    )
-    delta_k = delta_k.at[update_index_imag_0].set(
-        -jnp.take(jnp.flip(delta_k[1, 1:(N_Z-1), :, 0],
-                  axis=0), flip_indices, axis=1)
-    )
-
-    # Combine real and imaginary parts
-    J = jnp.array(complex(0, 1))
-    delta_k_complex = delta_k[0] + J * delta_k[1]
-
-    # Filter field
-    k_filter = jnp.exp(- 0.5 * (k_norm[:, :, :N_Z] * smooth_R)**2)
-    kR = k_norm * smooth_R
-    smooth_filter = np.exp(-0.5 * kR**2)
-    v_kx = smooth_filter * J * 100 * k_filter * \
-        f * delta_k_complex * k[0] / k_norm / k_norm
-    v_ky = smooth_filter * J * 100 * k_filter * \
-        f * delta_k_complex * k[1] / k_norm / k_norm
-    v_kz = smooth_filter * J * 100 * k_filter * \
-        f * delta_k_complex * k[2] / k_norm / k_norm
-
-    # Convert back to real space
-    vx = (jnp.fft.irfftn(v_kx) * (V / dV))
-    vy = (jnp.fft.irfftn(v_ky) * (V / dV))
-    vz = (jnp.fft.irfftn(v_kz) * (V / dV))
-
-    return jnp.array([vx, vy, vz])
+    workers = get_nthreads(nthreads)
+    k, kernel = vtheory_kernel(
+        N_SIDE, float(L_BOX), float(smooth_R), np.dtype(dtype))
+
+    # FFT and filter
+    delta_k = scipy.fft.rfftn(
+        np.asarray(delta, dtype=dtype), workers=workers)
+    delta_k *= kernel
+    delta_k *= 1j * 100 * f
+
+    # Convert the three components back to real space in one batch
+    v_k = np.empty((3,) + delta_k.shape, dtype=delta_k.dtype)
+    for i in range(3):
+        np.multiply(delta_k, k[i], out=v_k[i])
+    del delta_k
+    return scipy.fft.irfftn(
+        v_k, s=delta.shape, axes=(1, 2, 3), overwrite_x=True, workers=workers)
@@ -10,15 +10,23 @@ Currently implemented models:
 Each model derives from the `Hod_model` parent class,
 which additionally uses the `Hod_parameter` helper class
 for each parameter.
+
+Halos are populated either with halotools (`build_halo_catalog`
+and `build_HOD_model`), or natively with `populate_galaxies`.
 """
 
 import logging
 import numpy as np
+import jax
+from functools import lru_cache
 from omegaconf import open_dict
+from scipy.interpolate import InterpolatedUnivariateSpline as IUS
+from scipy.special import erf, spence
 
 from halotools.empirical_models import NFWProfile
 from halotools.sim_manager import UserSuppliedHaloCatalog
-from halotools.empirical_models import halo_mass_to_halo_radius
+from halotools.empirical_models import (
+    halo_mass_to_halo_radius, halo_mass_to_virial_velocity)
 from halotools.empirical_models import (
     Zheng07Cens, Zheng07Sats,
     Leauthaud11Cens, Leauthaud11Sats,
@@ -553,3 +561,352 @@ def build_HOD_model(
         satellites_profile=satsprof
     )
     return HodModelFactory(**model)
+
+
+# Native HOD engine
+#
+# The functions below reproduce the halotools occupation and NFW phase space
+# models used by build_HOD_model, operating directly on plain arrays.
+
+# Stellar mass threshold (log10 Msun/h) of the stellar-to-halo mass
+# relation based models, halotools' default
+SMHM_THRESHOLD = 10.5
+
+# Little h assumed by the Leauthaud+11 parameters
+L11_LITTLEH = 0.72
+
+# Range of NFW concentrations permitted by halotools' phase space model
+CONC_RANGE = (2., 20.)
+
+
+def zheng07_occupation(mass, theta, redshift=None):
+    """Mean number of centrals and satellites of the Zheng+07 model."""
+    logM = np.log10(mass)
+    ncen = 0.5 * (1. + erf((logM - theta['logMmin']) / theta['sigma_logM']))
+    M0, M1 = 10.**theta['logM0'], 10.**theta['logM1']
+    with np.errstate(invalid='ignore'):
+        nsat = np.where(mass > M0, ((mass - M0) / M1)**theta['alpha'], 0.)
+    return ncen, nsat * ncen
+
+
+def leauthaud11_log_halo_mass(log_stellar_mass, theta, redshift):
+    """Inverse stellar-to-halo mass relation of Leauthaud+11, in h=1 units.
+    """
+    a = 1. / (1. + redshift)
+
+    def param(key):
+        return theta[f'{key}_0'] + theta[f'{key}_a'] * (a - 1)
+
+    lgh = np.log10(L11_LITTLEH)
+    ratio = 10.**(log_stellar_mass - 2*lgh) / 10.**param('smhm_m0')
+    log_halo_mass = (
+        param('smhm_m1') + param('smhm_beta') * np.log10(ratio) +
+        ratio**param('smhm_delta') / (1 + ratio**(-param('smhm_gamma'))) -
+        0.5)
+    return log_halo_mass + lgh
+
+
+def leauthaud11_occupation(mass, theta, redshift):
+    """Mean number of centrals and satellites of the Leauthaud+11 model."""
+    lgh = np.log10(L11_LITTLEH)
+
+    # invert the stellar-to-halo mass relation (linear spline, as halotools)
+    log_stellar_mass = np.linspace(8.5, 12.5, 100)
+    log_halo_mass = leauthaud11_log_halo_mass(
+        log_stellar_mass, theta, redshift)
+    log_stellar_mass = IUS(log_halo_mass, log_stellar_mass, k=1)(
+        np.log10(mass))
+
+    logscatter = np.sqrt(2) * theta['scatter_model_param1']
+    ncen = 0.5 * (1. - erf(
+        (SMHM_THRESHOLD - log_stellar_mass) / logscatter))
+
+    knee = 10.**(leauthaud11_log_halo_mass(
+        SMHM_THRESHOLD, theta, redshift) - lgh) / 1e12
+    msat = 1e12 * theta['bsat'] * knee**theta['betasat']
+    mcut = 1e12 * theta['bcut'] * knee**theta['betacut']
+    mass = mass / L11_LITTLEH
+    nsat = np.exp(-mcut / mass) * (mass / msat)**theta['alphasat']
+    return ncen, nsat * ncen
+
+
+def zu_mandelbaum15_halo_mass(stellar_mass, theta):
+    """Inverse stellar-to-halo mass relation of Zu & Mandelbaum+15."""
+    ratio = stellar_mass / 10.**theta['smhm_m0']
+    exparg = ratio**theta['smhm_delta'] / (
+        1. + ratio**(-theta['smhm_gamma'])) - 0.5
+    return 10.**theta['smhm_m1'] * ratio**theta['smhm_beta'] * 10.**exparg
+
+
+def zu_mandelbaum15_occupation(mass, theta, redshift=None):
+    """Mean number of centrals and satellites of the Zu & Mandelbaum+15
+    model. As in the configuration, smhm_m0 and smhm_m1 are in log10."""
+    # invert the stellar-to-halo mass relation
+    stellar_mass = np.logspace(8.5, 12.5, 500)
+    halo_mass = zu_mandelbaum15_halo_mass(stellar_mass, theta)
+    log_stellar_mass = np.interp(
+        np.log10(mass), np.log10(halo_mass), np.log10(stellar_mass))
+
+    m1 = 10.**theta['smhm_m1']
+    sigma = np.where(
+        mass < m1, theta['smhm_sigma'],
+        theta['smhm_sigma'] + theta['smhm_sigma_slope'] * np.log10(mass / m1))
+    ncen = 0.5 * (1. - erf(
+        np.log(10.) * (SMHM_THRESHOLD - log_stellar_mass) /
+        (sigma * np.sqrt(2))))
+
+    knee = zu_mandelbaum15_halo_mass(10.**SMHM_THRESHOLD, theta) / 1e12
+    msat = 1e12 * theta['bsat'] * knee**theta['betasat']
+    mcut = 1e12 * theta['bcut'] * knee**theta['betacut']
+    nsat = np.exp(-mcut / mass) * (mass / msat)**theta['alphasat']
+    return ncen, nsat * ncen
+
+
+OCCUPATION_MODELS = {
+    'zheng07': zheng07_occupation,
+    'leauthaud11': leauthaud11_occupation,
+    'zu_mandelbaum15': zu_mandelbaum15_occupation,
+}
+
+
+# Range and size of the NFW lookup tables in y = conc * r / R
+NFW_TABLE_RANGE = (1e-8, 1e3)
+NFW_TABLE_SIZE = 16384
+
+
+def nfw_enclosed_mass(y):
+    """Enclosed mass of an NFW profile within y = r / r_s, in units of
+    4 pi rho_s r_s^3."""
+    return np.log1p(y) - y / (1. + y)
+
+
+def nfw_jeans_integral(y):
+    """Isotropic Jeans radial velocity dispersion of an NFW halo at
+    y = r / r_s, in units of 4 pi G rho_s r_s^2.
+
+    Closed form of the Jeans integral (Lokas & Mamon 2001, eq. 14).
+    """
+    log1py = np.log1p(y)
+    integral = 0.5 * (
+        np.pi**2 - np.log(y) - 1./y - 1./(1. + y)**2 - 6./(1. + y) +
+        (1. + 1./y**2 - 4./y - 2./(1. + y)) * log1py +
+        3. * log1py**2 + 6. * spence(1. + y))
+    return np.maximum(y * (1. + y)**2 * integral, 0.)
+
+
+@lru_cache(maxsize=None)
+def nfw_lookup_tables(ymin=NFW_TABLE_RANGE[0], ymax=NFW_TABLE_RANGE[1],
+                      size=NFW_TABLE_SIZE):
+    """Lookup tables of the NFW inverse enclosed mass and Jeans dispersion.
+
+    In units of r_s, both are functions of y = r / r_s alone, so a single
+    set of tables serves all concentrations, cosmologies, redshifts and
+    mass definitions. Both are tabulated on uniform grids in log, so
+    lookups need no search.
+
+    Returns:
+        logm (np.ndarray): Uniform grid in log(nfw_enclosed_mass).
+        logy (np.ndarray): log(y) at each logm.
+        logy_grid (np.ndarray): Uniform grid in log(y).
+        sigma (np.ndarray): sqrt(nfw_jeans_integral) at each logy_grid.
+    """
+    logy_grid = np.linspace(np.log(ymin), np.log(ymax), size)
+    sigma = np.sqrt(nfw_jeans_integral(np.exp(logy_grid)))
+
+    # invert the enclosed mass, refining with Newton steps in log space
+    logm = np.linspace(np.log(nfw_enclosed_mass(ymin)),
+                       np.log(nfw_enclosed_mass(ymax)), size)
+    logy = np.interp(logm, np.log(nfw_enclosed_mass(np.exp(logy_grid))),
+                     logy_grid)
+    for _ in range(3):
+        y = np.exp(logy)
+        m = nfw_enclosed_mass(y)
+        logy -= (np.log(m) - logm) * m * (1. + y)**2 / y**2
+    return logm, logy, logy_grid, sigma
+
+
+def _lerp(q, grid, table):
+    # linear interpolation on a uniform grid, clamped at its ends
+    t = np.clip((q - grid[0]) / (grid[1] - grid[0]), 0, len(grid) - 1)
+    with np.errstate(invalid='ignore'):  # nan propagates through t
+        i = np.clip(t.astype(np.int64), 0, len(grid) - 2)
+    return table[i] + (t - i) * (table[i + 1] - table[i])
+
+
+def nfw_scaled_radius(u, conc):
+    """Inverse CDF of the NFW profile, r/R of the quantile u in (0, 1).
+
+    Interpolated in the inverse enclosed mass table of nfw_lookup_tables.
+    """
+    logm, logy, _, _ = nfw_lookup_tables()
+    with np.errstate(divide='ignore'):
+        q = np.log(u * nfw_enclosed_mass(conc))
+    return np.exp(_lerp(q, logm, logy)) / conc
+
+
+def nfw_radial_dispersion(x, conc):
+    """Isotropic Jeans radial velocity dispersion of an NFW halo, in units
+    of the virial velocity, at r/R = x.
+
+    Interpolated in the Jeans dispersion table of nfw_lookup_tables.
+    """
+    _, _, logy_grid, sigma = nfw_lookup_tables()
+    with np.errstate(divide='ignore'):
+        q = np.log(conc * x)
+    return np.sqrt(conc / nfw_enclosed_mass(conc)) * _lerp(
+        q, logy_grid, sigma)
+
+
+def _padded(*arrays):
+    # pad to the next power of two, to reuse the compiled random draws
+    n = len(arrays[0])
+    size = 1 << max(n - 1, 0).bit_length()
+    return [np.pad(x, (0, size - n)) for x in arrays]
+
+
+@jax.jit
+def _draw_occupations(key, hostid, mean_ncen, mean_nsat):
+    # one counter-based stream per halo, keyed on its ID
+    kcen, ksat = jax.random.split(key)
+
+    def draw(i, ncen, nsat):
+        u = jax.random.uniform(jax.random.fold_in(kcen, i))
+        n = jax.random.poisson(jax.random.fold_in(ksat, i), nsat)
+        return u < ncen, n
+    return jax.vmap(draw)(hostid, mean_ncen, mean_nsat)
+
+
+@jax.jit
+def _draw_satellites(key, hostid, index):
+    # one counter-based stream per satellite, keyed on its host ID and its
+    # index in the host
+    def draw(i, j):
+        k = jax.random.fold_in(jax.random.fold_in(key, i), j)
+        ku, kn = jax.random.split(k)
+        return jax.random.uniform(ku, (3,)), jax.random.normal(kn, (3,))
+    return jax.vmap(draw)(hostid, index)
+
+
+def halo_properties(mass, redshift, cosmo, conc=None, mdef='vir'):
+    '''Halo properties used to place satellites with populate_galaxies.
+
+    These depend only on the halo catalog, so they can be computed once
+    and reused for many HOD parameters and seeds.
+
+    Args:
+        mass (array_like): Halo masses in Msun/h. Shape (N,).
+        redshift (float): The redshift of the halo catalog.
+        cosmo (astropy.cosmology.Cosmology):
+            The cosmology used for the simulation.
+        conc (array_like, optional): Halo concentration parameter.
+            Defaults to the mass-concentration relation.
+        mdef (str, optional): Halo mass definition. Defaults to 'vir'.
+
+    Returns:
+        dict: Halo radius in Mpc/h ('radius'), concentration ('conc') and
+            virial velocity in km/s ('vvir'), each of shape (N,).
+    '''
+    mass = np.asarray(mass, dtype=np.float64)
+    if conc is None:
+        conc = mass_to_concentration(mass, redshift, cosmo, mdef)
+    return {
+        'radius': halo_mass_to_halo_radius(mass, cosmo, redshift, mdef),
+        'conc': np.clip(np.asarray(conc, dtype=np.float64), *CONC_RANGE),
+        'vvir': halo_mass_to_virial_velocity(mass, cosmo, redshift, mdef),
+    }
+
+
+def populate_galaxies(
+    pos, vel, mass, redshift, BoxSize, cosmo,
+    model, theta, conc=None, mdef='vir', seed=0, halo_props=None
+):
+    '''Populate halos with galaxies, without building halotools tables.
+
+    Equivalent to building the halotools catalog and HOD model with
+    build_halo_catalog and build_HOD_model and running populate_mock:
+    centrals sit at the halo centers with the halo velocities, and
+    satellites follow an NFW profile with isotropic Jeans velocity
+    dispersions. Every halo and satellite draws from its own counter-based
+    random stream, so results do not depend on the order or the subset of
+    the halos.
+
+    Args:
+        pos (array_like): Halo comoving positions in Mpc/h. Shape (N, 3).
+        vel (array_like): Halo physical velocities in km/s. Shape (N, 3).
+        mass (array_like): Halo masses in Msun/h. Shape (N,).
+        redshift (float): The redshift of the halo catalog.
+        BoxSize (float): The size of the simulation box in Mpc/h.
+        cosmo (astropy.cosmology.Cosmology):
+            The cosmology used for the simulation.
+        model (str): The HOD model, one of OCCUPATION_MODELS.
+        theta (dict): The HOD parameters.
+        conc (array_like, optional): Halo concentration parameter.
+            Defaults to the mass-concentration relation.
+        mdef (str, optional): Halo mass definition. Defaults to 'vir'.
+        seed (int, optional): Random seed. Defaults to 0.
+        halo_props (dict, optional): Precomputed halo_properties of all
+            halos. If given, conc and mdef are ignored.
+
+    Returns:
+        gpos (np.ndarray): Galaxy comoving positions in Mpc/h. Shape (Ng, 3).
+        gvel (np.ndarray): Galaxy physical velocities in km/s. Shape (Ng, 3).
+        gal_type (np.ndarray): 'centrals' or 'satellites'. Shape (Ng,).
+        hostid (np.ndarray): Index of the host halo. Shape (Ng,).
+    '''
+    if model not in OCCUPATION_MODELS:
+        raise NotImplementedError(
+            f'HOD model {model} not implemented in the native engine. '
+            f'Choose from {list(OCCUPATION_MODELS)}.')
+    pos, vel = np.asarray(pos), np.asarray(vel)
+    mass = np.asarray(mass, dtype=np.float64)
+    theta = dict(theta)
+    BoxSize = np.broadcast_to(BoxSize, 3)
+
+    # occupations
+    mean_ncen, mean_nsat = OCCUPATION_MODELS[model](mass, theta, redshift)
+    kocc, kphase = jax.random.split(jax.random.PRNGKey(seed))
+    # only draw for halos which can host galaxies, most of the low-mass
+    # halos cannot. The streams are keyed by halo index, so this does not
+    # change the draws
+    haloid = np.flatnonzero((mean_ncen > 0) | (mean_nsat > 0))
+    has_cen, nsat = _draw_occupations(
+        kocc, *_padded(haloid, mean_ncen[haloid], mean_nsat[haloid]))
+    has_cen = np.asarray(has_cen)[:len(haloid)]
+    nsat = np.asarray(nsat)[:len(haloid)]
+
+    # satellites
+    satid = np.repeat(haloid, nsat)
+    index = np.arange(len(satid)) - np.repeat(np.cumsum(nsat) - nsat, nsat)
+    u, n = _draw_satellites(kphase, *_padded(satid, index))
+    u = np.asarray(u, dtype=np.float64)[:len(satid)]
+    n = np.asarray(n, dtype=np.float64)[:len(satid)]
+
+    # NFW positions, within the halo radius
+    if halo_props is None:
+        halo_props = halo_properties(
+            mass[satid], redshift, cosmo,
+            conc=None if conc is None else np.asarray(conc)[satid],
+            mdef=mdef)
+    else:
+        halo_props = {k: np.asarray(v)[satid] for k, v in halo_props.items()}
+    radius, csat = halo_props['radius'], halo_props['conc']
+    x = nfw_scaled_radius(u[:, 0], csat)
+    cos_t, phi = 2*u[:, 1] - 1, 2*np.pi*u[:, 2]
+    sin_t = np.sqrt(1 - cos_t**2)
+    offset = (x * radius)[:, None] * np.stack(
+        [sin_t * np.cos(phi), sin_t * np.sin(phi), cos_t], axis=-1)
+
+    # isotropic Jeans velocities
+    sigma = nfw_radial_dispersion(x, csat) * halo_props['vvir']
+    sigma = np.where(sigma <= 0, np.finfo(float).eps, sigma)
+
+    # centrals first, then satellites, as in halotools
+    cenid = haloid[has_cen.astype(bool)]
+    hostid = np.concatenate([cenid, satid])
+    gpos = np.concatenate([pos[cenid], pos[satid] + offset])
+    gpos = np.mod(gpos, BoxSize)
+    gvel = np.concatenate([vel[cenid], vel[satid] + sigma[:, None] * n])
+    gal_type = np.array(
+        ['centrals']*len(cenid) + ['satellites']*len(satid), dtype=object)
+
+    return gpos, gvel, gal_type, hostid
@@ -15,6 +15,7 @@ from astropy.cosmology import Planck18
 from ..utils import get_source_path, timing_decorator, cosmo_to_astropy
 from ..nbody.tools import parse_nbody_config
 from ..bias.apply_hod import parse_hod
+from ..bias.tools.catalog import read_catalog_dataset
 from .tools import MA, MAz, get_box_catalogue, get_box_catalogue_rsd
 from .tools import calcPk, calcBk
 from ..survey.tools import sky_to_xyz
@@ -282,10 +283,10 @@ def summarize_tracer(
 
         # Load
         with h5py.File(filename, 'r') as f:
-            pos = f[a]['pos'][...].astype(np.float32)
-            vel = f[a]['vel'][...].astype(np.float32)
+            pos = read_catalog_dataset(f[a]['pos']).astype(np.float32)
+            vel = read_catalog_dataset(f[a]['vel']).astype(np.float32)
             if proxy in f[a].keys():
-                mass = f[a][proxy][...].astype(np.float32)
+                mass = read_catalog_dataset(f[a][proxy]).astype(np.float32)
             else:
                 mass = None
         pos %= L  # Ensure all tracers inside box
@@ -416,16 +417,13 @@ def summarize_lightcone(
         z = f['z'][...]
     rdz = np.vstack([ra, dec, z]).T
 
-    # convert to comoving
-    pos = sky_to_xyz(rdz, cosmo)
+    # convert to comoving, in float32
+    pos = sky_to_xyz(rdz, cosmo, dtype=np.float32)
 
     # Noise out positions (we do not probe less than Lnoise)
     Lnoise = (1000/128)/np.sqrt(3)  # Set by CHARM resolution
     pos += np.random.randn(*pos.shape) * Lnoise
 
-    # convert to float32
-    pos = pos.astype(np.float32)
-
     if cap == 'ngc':
         # offset to center (min is about -1870, -1750, -120)
         pos += [2000, 1800, 250]
@@ -124,13 +124,12 @@ def main(cfg: DictConfig) -> None:
     cpar = build_cosmology(*cfg.nbody.cosmo)
 
     # Get ICs
-    # Note: these are loaded in all ranks, to minimize MPI memory usage
-    wn = get_ICs(cfg)
-    wn *= -1  # BORG uses opposite sign
+    # Note: these are mapped in all ranks, and only the local slab is read
+    wn = get_ICs(cfg, mmap=True)
 
     # Get MPI slice
     startN0, localN0, _, _ = getMPISlice(cfg)
-    wn = wn[startN0:startN0+localN0]
+    wn = -wn[startN0:startN0+localN0]  # BORG uses opposite sign
 
     # Apply transfer fn to ICs (for CHARM)
     if cfg.nbody.save_transfer:
@@ -163,7 +162,8 @@ def main(cfg: DictConfig) -> None:
         fvel *= (1 + cfg.nbody.zf)
 
         # Save
-        save_nbody(outdir, cfg.nbody.af, rho, fvel, pos, vel)
+        save_nbody(outdir, cfg.nbody.af, rho, fvel, pos, vel,
+                   storage=cfg.nbody.storage)
         save_cfg(outdir, cfg)
         logging.info("Done!")
     comm.Barrier()
@@ -72,7 +72,8 @@ def run_density(wn, cpar, cfg, outdir=None):
     # at each desired step
     noti = BorgNotifier(
         asave=nbody.asave, N=nbody.N, L=nbody.L,
-        omega_m=cpar.omega_m, h=cpar.h, outdir=outdir)
+        omega_m=cpar.omega_m, h=cpar.h, outdir=outdir,
+        storage=nbody.storage, nthreads=nbody.get('cic_nthreads', None))
     pm.setStepNotifier(
         noti,
         with_particles=True
@@ -87,6 +88,9 @@ def run_density(wn, cpar, cfg, outdir=None):
     logging.info('Running forward...')
     chain.forwardModel_v2(wn)
 
+    # Wait for the last snapshots to be saved
+    noti.close()
+
     # Density fields are saved during forward run, so nothing is returned
 
 
@@ -122,8 +126,7 @@ def main(cfg: DictConfig) -> None:
 
     # Get ICs
     # Note: these are loaded in all ranks, to minimize MPI memory usage
-    wn = get_ICs(cfg)
-    wn *= -1  # BORG uses opposite sign
+    wn = -get_ICs(cfg, mmap=True)  # BORG uses opposite sign
 
     # Apply transfer fn to ICs (for CHARM)
     if cfg.nbody.save_transfer:
@@ -10,20 +10,21 @@ import subprocess
 import h5py
 import multiprocessing as mp
 
-from ..utils import get_source_path, timing_decorator, save_cfg
+from ..utils import (
+    get_source_path, timing_decorator, save_cfg, get_nthreads,
+    get_available_memory)
 from .tools import (
     parse_nbody_config, get_ICs,
     save_white_noise_grafic, generate_pk_file, rho_and_vfield,
-    save_nbody
+    save_nbody, create_nbody_dataset, ParticleReader
 )
 
 
 def save_ICs(cfg, outdir):
-    ic = get_ICs(cfg)
-    ic = np.fft.irfftn(ic, norm="ortho")
+    ic = get_ICs(cfg, mmap=True)
 
     filename = join(outdir, "WhiteNoise_grafic")
-    save_white_noise_grafic(filename, ic, cfg.nbody.lhid)
+    save_white_noise_grafic(filename, ic, cfg.nbody.lhid, fourier=True)
 
 
 def generate_param_file(
@@ -153,54 +154,70 @@ def run_density(cfg, outdir):
     _ = subprocess.run(command, shell=True, check=True, env=env)
 
 
-@timing_decorator
-def process_transfer(cfg, outdir, delete_files=True):
-    with h5py.File(join(outdir, 'transfer.h5'), 'w') as outfile:
-        a = 1/(1+99.)  # hardcoded for now, from CHARM training
-        logging.info(f"Processing transfer function at a={a:.4f}...")
-        snapdir = join(outdir, f'fastpm_B{cfg.nbody.B}_{a:.4f}')
-        infile = bigfile.File(snapdir)
-        ds = bigfile.Dataset(infile['1/'], ['Position', 'Velocity', 'ID'])
-        pos = np.array(ds[:]['Position'])
-        vel = np.array(ds[:]['Velocity'])
-
-        # Measure density field
-        rho, _ = rho_and_vfield(
-            pos, vel, cfg.nbody.L, cfg.nbody.N, 'CIC',
-            omega_m=cfg.nbody.cosmo[0], h=cfg.nbody.cosmo[2])
-
-        # Convert to overdensity field
-        rho /= np.mean(rho)
-        rho -= 1
-
-        outfile.create_dataset('rho', data=rho)
+# Approximate peak memory of one post-processing worker, in bytes per grid
+# cell: CIC count and velocity buffers, normalized fields, and the copy of
+# rho and fvel sent back to the writer
+WORKER_BYTES_PER_CELL = 64
+
+
+def get_pool_size(N, ntasks, max_cores=None):
+    """Number of worker processes for snapshot post-processing.
+
+    Bounded by the number of tasks, the available cores and the available
+    memory, assuming each worker needs WORKER_BYTES_PER_CELL * N**3 bytes.
+    """
+    max_cores = get_nthreads(max_cores)
+    nproc = min(ntasks, max_cores)
+    mem = get_available_memory()
+    if mem is not None:
+        nproc = min(nproc, mem // (WORKER_BYTES_PER_CELL * N**3))
+    return max(int(nproc), 1)
+
+
+def process_transfer(cfg, outdir, delete_files=True, nthreads=None):
+    a = 1/(1+99.)  # hardcoded for now, from CHARM training
+    logging.info(f"Processing transfer function at a={a:.4f}...")
+    snapdir = join(outdir, f'fastpm_B{cfg.nbody.B}_{a:.4f}')
+    infile = bigfile.File(snapdir)
+    ds = bigfile.Dataset(infile['1/'], ['Position'])
+    reader = ParticleReader.from_bigfile(ds, vel_key=None)
+
+    # Measure density field, streaming particles from disk
+    rho, _ = rho_and_vfield(
+        reader, None, cfg.nbody.L, cfg.nbody.N, 'CIC',
+        omega_m=cfg.nbody.cosmo[0], h=cfg.nbody.cosmo[2],
+        nthreads=nthreads)
+
+    # Convert to overdensity field
+    rho /= np.mean(rho)
+    rho -= 1
 
     if delete_files:
         infile.close()
         shutil.rmtree(snapdir)
 
+    return 'transfer', a, rho, None
 
-def process_single_snapshot(cfg, outdir, a, delete_files=True):
+
+def process_single_snapshot(cfg, outdir, a, delete_files=True, nthreads=None):
     logging.info(f"Reading snapshot at a={a:.4f}...")
     snapdir = join(outdir, f'fastpm_B{cfg.nbody.B}_{a:.4f}')
 
     if not os.path.isdir(snapdir):
         logging.warning(f"Snapshot at a={a:.4f} not found, skipping...")
-        return
+        return 'snapshot', a, None, None
 
     infile = bigfile.File(snapdir)
-    ds = bigfile.Dataset(infile['1/'], ['Position', 'Velocity', 'ID'])
-    pos = np.array(ds[:]['Position'])  # comoving positions [Mpc/h]
-    vel = np.array(ds[:]['Velocity'])  # physical velocities [km/s]
+    ds = bigfile.Dataset(infile['1/'], ['Position', 'Velocity'])
+    # comoving positions [Mpc/h], physical velocities [km/s]
+    reader = ParticleReader.from_bigfile(ds)
 
-    # Measure density and velocity field
+    # Measure density and velocity field, streaming particles from disk
     logging.info(f"Processing snapshot at a={a:.4f}...")
     rho, fvel = rho_and_vfield(
-        pos, vel, cfg.nbody.L, cfg.nbody.N, 'CIC',
-        omega_m=cfg.nbody.cosmo[0], h=cfg.nbody.cosmo[2])
-
-    # Delete pos, vel
-    del pos, vel  # TODO: save these?
+        reader, None, cfg.nbody.L, cfg.nbody.N, 'CIC',
+        omega_m=cfg.nbody.cosmo[0], h=cfg.nbody.cosmo[2],
+        nthreads=nthreads)
 
     # Convert to overdensity field
     rho /= np.mean(rho)
@@ -213,41 +230,55 @@ def process_single_snapshot(cfg, outdir, a, delete_files=True):
         infile.close()
         shutil.rmtree(snapdir)
 
-    # Save to file
-    with h5py.File(join(outdir, f'nbody_{a:.4f}.h5'), 'w') as outfile:
-        outfile.create_dataset('rho', data=rho)
-        outfile.create_dataset('fvel', data=fvel)
+    return 'snapshot', a, rho, fvel
+
+
+def _process_task(args):
+    kind, cfg, outdir, a, delete_files, nthreads = args
+    if kind == 'transfer':
+        return process_transfer(cfg, outdir, delete_files, nthreads)
+    return process_single_snapshot(cfg, outdir, a, delete_files, nthreads)
 
 
 @timing_decorator
 def process_outputs(cfg, outdir, delete_files=True):
+    """Process all FastPM snapshots (and the transfer snapshot) in a pool.
+
+    Workers stream their fields back to this process, which is the single
+    writer appending each snapshot to nbody.h5 as soon as it is ready.
+    """
     asave = sorted(cfg.nbody.asave)
-    rho, fvel = None, None
-
-    with mp.Pool(3) as pool:
-        _ = pool.starmap(
-            process_single_snapshot,
-            [(cfg, outdir, a, delete_files) for a in asave]
-        )
-
-    logging.info("Concatenating snapshots...")
-    with h5py.File(join(outdir, 'nbody.h5'), 'w') as outfile:
-        for a in asave:
-            # Read snapshot
-            filename = join(outdir, f'nbody_{a:.4f}.h5')
-            with h5py.File(filename, 'r') as infile:
-                rho = infile['rho'][:]
-                fvel = infile['fvel'][:]
+    tasks = [('snapshot', a) for a in asave]
+    if cfg.nbody.save_transfer:
+        tasks = [('transfer', None)] + tasks
+
+    nproc = get_pool_size(cfg.nbody.N, len(tasks))
+    # fused NumPy CIC deposit is opt-in, MAS_library is used by default
+    nthreads = cfg.nbody.get('cic_nthreads', None)
+    logging.info(f"Processing {len(tasks)} snapshots with {nproc} workers...")
+    tasks = [(kind, cfg, outdir, a, delete_files, nthreads)
+             for kind, a in tasks]
+
+    rho, fvel, alast = None, None, -np.inf
+    with mp.Pool(nproc) as pool, \
+            h5py.File(join(outdir, 'nbody.h5'), 'w') as outfile:
+        for kind, a, rho_a, fvel_a in pool.imap_unordered(
+                _process_task, tasks):
+            if kind == 'transfer':
+                with h5py.File(join(outdir, 'transfer.h5'), 'w') as f:
+                    f.create_dataset('rho', data=rho_a)
+                continue
+            if rho_a is None:
+                continue
 
             # Save to file
-            key = f'{a:.6f}'
-            group = outfile.create_group(key)
-            group.create_dataset('rho', data=rho)
-            group.create_dataset('fvel', data=fvel)
+            logging.info(f"Saving snapshot at a={a:.4f}...")
+            group = outfile.create_group(f'{a:.6f}')
+            create_nbody_dataset(group, 'rho', rho_a, cfg.nbody.storage)
+            create_nbody_dataset(group, 'fvel', fvel_a, cfg.nbody.storage)
 
-            # Delete temporary file
-            if delete_files:
-                os.remove(filename)
+            if a > alast:
+                rho, fvel, alast = rho_a, fvel_a, a
 
     return rho, fvel, None, None  # return the last snapshot
 
@@ -295,8 +326,6 @@ def main(cfg: DictConfig) -> None:
 
     # Process outputs
     logging.info("Processing outputs...")
-    if cfg.nbody.save_transfer:
-        process_transfer(cfg, outdir, delete_files=True)
     rho, fvel, pos, vel = process_outputs(cfg, outdir, delete_files=True)
 
     if not cfg.nbody.save_particles:
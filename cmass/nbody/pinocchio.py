@@ -27,7 +27,8 @@ import h5py
 from omegaconf import DictConfig, OmegaConf
 from ..utils import get_source_path, timing_decorator, save_cfg
 from .tools import (
-    parse_nbody_config, gen_white_noise, load_white_noise, generate_pk_file)
+    parse_nbody_config, gen_white_noise, load_white_noise, generate_pk_file,
+    irfftn_slabs, write_plane_records)
 from .tools_pinocchio import (
     process_snapshot, save_pinocchio_nbody, process_halos, save_cfg_data)
 
@@ -44,37 +45,36 @@ def get_ICs(cfg, outdir):
             path_to_ic = join(cfg.meta.wdir, 'quijote', path_to_ic)
         else:
             path_to_ic = join(cfg.meta.wdir, path_to_ic)
-        ic = load_white_noise(path_to_ic, N, quijote=nbody.quijote)
+        ic = load_white_noise(path_to_ic, N, quijote=nbody.quijote,
+                              mmap=True, shm_cache=nbody.ic_cache)
     else:
         # ic = gen_white_noise(N, seed=nbody.lhid)
         seed = np.random.randint(0, 2**32)
         logging.info(f'Using seed {seed} for simulation {nbody.lhid}')
         nthread, _ = get_mpi_info()
         basedir = os.getcwd()
-        path_to_ic = join(cfg.meta.wdir, f'wn/N{N}/')
-        os.makedirs(path_to_ic, exist_ok=True)
-        path_to_ic = join(path_to_ic, f'wn_{seed}.dat')
-        command = f'mpirun -n 1 {basedir}/quijote_wn/NGenicWhiteNoise/ngenic_white_noise {nbody.N} {nbody.N} {seed} {path_to_ic} {nthread}'
-        logging.info(command)
-        os.system(command)
-        ic = load_white_noise(path_to_ic, N, quijote=True)
-
-    # Convert to real space
-    ic = np.fft.irfftn(ic, norm="ortho").astype(np.float32)
-
-    #  Make header
+        ngenic_exec = join(
+            basedir, 'quijote_wn/NGenicWhiteNoise/ngenic_white_noise')
+        if os.access(ngenic_exec, os.X_OK):
+            path_to_ic = join(cfg.meta.wdir, f'wn/N{N}/')
+            os.makedirs(path_to_ic, exist_ok=True)
+            path_to_ic = join(path_to_ic, f'wn_{seed}.dat')
+            command = f'mpirun -n 1 {ngenic_exec} {nbody.N} {nbody.N} {seed} {path_to_ic} {nthread}'
+            logging.info(command)
+            os.system(command)
+            ic = load_white_noise(path_to_ic, N, quijote=True, mmap=True)
+        else:
+            logging.info(
+                f'{ngenic_exec} not found. Generating white noise in python.')
+            ic = gen_white_noise(N, seed=seed, nthreads=nthread,
+                                 generator=nbody.wn_generator)
+
+    # Make header
     header = np.array([0, N, N, N, nbody.lhid, 0], dtype=np.int32)
 
-    # Write the white noise field to a binary file
+    # Convert to real space and write the white noise field, slab by slab
     filename = join(outdir, "WhiteNoise")
-    with open(filename, 'wb') as file:
-        header.tofile(file)
-        # ic.tofile(file)
-        planesize = N * N * np.dtype(np.float32).itemsize
-        for plane in ic:
-            file.write(np.array([planesize], dtype=np.int32).tobytes())
-            plane.tofile(file)
-            file.write(np.array([planesize], dtype=np.int32).tobytes())
+    write_plane_records(filename, header, irfftn_slabs(ic), (N, N))
 
     return
 
@@ -370,7 +370,7 @@ def delete_files(cfg, outdir):
 
 
 @timing_decorator
-def run_density(cfg, outdir):
+def run_density(cfg, outdir, halo_storage=None):
 
     # Run from output dir
     cwd = os.getcwd()
@@ -397,17 +397,18 @@ def run_density(cfg, outdir):
         else:
             supersampling = None
         z = 1 / cfg.nbody.asave[0] - 1
-        rho, fvel, pos_fname, vel_fname = process_snapshot(
+        rho, fvel, reader = process_snapshot(
             outdir, z, cfg.nbody.L, cfg.nbody.N, cfg.nbody.lhid,
             cfg.nbody.cosmo[0], cfg.nbody.cosmo[2],
             supersampling=supersampling)
-        save_pinocchio_nbody(outdir, rho, fvel, pos_fname, vel_fname, z,
-                             save_particles=cfg.nbody.save_particles)
+        save_pinocchio_nbody(outdir, rho, fvel, reader, z,
+                             save_particles=cfg.nbody.save_particles,
+                             storage=cfg.nbody.storage)
         process_halos(outdir, cfg.nbody.zf, cfg.nbody.L,
-                      cfg.nbody.N, cfg.nbody.lhid)
+                      cfg.nbody.N, cfg.nbody.lhid, storage=halo_storage)
     else:
         ncore = min(max_cores, len(cfg.nbody.asave))
-        save_cfg_data(outdir, cfg)
+        save_cfg_data(outdir, cfg, halo_storage=halo_storage)
         command = f'mpirun -n {ncore} {mpi_args} env PYTHONPATH={cwd} '
         command += 'python -u -m cmass.nbody.tools_pinocchio '
         command += join(outdir, 'snapshot_data.yaml')
@@ -424,6 +425,9 @@ def run_density(cfg, outdir):
 @timing_decorator
 @hydra.main(version_base=None, config_path="../conf", config_name="config")
 def main(cfg: DictConfig) -> None:
+    # halos.h5 storage profile, as in rho_to_halo
+    halo_storage = OmegaConf.select(cfg, 'bias.halo.storage', default=None)
+
     # Filtering for necessary configs
     cfg = OmegaConf.masked_copy(cfg, ['meta', 'nbody', 'multisnapshot'])
 
@@ -452,7 +456,7 @@ def main(cfg: DictConfig) -> None:
     generate_param_file(cfg, outdir)
 
     # Run
-    run_density(cfg, outdir)
+    run_density(cfg, outdir, halo_storage=halo_storage)
     save_cfg(outdir, cfg)
 
     delete_files(cfg, outdir)
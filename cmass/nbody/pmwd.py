@@ -115,7 +115,7 @@ def main(cfg: DictConfig) -> None:
     os.makedirs(outdir, exist_ok=True)
 
     # Get ICs
-    wn = get_ICs(cfg)
+    wn = get_ICs(cfg, mmap=True)
 
     # Run transfer function
     if cfg.nbody.save_transfer:
@@ -154,7 +154,8 @@ def main(cfg: DictConfig) -> None:
     fvel *= (1 + cfg.nbody.zf)
 
     # Save
-    save_nbody(outdir, cfg.nbody.af, rho, fvel, pos, vel)
+    save_nbody(outdir, cfg.nbody.af, rho, fvel, pos, vel,
+               storage=cfg.nbody.storage)
     save_cfg(outdir, cfg)
     logging.info("Done!")
 
@@ -1,10 +1,15 @@
 import os
 from os.path import join
 import logging
+import shutil
+import hashlib
 import numpy as np
+import scipy.fft
 import h5py
-from ..utils import load_params, timing_decorator, get_particle_mass
+from ..utils import (
+    load_params, timing_decorator, get_particle_mass, get_nthreads)
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import MAS_library as MASL
 from omegaconf import open_dict
 
@@ -37,6 +42,10 @@ try:
     import symbolic_pofk.linear
 except ImportError:
     symbolic_pofk = None
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 
 def parse_nbody_config(cfg):
@@ -52,6 +61,18 @@ def parse_nbody_config(cfg):
                 (len(nbody.asave) == 0)):
             nbody.asave = [nbody.af]
 
+        # default nbody.h5 storage profile (contiguous, uncompressed)
+        if 'storage' not in nbody:
+            nbody.storage = None
+
+        # whether to cache white noise files in node-local shared memory
+        if 'ic_cache' not in nbody:
+            nbody.ic_cache = False
+
+        # white noise generator, 'legacy' or 'philox' (see gen_white_noise)
+        if 'wn_generator' not in nbody:
+            nbody.wn_generator = 'legacy'
+
         # load cosmology
         nbody.cosmo = load_params(nbody.lhid, cfg.meta.cosmofile)
 
@@ -62,18 +83,178 @@ def parse_nbody_config(cfg):
     return cfg
 
 
+# white noise generators, see gen_white_noise
+WN_GENERATORS = ('legacy', 'philox')
+
+
 @timing_decorator
-def gen_white_noise(N, seed=None):
-    """Generate ICs in Fourier space."""
-    if seed is not None:
-        np.random.seed(seed)
-    ic = np.fft.rfftn(np.random.randn(N, N, N)) / N ** (1.5)
+def gen_white_noise(N, seed=None, nthreads=None, generator='legacy'):
+    """Generate ICs in Fourier space.
+
+    The 'legacy' generator draws the real-space Gaussian field from the
+    global np.random stream, reproducing existing realizations for a given
+    seed. The 'philox' generator draws it in parallel, plane by plane, with
+    each plane taken from its own counter-based Philox stream keyed on
+    (seed, plane index), and transforms it with a multithreaded FFT. Its
+    output does not depend on the number of threads, but differs from the
+    legacy realization for the same seed.
+
+    Args:
+        N (int): number of grid points per side
+        seed (int, optional): random seed
+        nthreads (int, optional): number of threads of the philox generator.
+            Defaults to OMP_NUM_THREADS or all cores.
+        generator (str, optional): one of WN_GENERATORS
+    """
+    if generator == 'legacy':
+        if seed is not None:
+            np.random.seed(seed)
+        ic = np.fft.rfftn(np.random.randn(N, N, N)) / N ** (1.5)
+        return ic
+    elif generator != 'philox':
+        raise ValueError(
+            f'Unknown white noise generator "{generator}". '
+            f'Choose from {WN_GENERATORS}.')
+
+    nthreads = get_nthreads(nthreads)
+    plane_seeds = np.random.SeedSequence(seed).spawn(N)
+    field = np.empty((N, N, N), dtype=np.float64)
+
+    def fill_plane(i):
+        rng = np.random.Generator(np.random.Philox(plane_seeds[i]))
+        rng.standard_normal(out=field[i])
+
+    with ThreadPoolExecutor(nthreads) as pool:
+        list(pool.map(fill_plane, range(N)))
+
+    ic = scipy.fft.rfftn(field, overwrite_x=True, workers=nthreads)
+    del field
+    ic /= N ** (1.5)
     return ic
 
 
+# node-local shared memory used to cache white noise files
+SHM_DIR = '/dev/shm'
+
+# maximum fraction of the shared memory filesystem used by the cache
+WN_CACHE_FRACTION = 0.5
+
+# white noise memory maps already opened by this process
+_WN_MAPS = {}
+
+
+def _evict_white_noise(wn_dir, nbytes, max_bytes):
+    """Remove least recently used cached files until nbytes more fit.
+
+    Removing a file only unlinks it, so processes still mapping it keep
+    their pages until they unmap it.
+    """
+    entries = []
+    for name in os.listdir(wn_dir):
+        if name.endswith('.tmp'):  # copy in progress
+            continue
+        try:
+            st = os.stat(join(wn_dir, name))
+        except FileNotFoundError:  # removed by another process
+            continue
+        entries.append((st.st_mtime_ns, st.st_size, join(wn_dir, name)))
+    used = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if (used + nbytes <= max_bytes) and \
+                (shutil.disk_usage(wn_dir).free >= 2*nbytes):
+            break
+        logging.info(f'Evicting cached ICs {path}...')
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        used -= size
+
+
+def cache_white_noise(path_to_ic, cache_dir=SHM_DIR):
+    """Copy a white noise file to node-local shared memory, once per node.
+
+    All processes on the node then map the same cached pages, rather than
+    each reading its own copy. The cache holds at most WN_CACHE_FRACTION of
+    the shared memory, evicting the least recently used files first. Falls
+    back to the original file if the cache directory is missing or too
+    small.
+
+    Returns:
+        str: path to the cached file (or the original path)
+    """
+    st = os.stat(path_to_ic)
+    tag = f'{os.path.abspath(path_to_ic)}:{st.st_size}:{st.st_mtime_ns}'
+    wn_dir = join(cache_dir, 'cmass_wn')
+    cached = join(
+        wn_dir,
+        f'{hashlib.md5(tag.encode()).hexdigest()}_'
+        f'{os.path.basename(path_to_ic)}')
+    if os.path.isfile(cached):
+        try:
+            os.utime(cached)  # mark as recently used
+        except FileNotFoundError:  # evicted by another process
+            return cache_white_noise(path_to_ic, cache_dir)
+        return cached
+    if not os.path.isdir(cache_dir):
+        logging.warning(
+            f'Cache directory {cache_dir} not found, mapping ICs from disk.')
+        return path_to_ic
+    max_bytes = WN_CACHE_FRACTION * shutil.disk_usage(cache_dir).total
+    os.makedirs(wn_dir, exist_ok=True)
+    _evict_white_noise(wn_dir, st.st_size, max_bytes)
+    if (st.st_size > max_bytes) or \
+            (shutil.disk_usage(cache_dir).free < 2*st.st_size):
+        logging.warning(
+            f'Not enough space to cache ICs in {cache_dir}, '
+            'mapping from disk.')
+        return path_to_ic
+
+    logging.info(f'Caching ICs to {cached}...')
+    tmpfile = f'{cached}.{os.getpid()}.tmp'
+    shutil.copyfile(path_to_ic, tmpfile)
+    os.replace(tmpfile, cached)  # atomic, so concurrent copies are safe
+    return cached
+
+
+def map_white_noise(path_to_ic, N, quijote=False, shm_cache=False):
+    """Lazily map white noise modes in Fourier space.
+
+    Returns a read-only (N, N, N//2+1) complex128 np.memmap, so that planes
+    are only read from disk when sliced (e.g. wn[start:end] for an MPI
+    slab). Maps are reused within a process.
+
+    Args:
+        path_to_ic (str): path to the wn_*.dat file
+        N (int): number of grid points per side
+        quijote (bool): whether the file has a Quijote (uint32) header
+        shm_cache (bool): whether to map the file from a node-wide copy in
+            shared memory (see cache_white_noise)
+    """
+    if shm_cache:
+        path_to_ic = cache_white_noise(path_to_ic)
+    key = (os.path.abspath(path_to_ic), N, quijote)
+    if key not in _WN_MAPS:
+        logging.info(f"Mapping ICs from {path_to_ic}...")
+        offset = np.dtype(np.uint32).itemsize if quijote else 0
+        _WN_MAPS[key] = np.memmap(
+            path_to_ic, dtype=np.complex128, mode='r', offset=offset,
+            shape=(N, N, N // 2 + 1))
+    return _WN_MAPS[key]
+
+
 @timing_decorator
-def load_white_noise(path_to_ic, N, quijote=False):
-    """Loading in Fourier space."""
+def load_white_noise(path_to_ic, N, quijote=False, mmap=False,
+                     shm_cache=False):
+    """Loading in Fourier space.
+
+    If mmap, returns a lazy read-only memory map (see map_white_noise)
+    instead of reading the full array into memory.
+    """
+    if mmap or shm_cache:
+        modes = map_white_noise(path_to_ic, N, quijote, shm_cache)
+        return modes if mmap else np.array(modes)
+
     logging.info(f"Loading ICs from {path_to_ic}...")
     num_modes_last_d = N // 2 + 1
     with open(path_to_ic, 'rb') as f:
@@ -84,7 +265,12 @@ def load_white_noise(path_to_ic, N, quijote=False):
     return modes
 
 
-def get_ICs(cfg):
+def get_ICs(cfg, mmap=False):
+    """Get the white noise ICs in Fourier space.
+
+    If mmap, ICs loaded from file are returned as a lazy read-only memory
+    map, which callers should slice or copy before modifying.
+    """
     nbody = cfg.nbody
     N = nbody.N*nbody.supersampling
     if nbody.matchIC:
@@ -93,12 +279,98 @@ def get_ICs(cfg):
             path_to_ic = join(cfg.meta.wdir, 'quijote', path_to_ic)
         else:
             path_to_ic = join(cfg.meta.wdir, path_to_ic)
-        return load_white_noise(path_to_ic, N, quijote=nbody.quijote)
+        return load_white_noise(path_to_ic, N, quijote=nbody.quijote,
+                                mmap=mmap, shm_cache=nbody.ic_cache)
     else:
-        return gen_white_noise(N, seed=nbody.lhid)
+        return gen_white_noise(
+            N, seed=nbody.lhid, generator=nbody.wn_generator)
+
+
+WN_SLAB_BYTES = 2**26  # size of real-space slabs streamed to disk
+
+
+def _slab_planes(plane_shape, itemsize=4, nbytes=WN_SLAB_BYTES):
+    """Number of planes in a slab of roughly nbytes."""
+    return max(1, nbytes // (itemsize * int(np.prod(plane_shape))))
 
 
-def save_white_noise_grafic(filename, array, seed):
+def irfftn_slabs(ic, n=None, slab_size=None, nthreads=None):
+    """Stream the inverse FFT of a 3D half-spectrum in slabs along axis 0.
+
+    Computes np.fft.irfftn(ic, norm='ortho').astype(np.float32) without
+    the float64 real-space cube and complex128 temporaries. The first-axis
+    transform is done in column blocks into a complex64 half-spectrum
+    buffer, which is held in full (about the size of the float32 output
+    cube). The remaining two axes are then transformed one slab of planes
+    at a time. As the intermediate is single precision, the output agrees
+    with the float64 transform to a few float32 ulps, not bitwise.
+
+    Args:
+        ic (array): Fourier-space field of shape (N0, N1, N2//2+1). May be
+            a read-only memmap.
+        n (int, optional): real-space length of the last axis. Defaults
+            to 2*(ic.shape[-1]-1).
+        slab_size (int, optional): number of planes per yielded slab.
+        nthreads (int, optional): number of FFT threads.
+
+    Yields:
+        slab (array): float32 array of shape (nplanes, N1, n)
+    """
+    nthreads = get_nthreads(nthreads)
+    N0, N1, Nk = ic.shape
+    n = 2 * (Nk - 1) if n is None else n
+    if slab_size is None:
+        slab_size = _slab_planes((N1, n))
+
+    # transform axis 0, block by block over axis 1
+    buf = np.empty((N0, N1, Nk), dtype=np.complex64)
+    step = _slab_planes((N0, Nk), itemsize=16)
+    for j in range(0, N1, step):
+        buf[:, j:j+step] = scipy.fft.ifft(
+            ic[:, j:j+step], axis=0, norm='ortho', workers=nthreads)
+
+    # transform axes 1 and 2, slab by slab over axis 0
+    for i in range(0, N0, slab_size):
+        slab = scipy.fft.ifft(
+            buf[i:i+slab_size], axis=1, norm='ortho', workers=nthreads)
+        yield scipy.fft.irfft(
+            slab, n=n, axis=2, norm='ortho', workers=nthreads
+        ).astype(np.float32)
+
+
+def plane_record_dtype(plane_shape):
+    """Fortran unformatted record holding one float32 plane."""
+    return np.dtype([('head', np.int32),
+                     ('data', np.float32, tuple(plane_shape)),
+                     ('tail', np.int32)])
+
+
+def write_plane_records(filename, header, slabs, plane_shape):
+    """Write a header and a stream of plane slabs as Fortran records.
+
+    Each slab is framed in a single structured buffer and written with one
+    call, so the cost is dominated by I/O rather than per-plane overhead.
+
+    Args:
+        filename (str): output file
+        header (array): int32 header written verbatim
+        slabs (iterable): arrays of shape (nplanes, *plane_shape)
+        plane_shape (tuple): shape of each plane
+    """
+    rec = plane_record_dtype(plane_shape)
+    block_size = rec['data'].itemsize
+    with open(filename, 'wb') as f:
+        np.asarray(header, dtype=np.int32).tofile(f)
+        for slab in slabs:
+            buf = np.empty(len(slab), dtype=rec)
+            buf['head'] = block_size
+            buf['data'] = slab
+            buf['tail'] = block_size
+            buf.tofile(f)
+
+
+def save_white_noise_grafic(filename, array, seed, fourier=False,
+                            nthreads=None):
     """
     Save a NumPy array to a file in the grafic noise format, required for FastPM
 
@@ -106,26 +378,22 @@ def save_white_noise_grafic(filename, array, seed):
         :param filename: The name of the file to save the array to.
         :param array: The NumPy array to save. It should be 3-dimensional.
         :param seed: The seed value to include in the header.
+        :param fourier: If True, array is the Fourier-space half-spectrum,
+            which is inverse transformed (norm='ortho') slab by slab while
+            writing.
+        :param nthreads: Number of FFT threads, if fourier is True.
     """
     assert array.ndim == 3, "Array must be 3-dimensional"
-    n = array.shape
+    if fourier:
+        n = (*array.shape[:2], 2 * (array.shape[2] - 1))
+        slabs = irfftn_slabs(array, nthreads=nthreads)
+    else:
+        n = array.shape
+        step = _slab_planes(n[1:])
+        slabs = (array[i:i+step] for i in range(0, n[0], step))
 
     header = np.array([16, n[2], n[1], n[0], seed, 16], dtype=np.int32)
-
-    with open(filename, 'wb') as f:
-        f.write(header.tobytes())
-
-        # Writing the array in the required format
-        for i in range(n[0]):
-            block_size = np.array([4 * n[1] * n[2]], dtype=np.int32)
-            f.write(block_size.tobytes())
-
-            # Extract the 2D slice and write it
-            slice_2d = array[i, :, :]
-            f.write(slice_2d.astype(np.float32).tobytes())
-
-            # Write block_size again
-            f.write(block_size.tobytes())
+    write_plane_records(filename, header, slabs, n[1:])
 
     return
 
@@ -140,8 +408,98 @@ def save_transfer(savedir, rho):
         f.create_dataset('rho', data=rho)
 
 
+# Opt-in storage profiles for nbody.h5, giving the on-disk dtype of each
+# dataset. Profiled datasets are chunked by slab and compressed.
+STORAGE_PROFILES = {
+    'compressed': {'rho': 'f4', 'fvel': 'f4', 'ppos': 'f4', 'pvel': 'f4'},
+    'compressed_f16': {'rho': 'f4', 'fvel': 'f2', 'ppos': 'f4', 'pvel': 'f2'},
+}
+
+
+def get_compression():
+    """Fastest available HDF5 compression, as create_dataset kwargs.
+
+    Uses Blosc-LZ4 with byte shuffling if hdf5plugin is installed, otherwise
+    falls back to shuffled gzip.
+    """
+    if hdf5plugin is not None:
+        return 'blosc-lz4', dict(hdf5plugin.Blosc(
+            cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return 'gzip', dict(compression='gzip', compression_opts=1, shuffle=True)
+
+
+def slab_chunks(shape, itemsize, nbytes=2**20):
+    """Chunk shape of whole planes along the first axis (~nbytes each).
+
+    Vector datasets, i.e. (N, N, N, 3) fields or (Npart, 3) particles, keep
+    each component in separate chunks so they can be read independently.
+    """
+    vector = len(shape) in [2, 4]
+    plane = shape[1:-1] if vector else shape[1:]
+    nplane = max(1, nbytes // (itemsize * int(np.prod(plane))))
+    chunks = (min(nplane, shape[0]),) + tuple(plane)
+    if vector:
+        chunks += (1,)
+    return chunks
+
+
+def create_nbody_dataset(group, key, data, storage=None):
+    """Save a dataset to nbody.h5 using the given storage profile.
+
+    The on-disk dtype, source dtype and compression are recorded in the
+    dataset attributes, so that read_nbody_field can decode it.
+    """
+    if storage is None:
+        return group.create_dataset(key, data=data)
+    if storage not in STORAGE_PROFILES:
+        raise ValueError(
+            f'Unknown storage profile "{storage}". '
+            f'Choose from {list(STORAGE_PROFILES)}.')
+
+    data = np.asarray(data)
+    dtype = np.dtype(STORAGE_PROFILES[storage].get(key, data.dtype))
+    compression, kws = get_compression()
+    dset = group.create_dataset(
+        key, data=data.astype(dtype, copy=False),
+        chunks=slab_chunks(data.shape, dtype.itemsize), **kws)
+    dset.attrs['storage'] = storage
+    dset.attrs['source_dtype'] = data.dtype.str
+    dset.attrs['compression'] = compression
+    return dset
+
+
+def read_nbody_field(source_path, a, key, index=Ellipsis, component=None):
+    """Read a dataset, a sub-volume or a single component from nbody.h5.
+
+    Only the chunks overlapping the selection are read and decompressed.
+    Down-cast (float16) datasets are returned as float32.
+
+    Args:
+        source_path (str): directory containing nbody.h5
+        a (float): scale factor of the snapshot
+        key (str): dataset name (rho, fvel, ppos, pvel)
+        index (tuple, optional): selection along the leading axes, e.g.
+            np.s_[:64, :, :] for a slab of planes
+        component (int, optional): for vector datasets (fvel, ppos, pvel),
+            read only this component
+    """
+    with h5py.File(join(source_path, 'nbody.h5'), 'r') as f:
+        dset = f[f'{a:.6f}'][key]
+        if component is not None:
+            if not isinstance(index, tuple):
+                index = (index,)
+            if Ellipsis in index:
+                index = index[:index.index(Ellipsis)]
+            index = index + (slice(None),)*(dset.ndim - 1 - len(index))
+            index = index + (component,)
+        out = dset[index]
+    if out.dtype == np.float16:
+        out = out.astype(np.float32)
+    return out
+
+
 @ timing_decorator
-def save_nbody(savedir, a, rho, fvel, ppos, pvel, mode='w'):
+def save_nbody(savedir, a, rho, fvel, ppos, pvel, mode='w', storage=None):
     os.makedirs(savedir, exist_ok=True)
     savefile = join(savedir, 'nbody.h5')
 
@@ -149,13 +507,15 @@ def save_nbody(savedir, a, rho, fvel, ppos, pvel, mode='w'):
     with h5py.File(savefile, mode) as f:
         key = f'{a:.6f}'
         group = f.create_group(key)
-        group.create_dataset('rho', data=rho)  # density contrast
-        group.create_dataset('fvel', data=fvel)  # velocity field [km/s]
+        # density contrast
+        create_nbody_dataset(group, 'rho', rho, storage)
+        # velocity field [km/s]
+        create_nbody_dataset(group, 'fvel', fvel, storage)
         if (ppos is not None) and (pvel is not None):
             # particle comoving positions [Mpc/h]
-            group.create_dataset('ppos', data=ppos)
+            create_nbody_dataset(group, 'ppos', ppos, storage)
             # particle physical velocities [km/s]
-            group.create_dataset('pvel', data=pvel)
+            create_nbody_dataset(group, 'pvel', pvel, storage)
 
 
 def assign_field(pos, BoxSize, Ngrid, MAS, value=None, verbose=False, chunk_size=-1):
@@ -200,12 +560,307 @@ def assign_field(pos, BoxSize, Ngrid, MAS, value=None, verbose=False, chunk_size
     return delta
 
 
-def rho_and_vfield(ppos, pvel, BoxSize, Ngrid, MAS, omega_m, h, verbose=False, chunk_size=-1):
+# maximum number of particles deposited at once by the fused CIC kernel
+CIC_CHUNK_SIZE = 2**20
+
+
+def cic_stencil(pos, BoxSize, Ngrid):
+    """Flat cell indices and weights of the 8 CIC corners of each particle.
+
+    Reproduces the float32 arithmetic and corner ordering of MAS_library's
+    CIC, so that accumulating the weights in order is bit-identical to
+    MASL.MA(..., MAS='CIC').
+
+    Args:
+        pos (np.array): (N, 3) float32 array of particle positions
+        BoxSize (float): size of the box
+        Ngrid (int): number of grid points
+
+    Returns:
+        cells (np.array): (N, 8) int64 array of flat cell indices
+        weights (np.array): (N, 8) float32 array of CIC weights
+    """
+    # MAS_library expects positions in [0, BoxSize), and its C truncation and
+    # modulo give out-of-range cells for negative positions. Wrap explicitly,
+    # which leaves positions in [0, BoxSize) unchanged
+    pos = np.mod(pos, np.float32(BoxSize))
+    inv_cell_size = np.float32(Ngrid) / np.float32(BoxSize)
+    dist = pos * inv_cell_size
+    index = dist.astype(np.int32)
+    u = dist - index.astype(np.float32)
+    d = np.float32(1) - u
+    index_d = index % Ngrid
+    index_u = (index_d + 1) % Ngrid
+
+    # (N, 2, 3) lower/upper corners along each axis
+    ind = np.stack([index_d, index_u], axis=1).astype(np.int64)
+    wts = np.stack([d, u], axis=1)
+
+    cells = ((ind[:, :, None, None, 0]*Ngrid + ind[:, None, :, None, 1])*Ngrid
+             + ind[:, None, None, :, 2])
+    weights = (wts[:, :, None, None, 0] * wts[:, None, :, None, 1]
+               * wts[:, None, None, :, 2])
+    return cells.reshape(-1, 8), weights.reshape(-1, 8)
+
+
+def _add_at_slabs(grid, cells, values, Nplane, nthreads, pool=None):
+    """Unbuffered in-order addition of values into a flat grid.
+
+    With nthreads > 1, the grid is split into contiguous slabs of planes
+    owned by one thread each. A stable partition of the updates keeps the
+    order of additions into every cell unchanged, so the result does not
+    depend on the number of threads. The partition costs an argsort per
+    chunk, so this only pays off with several free cores.
+    """
+    if (nthreads == 1) or (pool is None):
+        np.add.at(grid, cells, values)
+        return
+
+    # assign every update to the slab owning its destination plane
+    Ngrid = len(grid) // Nplane
+    slab_of_plane = (np.arange(Ngrid) * nthreads // Ngrid).astype(np.uint16)
+    slab = slab_of_plane[cells // Nplane]
+    order = np.argsort(slab, kind='stable')
+    bounds = np.concatenate(
+        [[0], np.cumsum(np.bincount(slab, minlength=nthreads))])
+
+    def add_slab(i):
+        sel = order[bounds[i]:bounds[i+1]]
+        np.add.at(grid, cells[sel], values[sel])
+
+    list(pool.map(add_slab, range(nthreads)))
+
+
+def deposit_cic(count, momentum, pos, vel, BoxSize, nthreads=1, pool=None):
+    """Deposit one chunk of particles onto the count and momentum grids.
+
+    Args:
+        count (np.array): (Ngrid, Ngrid, Ngrid) float32 count grid
+        momentum (np.array): (Ngrid, Ngrid, Ngrid, 3) float32 grid of
+            weighted velocity sums, or None
+        pos (np.array): (N, 3) float32 array of particle positions
+        vel (np.array): (N, 3) float32 array of particle velocities, or None
+        BoxSize (float): size of the box
+        nthreads (int, optional): number of threads owning grid slabs
+        pool (ThreadPoolExecutor, optional): pool with nthreads workers
+    """
+    Ngrid = count.shape[0]
+    cells, weights = cic_stencil(pos, BoxSize, Ngrid)
+
+    _add_at_slabs(count.reshape(-1), cells.ravel(), weights.ravel(),
+                  Ngrid**2, nthreads, pool)
+    if momentum is not None:
+        # interleave the three components of each (cell, corner) update
+        values = weights[..., None] * vel[:, None, :]
+        cells = cells[..., None]*3 + np.arange(3)
+        _add_at_slabs(momentum.reshape(-1), cells.ravel(), values.ravel(),
+                      3*Ngrid**2, nthreads, pool)
+
+
+class ParticleReader:
+    """Chunked, out-of-core reader of particle positions and velocities.
+
+    Wraps in-memory arrays, np.memmap views of binary files, h5py datasets,
+    or a structured chunked store such as bigfile.Dataset, and reads them
+    as float32 chunks without materializing the full particle arrays.
+
+    Args:
+        pos (array-like): (N, 3) positions, or a structured store whose
+            rows contain the pos_key and vel_key fields
+        vel (array-like, optional): (N, 3) velocities, or a list of three
+            (N,) per-component arrays (e.g. h5 datasets)
+        pos_key (str, optional): position field of a structured store
+        vel_key (str, optional): velocity field of a structured store
+        axes (list, optional): permutation of the stored axes applied to
+            each chunk, e.g. [2, 1, 0] to swap x and z
+        BoxSize (float, optional): if given, positions are wrapped
+            periodically into [0, BoxSize) as they are read
+    """
+
+    def __init__(self, pos, vel=None, pos_key=None, vel_key=None,
+                 axes=None, BoxSize=None):
+        self.pos = pos
+        self.vel = vel
+        self.pos_key = pos_key
+        self.vel_key = vel_key
+        self.axes = axes
+        self.BoxSize = BoxSize
+
+    @classmethod
+    def from_bigfile(cls, ds, pos_key='Position', vel_key='Velocity'):
+        """Reader over a bigfile.Dataset, e.g. a FastPM snapshot."""
+        return cls(ds, pos_key=pos_key, vel_key=vel_key)
+
+    @property
+    def has_vel(self):
+        if self.pos_key is not None:
+            return self.vel_key is not None
+        return self.vel is not None
+
+    def __len__(self):
+        if self.pos_key is not None:
+            return self.pos.size
+        return self.pos.shape[0]
+
+    def read(self, start, end):
+        """Read particles [start, end) as float32 (pos, vel) arrays."""
+        if self.pos_key is not None:
+            chunk = self.pos[start:end]
+            pos = chunk[self.pos_key]
+            vel = None if self.vel_key is None else chunk[self.vel_key]
+        else:
+            pos = self.pos[start:end]
+            if self.vel is None:
+                vel = None
+            elif isinstance(self.vel, (list, tuple)):
+                vel = np.stack([x[start:end] for x in self.vel], axis=-1)
+            else:
+                vel = self.vel[start:end]
+        pos = np.asarray(pos).astype(np.float32, copy=False)
+        if vel is not None:
+            vel = np.asarray(vel).astype(np.float32, copy=False)
+        if self.axes is not None:
+            pos = pos[:, self.axes]
+            if vel is not None:
+                vel = vel[:, self.axes]
+        if self.BoxSize is not None:
+            pos = np.mod(pos, self.BoxSize)
+        return pos, vel
+
+    def iter_chunks(self, chunk_size, prefetch=True):
+        """Yield (start, end, pos, vel) chunks in order.
+
+        If prefetch, the next chunk is read in a background thread while
+        the current one is processed, so at most two chunks are in memory.
+        """
+        num_particles = len(self)
+        bounds = [(start, min(start + chunk_size, num_particles))
+                  for start in range(0, num_particles, chunk_size)]
+        if not prefetch:
+            for start, end in bounds:
+                yield (start, end) + self.read(start, end)
+            return
+
+        with ThreadPoolExecutor(1) as reader:
+            future = reader.submit(self.read, *bounds[0]) if bounds else None
+            for i, (start, end) in enumerate(bounds):
+                pos, vel = future.result()
+                if i + 1 < len(bounds):
+                    future = reader.submit(self.read, *bounds[i+1])
+                yield start, end, pos, vel
+
+
+def assign_fields_cic(ppos, pvel, BoxSize, Ngrid, verbose=False,
+                      chunk_size=-1, nthreads=1, prefetch=True):
+    """Fused single-pass CIC assignment of particle counts and velocities.
+
+    Equivalent (bit-for-bit) to calling assign_field with MAS='CIC' once for
+    the counts and once per velocity component, but reads every particle
+    once and computes its CIC stencil once. Particles are streamed in
+    chunks of at most CIC_CHUNK_SIZE, so memory use is bounded by the chunk
+    size. Optionally, the grid is split in slabs across threads.
+
+    Args:
+        ppos (np.array or ParticleReader): (N, 3) array of particle
+            positions, or a ParticleReader (in which case pvel is ignored)
+        pvel (np.array or list): (N, 3) array of particle velocities, or a
+            list of three (N,) arrays (e.g. h5 datasets), or None
+        BoxSize (float): size of the box
+        Ngrid (int): number of grid points
+        verbose (bool, optional): print information on progress
+        chunk_size (int, optional): number of particles to read at once.
+            If -1, use CIC_CHUNK_SIZE.
+        nthreads (int, optional): number of threads owning grid slabs.
+            Defaults to 1 (serial np.add.at). The threaded slab partition is
+            opt-in, as it is only faster with several free cores.
+        prefetch (bool, optional): read the next chunk in the background
+            while depositing the current one
+
+    Returns:
+        count (np.array): (Ngrid, Ngrid, Ngrid) particle count field
+        vel (np.array): (Ngrid, Ngrid, Ngrid, 3) summed velocity field,
+            or None if no velocities are given
+    """
+    nthreads = 1 if nthreads is None else get_nthreads(nthreads)
+    if (chunk_size <= 0) or (chunk_size > CIC_CHUNK_SIZE):
+        chunk_size = CIC_CHUNK_SIZE
+    if isinstance(ppos, ParticleReader):
+        reader = ppos
+    else:
+        reader = ParticleReader(ppos, pvel)
+
+    count = np.zeros((Ngrid,)*3, dtype=np.float32)
+    vel = None
+    if reader.has_vel:
+        vel = np.zeros((Ngrid,)*3 + (3,), dtype=np.float32)
+
+    num_particles = len(reader)
+    with ThreadPoolExecutor(nthreads) as pool:
+        for start, end, pos, v in reader.iter_chunks(chunk_size, prefetch):
+            if verbose:
+                logging.info(f'Depositing particles {start}-{end} '
+                             f'of {num_particles}...')
+            deposit_cic(count, vel, pos, v, BoxSize,
+                        nthreads=nthreads, pool=pool)
+
+    return count, vel
+
+
+def assign_fields_masl(reader, BoxSize, Ngrid, MAS, verbose=False,
+                       chunk_size=-1, prefetch=True):
+    """Chunked MAS_library assignment of particle counts and velocities.
+
+    Each chunk of particles is read once from the ParticleReader, and
+    deposited with MASL.MA for the counts and for each velocity component.
+
+    Args:
+        reader (ParticleReader): particle positions and velocities
+        BoxSize (float): size of the box
+        Ngrid (int): number of grid points
+        MAS (str): mass assignment scheme (NGP, CIC, TSC, PCS)
+        verbose (bool, optional): print information on progress
+        chunk_size (int, optional): number of particles to read at once.
+            If -1, use CIC_CHUNK_SIZE.
+        prefetch (bool, optional): read the next chunk in the background
+            while depositing the current one
+
+    Returns:
+        count (np.array): (Ngrid, Ngrid, Ngrid) particle count field
+        vel (np.array): (Ngrid, Ngrid, Ngrid, 3) summed velocity field,
+            or None if the reader has no velocities
+    """
+    if (chunk_size <= 0) or (chunk_size > CIC_CHUNK_SIZE):
+        chunk_size = CIC_CHUNK_SIZE
+
+    count = np.zeros((Ngrid,)*3, dtype=np.float32)
+    vel = None
+    if reader.has_vel:
+        vel = np.zeros((3,) + (Ngrid,)*3, dtype=np.float32)
+
+    num_particles = len(reader)
+    for start, end, pos, v in reader.iter_chunks(chunk_size, prefetch):
+        if verbose:
+            logging.info(f'Depositing particles {start}-{end} '
+                         f'of {num_particles}...')
+        MASL.MA(pos, count, BoxSize, MAS, W=None, verbose=verbose)
+        if vel is not None:
+            for i in range(3):
+                MASL.MA(pos, vel[i], BoxSize, MAS,
+                        W=np.ascontiguousarray(v[:, i]), verbose=verbose)
+
+    if vel is not None:
+        vel = np.ascontiguousarray(np.moveaxis(vel, 0, -1))
+    return count, vel
+
+
+def rho_and_vfield(ppos, pvel, BoxSize, Ngrid, MAS, omega_m, h, verbose=False,
+                   chunk_size=-1, nthreads=None, prefetch=True):
     """
     Measure the 3D density and velocity field from particles.
 
     Args:
-        ppos (np.array): (N, 3) array of particle positions
+        ppos (np.array): (N, 3) array of particle positions. This can also
+            be a ParticleReader over an out-of-core particle store
         pvel (np.array): (N, 3) array of particle velocities
         BoxSize (float): size of the box
         Ngrid (int): number of grid points
@@ -216,14 +871,36 @@ def rho_and_vfield(ppos, pvel, BoxSize, Ngrid, MAS, omega_m, h, verbose=False, c
         chunk_size (int, optional): if applying assignment to full array, use chunk_size=-1.
             Otherwise, can apply to chunk_size particles at once. Important if pos is a
             h5 dataset.
+        nthreads (int, optional): if given, use the fused NumPy CIC deposit
+            (see assign_fields_cic) with this many threads. Defaults to
+            None, i.e. MAS_library, as the fused deposit has not been shown
+            to be faster.
+        prefetch (bool, optional): for a ParticleReader, overlap reading
+            the next chunk of particles with the deposit of the current one
     """
+    Npart = len(ppos)
+
+    if (MAS == 'CIC') and (nthreads is not None):
+        # Stream particle count and summed velocity fields in a single pass
+        logging.info('Computing density and velocity fields...')
+        count, vel = assign_fields_cic(
+            ppos, pvel, BoxSize, Ngrid, verbose=verbose,
+            chunk_size=chunk_size, nthreads=nthreads, prefetch=prefetch)
+        return _normalize_fields(count, vel, Npart, BoxSize, omega_m, h)
+
+    if isinstance(ppos, ParticleReader):
+        # Read each chunk of particles once, for all fields
+        logging.info('Computing density and velocity fields...')
+        count, vel = assign_fields_masl(
+            ppos, BoxSize, Ngrid, MAS, verbose=verbose,
+            chunk_size=chunk_size, prefetch=prefetch)
+        return _normalize_fields(count, vel, Npart, BoxSize, omega_m, h)
+
     if ppos.dtype != np.float32:
         ppos = ppos.astype(np.float32)
     if isinstance(pvel, np.ndarray) and (pvel.dtype != np.float32):
         pvel = pvel.astype(np.float32)
 
-    Npart = len(ppos)
-
     # Get particle count field
     logging.info('Computing density field...')
     count = assign_field(ppos, BoxSize, Ngrid, MAS,
@@ -248,9 +925,15 @@ def rho_and_vfield(ppos, pvel, BoxSize, Ngrid, MAS, omega_m, h, verbose=False, c
                                   chunk_size=chunk_size)
         vel = np.stack(vel, axis=-1)
 
-    # Normalize
+    return _normalize_fields(count, vel, Npart, BoxSize, omega_m, h)
+
+
+def _normalize_fields(count, vel, Npart, BoxSize, omega_m, h):
+    """Convert count and summed velocity fields to mass and mean velocity."""
     m_particle = get_particle_mass(Npart, BoxSize, omega_m, h)
     rho = count*m_particle
+    if vel is None:
+        return rho, vel
     mask = count > 0
     vel[mask] /= count[mask][..., np.newaxis]
     mask = (count == 0)
@@ -1,11 +1,13 @@
 from os.path import join
 import logging
+import queue
+import threading
 import numpy as np
 import aquila_borg as borg
 from mpi4py import MPI
 import h5py
-from .tools import bin_cube, rho_and_vfield
-from ..utils import timing_decorator
+from .tools import bin_cube, rho_and_vfield, create_nbody_dataset
+from ..utils import timing_decorator, get_available_memory
 
 
 def build_cosmology(omega_m, omega_b, h, n_s, sigma8):
@@ -216,7 +218,33 @@ def gather_MPI(pos, vel):
 
 # Lightcone stuff
 class BorgNotifier:
-    def __init__(self, asave, N, L, omega_m, h, outdir):
+    """BORG PM step notifier saving density and velocity fields at asave.
+
+    Particles are interpolated to each requested scale factor and copied
+    into one of a few reusable float32 buffers. A background thread does
+    the mass assignment and the (compressed) write to nbody.h5, so the
+    integrator only waits when all buffers are in use (back-pressure).
+
+    Args:
+        asave (list): scale factors to save
+        N (int): grid size of the saved fields
+        L (float): box size (Mpc/h)
+        omega_m (float): matter density
+        h (float): Hubble constant
+        outdir (str): output directory
+        storage (str, optional): nbody.h5 storage profile
+        async_save (bool, optional): process snapshots in the background.
+            If False, snapshots are processed inside the step callback.
+        max_pending (int, optional): number of particle buffers, i.e.
+            snapshots in flight. Defaults to what fits in available memory,
+            up to 2.
+        nthreads (int, optional): if given, number of threads of the fused
+            CIC deposit (see rho_and_vfield). Keep it small, as it runs
+            alongside the integrator. Defaults to MAS_library.
+    """
+
+    def __init__(self, asave, N, L, omega_m, h, outdir, storage=None,
+                 async_save=True, max_pending=None, nthreads=None):
         self.step_id = 0
         self.asave = asave
         self.N = N
@@ -224,6 +252,10 @@ class BorgNotifier:
         self.omega_m = omega_m
         self.h = h
         self.outdir = outdir
+        self.storage = storage
+        self.async_save = async_save
+        self.max_pending = max_pending
+        self.nthreads = nthreads
 
         self.outpath = join(outdir, 'nbody.h5')
         logging.info(f"Saving snapshots to {self.outpath}")
@@ -231,11 +263,20 @@ class BorgNotifier:
         with h5py.File(self.outpath, 'a') as f:
             f.attrs['asave'] = asave
 
+        self._free = None  # queue of free particle buffers
+        self._todo = queue.Queue()
+        self._worker = None
+        self._error = None
+
     @staticmethod
-    def interpolate(xi, xf, ai, af, a):
+    def interpolate(xi, xf, ai, af, a, out=None):
         # Linearly interpolate between xi and xf
         # TODO: Replace with Bezier interpolation?
-        return xi + (xf - xi) * (a - ai) / (af - ai)
+        # computed in place in out, without a full-size temporary
+        out = np.subtract(xf, xi, out=out)
+        out *= (a - ai) / (af - ai)
+        out += xi
+        return out
 
     def mass_assignment(self, pos, vel):
         rho, fvel = rho_and_vfield(
@@ -244,7 +285,8 @@ class BorgNotifier:
             BoxSize=self.L,
             MAS='CIC',
             omega_m=self.omega_m,
-            h=self.h
+            h=self.h,
+            nthreads=self.nthreads
         )
 
         # get right units
@@ -256,30 +298,95 @@ class BorgNotifier:
         with h5py.File(self.outpath, 'a') as f:
             key = f'{a:.6f}'
             group = f.create_group(key)
-            group.create_dataset('rho', data=rho)
-            group.create_dataset('fvel', data=fvel)
+            create_nbody_dataset(group, 'rho', rho, self.storage)
+            create_nbody_dataset(group, 'fvel', fvel, self.storage)
+
+    def process(self, a, pos, vel):
+        # mass assignment
+        rho, fvel = self.mass_assignment(pos, vel)
+
+        # convert to overdensity
+        rho /= np.mean(rho)
+        rho -= 1
+
+        # convert comoving to physical velocities
+        fvel /= a
+
+        # save
+        self.save(a, rho, fvel)
+
+    def _get_max_pending(self, nbytes):
+        if self.max_pending is not None:
+            return max(int(self.max_pending), 1)
+        # one buffer in use by the worker, plus its fields
+        per_snapshot = nbytes + 64 * self.N**3
+        mem = get_available_memory()
+        if mem is None:
+            return 1
+        return int(np.clip(mem // per_snapshot, 1, 2))
+
+    def _start(self, pos):
+        shape = (len(pos), 3)
+        nbytes = 2 * 4 * np.prod(shape)
+        nbuf = self._get_max_pending(nbytes)
+        logging.info(f"Using {nbuf} asynchronous snapshot buffers.")
+        self._free = queue.Queue()
+        for _ in range(nbuf):
+            self._free.put((np.empty(shape, dtype=np.float32),
+                            np.empty(shape, dtype=np.float32)))
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            item = self._todo.get()
+            if item is None:
+                return
+            a, buf = item
+            try:
+                if self._error is None:
+                    self.process(a, *buf)
+            except Exception as e:
+                logging.error(f"Failed to save snap a={a:.6f}: {e}")
+                self._error = e
+            finally:
+                self._free.put(buf)
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError(
+                "Asynchronous snapshot saving failed.") from self._error
+
+    def close(self):
+        """Wait for all pending snapshots to be saved."""
+        if self._worker is not None:
+            self._todo.put(None)
+            self._worker.join()
+            self._worker = None
+        self._check()
 
     def __call__(self, a, Np, ids, pos, vel):
+        self._check()
         if self.step_id != 0:
             for af in self.asave:
                 if (af >= self.a0) and (af <= a):
                     logging.info(f"Saving snap a={af:.6f}.")
-                    # interpolate along the trajectory
-                    _pos = self.interpolate(self.pos0, pos, self.a0, a, af)
-                    _vel = self.interpolate(self.vel0, vel, self.a0, a, af)
-
-                    # mass assignment
-                    rho, fvel = self.mass_assignment(_pos, _vel)
-
-                    # convert to overdensity
-                    rho /= np.mean(rho)
-                    rho -= 1
-
-                    # convert comoving to physical velocities
-                    fvel /= af
-
-                    # save
-                    self.save(af, rho, fvel)
+                    if not self.async_save:
+                        # interpolate along the trajectory
+                        _pos = self.interpolate(self.pos0, pos, self.a0, a, af)
+                        _vel = self.interpolate(self.vel0, vel, self.a0, a, af)
+                        self.process(af, _pos, _vel)
+                        continue
+
+                    if self._worker is None:
+                        self._start(pos)
+                    # wait for a free buffer (back-pressure)
+                    _pos, _vel = self._free.get()
+                    self._check()
+                    # interpolate along the trajectory, into the buffer
+                    self.interpolate(self.pos0, pos, self.a0, a, af, out=_pos)
+                    self.interpolate(self.vel0, vel, self.a0, a, af, out=_vel)
+                    self._todo.put((af, (_pos, _vel)))
 
         self.pos0 = pos
         self.vel0 = vel
@@ -1,5 +1,6 @@
 import logging
 import numpy as np
+import pandas as pd
 import h5py
 import os
 import sys
@@ -7,7 +8,7 @@ import yaml
 from os.path import join
 from ..bias.rho_to_halo import save_snapshot
 from .tools import (
-    save_nbody, rho_and_vfield)
+    save_nbody, rho_and_vfield, ParticleReader)
 
 class FlushHandler(logging.StreamHandler):
     def emit(self, record):
@@ -21,7 +22,7 @@ logging.basicConfig(
     handlers=[FlushHandler()]
 )
 
-def save_cfg_data(outdir, cfg):
+def save_cfg_data(outdir, cfg, halo_storage=None):
 
     filename = join(outdir, 'snapshot_data.yaml')
 
@@ -38,7 +39,9 @@ def save_cfg_data(outdir, cfg):
             'omega_m':cfg.nbody.cosmo[0], 
             'h':cfg.nbody.cosmo[2],
             'supersampling':supersampling,
-            'save_particles':cfg.nbody.save_particles
+            'save_particles':cfg.nbody.save_particles,
+            'storage':cfg.nbody.storage,
+            'halo_storage':halo_storage
             }
 
     with open(filename, 'w') as f:
@@ -47,19 +50,55 @@ def save_cfg_data(outdir, cfg):
     return
 
 
-def process_snapshot(outdir, z, L, N, lhid, omega_m, h, supersampling=None):
-
-    # Load the data
-    filename = join(
-        outdir,
-        f'pinocchio.{z:.4f}.pinocchio-L{L}-'
-        f'N{N}-{lhid}.snapshot.out')
-    data = {}
+# Gadget format 2 snapshot header, preceded by the size records of its block
+SNAPSHOT_HEADER_DTYPE = np.dtype([
+    ('dummy', np.int64),
+    ('NPart', np.uint32, 6),
+    ('Mass', np.float64, 6),
+    ('Time', np.float64),
+    ('RedShift', np.float64),
+    ('flag_sfr', np.int32),
+    ('flag_feedback', np.int32),
+    ('NPartTotal', np.uint32, 6),
+    ('flag_cooling', np.int32),
+    ('num_files', np.int32),
+    ('BoxSize', np.float64),
+    ('Omega0', np.float64),
+    ('OmegaLambda', np.float64),
+    ('HubbleParam', np.float64),
+    ('flag_stellarage', np.int32),
+    ('flag_metals', np.int32),
+    ('npartTotalHighWord', np.uint32, 6),
+    ('flag_entropy_instead_u', np.int32),
+    ('flag_metalcooling', np.int32),
+    ('flag_stellarevolution', np.int32),
+    ('fill', np.int8, 52)
+])
+
+
+def read_snapshot(filename, L):
+    """Parse a Pinocchio snapshot without loading the particles.
+
+    The block headers are read once, and the POS and VEL blocks are exposed
+    as zero-copy np.memmap views at their byte offsets. The x <-> z axis
+    swap and the periodic wrap of positions are applied lazily, chunk by
+    chunk, by the returned ParticleReader.
+
+    Args:
+        filename (str): path to the pinocchio.*.snapshot.out file
+        L (float): box size (Mpc/h)
+
+    Returns:
+        header (dict): snapshot header
+        reader (ParticleReader): reader over particle positions and
+            velocities
+    """
+    offsets = {}
 
     with open(filename, 'rb') as f:
 
-        # Function to read a block
-        def read_block(expected_name, dtype, count):
+        # Function to read a block name
+        def read_block_name(expected_name):
             _ = np.fromfile(
                 f, dtype=np.int32, count=1)[0]  # not used
             block_name = np.fromfile(f, dtype='S4', count=1)[
@@ -70,136 +109,29 @@ def process_snapshot(outdir, z, L, N, lhid, omega_m, h, supersampling=None):
                 raise ValueError(
                     f"Expected block name '{expected_name}', "
                     f"but got '{block_name}'")
+
+        # Function to read a block
+        def read_block(expected_name, dtype, count):
+            read_block_name(expected_name)
             data_block = np.fromfile(f, dtype=dtype, count=count)
             _ = np.fromfile(
                 f, dtype=np.int32, count=1)[0]  # not used
             return data_block
 
-
-        # Function to read a large block
-        def read_large_block(expected_name, dummy_dtype, data_dtype, num_particles, chunk_size = 900000):
-
-            # Save to file to prevent storing too much in memory
-            out_filename = join(
-                outdir, f'pinocchio.{z:.4f}.pinocchio-L{L}-'
-                f'N{N}-{lhid}.particle_{expected_name}.h5')
-
-            def write_initial_chunk(data_chunk):
-                if expected_name == 'ID':
-                    shape=(num_particles,)
-                    maxshape=(num_particles,)
-                elif expected_name == 'VEL':
-                    shape=(num_particles//3,)
-                    maxshape=(num_particles//3,)
-                else:
-                    shape=(num_particles//3,)+data_chunk.shape[1:]
-                    maxshape=(num_particles//3,)+data_chunk.shape[1:]
-
-                with h5py.File(out_filename, 'w') as fout:
-                    if expected_name == 'VEL':
-                        for i, suffix in enumerate(['X', 'Y', 'Z']):
-                            dset = fout.create_dataset(
-                                expected_name + suffix,
-                                shape=shape,
-                                maxshape=maxshape,  # Preallocate space for the number of particles
-                                chunks=True,
-                                dtype=data_chunk.dtype
-                            )
-                            dset[:data_chunk.shape[0]] = data_chunk[:, i]
-                    else:
-                        dset = fout.create_dataset(
-                            expected_name,
-                            shape=shape,
-                            maxshape=maxshape,  # Preallocate space for the number of particles
-                            chunks=True,
-                            dtype=data_chunk.dtype
-                        )
-                        dset[:data_chunk.shape[0]] = data_chunk
-
-
-            def append_chunk(new_chunk):
-                with h5py.File(out_filename, 'a') as fout:
-                    if expected_name == 'VEL':
-                        for i, suffix in enumerate(['X', 'Y', 'Z']):
-                            dset = fout[expected_name+suffix]
-                            dset[total_read//3:total_read//3+new_chunk.shape[0]] = new_chunk[:,i]
-                    elif expected_name == 'ID':
-                        dset = fout[expected_name]
-                        dset[total_read:total_read+new_chunk.shape[0]] = new_chunk
-                    else:
-                        dset = fout[expected_name]
-                        dset[total_read//3:total_read//3+new_chunk.shape[0]] = new_chunk
-
-            _ = np.fromfile(
-                f, dtype=np.int32, count=1)[0]  # not used
-            block_name = np.fromfile(f, dtype='S4', count=1)[
-                0].decode().strip()
-            _ = np.fromfile(
-                f, dtype=np.int32, count=1)[0]  # not used
-            if block_name != expected_name:
-                raise ValueError(
-                    f"Expected block name '{expected_name}', "
-                    f"but got '{block_name}'")
-
-            _ = np.fromfile(f, dtype=dummy_dtype, count=1)[0]
-
-            assert chunk_size % 3 == 0, f"{chunk_size} is not divisible by 3"
-            total_read = 0
-
-            while total_read < num_particles:
-                count = min(chunk_size, num_particles - total_read)
-                data = np.fromfile(f, dtype=data_dtype, count=count)
-
-                if expected_name in ['POS', 'VEL']:
-                    data = data.reshape(-1,3)
-                    data[:, [0, 1, 2]] = data[:, [2, 1, 0]]
-
-                # Periodic boundary conditions
-                if expected_name == 'POS':
-                    data = np.mod(data, L)
-
-                if total_read == 0:
-                    write_initial_chunk(data)
-                else:
-                    append_chunk(data)
-
-                total_read += count
-
-            _ = np.fromfile(
-                f, dtype=np.int32, count=1)[0]  # not used
-
-            return out_filename
+        # Function to locate a large block, and skip over it
+        def skip_large_block(expected_name, data_dtype, count):
+            read_block_name(expected_name)
+            _ = np.fromfile(f, dtype=np.int64, count=1)[0]  # not used
+            offsets[expected_name] = f.tell()
+            f.seek(count * np.dtype(data_dtype).itemsize + 4, os.SEEK_CUR)
 
         # Read the HEADER block
-        header_dtype = np.dtype([
-            ('dummy', np.int64),
-            ('NPart', np.uint32, 6),
-            ('Mass', np.float64, 6),
-            ('Time', np.float64),
-            ('RedShift', np.float64),
-            ('flag_sfr', np.int32),
-            ('flag_feedback', np.int32),
-            ('NPartTotal', np.uint32, 6),
-            ('flag_cooling', np.int32),
-            ('num_files', np.int32),
-            ('BoxSize', np.float64),
-            ('Omega0', np.float64),
-            ('OmegaLambda', np.float64),
-            ('HubbleParam', np.float64),
-            ('flag_stellarage', np.int32),
-            ('flag_metals', np.int32),
-            ('npartTotalHighWord', np.uint32, 6),
-            ('flag_entropy_instead_u', np.int32),
-            ('flag_metalcooling', np.int32),
-            ('flag_stellarevolution', np.int32),
-            ('fill', np.int8, 52)
-        ])
-        header_block = read_block('HEAD', header_dtype, 1)[0]
-        data['header'] = {name: header_block[name]
-                          for name in header_dtype.names}
+        header_block = read_block('HEAD', SNAPSHOT_HEADER_DTYPE, 1)[0]
+        header = {name: header_block[name]
+                  for name in SNAPSHOT_HEADER_DTYPE.names}
 
         # Number of particles
-        num_particles = header_block['NPart'][1]
+        num_particles = int(header_block['NPart'][1])
 
         # Read INFO block
         info_dtype = np.dtype(
@@ -215,23 +147,28 @@ def process_snapshot(outdir, z, L, N, lhid, omega_m, h, supersampling=None):
         rmax_dtype = np.dtype([('dummy', np.int64), ('rmax', np.int64)])
         read_block('RMAX', rmax_dtype, 2)
 
-        # Read ID block in chunks (otherwise can be too much memory)
-        logging.info("Reading particle IDs...")
-        read_large_block('ID', np.int64, np.uint32, num_particles,)
+        # Locate particle blocks
+        skip_large_block('ID', np.uint32, num_particles)
+        skip_large_block('POS', np.float32, num_particles*3)
+        skip_large_block('VEL', np.float32, num_particles*3)
+
+    pos, vel = [
+        np.memmap(filename, dtype=np.float32, mode='r',
+                  offset=offsets[name], shape=(num_particles, 3))
+        for name in ['POS', 'VEL']]
+    reader = ParticleReader(pos, vel, axes=[2, 1, 0], BoxSize=L)
+    return header, reader
 
-        # Read POS block and save to file to reduce memory allocated
-        logging.info("Reading particle positions...")
-        pos_fname = read_large_block('POS', np.int64, np.float32, num_particles*3)
 
-        # Read VEL block and save to file to reduce memory allocated
-        logging.info("Reading particle velocities...")
-        vel_fname  = read_large_block('VEL', np.int64, np.float32, num_particles*3)
+def process_snapshot(outdir, z, L, N, lhid, omega_m, h, supersampling=None):
 
-    # Acces pos and vel with memory mapping
-    posfile = h5py.File(pos_fname, 'r')
-    velfile = h5py.File(vel_fname, 'r')
-    pos = posfile['POS']
-    vel = [velfile['VELX'], velfile['VELY'], velfile['VELZ']]
+    # Map the particle data
+    filename = join(
+        outdir,
+        f'pinocchio.{z:.4f}.pinocchio-L{L}-'
+        f'N{N}-{lhid}.snapshot.out')
+    logging.info("Reading snapshot headers...")
+    _, reader = read_snapshot(filename, L)
 
     # Calculate velocity field
     if supersampling is None:
@@ -240,23 +177,17 @@ def process_snapshot(outdir, z, L, N, lhid, omega_m, h, supersampling=None):
         Ngrid = N // supersampling
     logging.info(f'Running field construction on grid {Ngrid}...')
     rho, fvel = rho_and_vfield(
-        pos, vel, L, Ngrid, 'CIC',
-        omega_m=omega_m, h=h,
-        chunk_size = 512**3)
+        reader, None, L, Ngrid, 'CIC',
+        omega_m=omega_m, h=h)
 
-    posfile.close()
-    velfile.close()
+    return rho, fvel, reader
 
-    return rho, fvel, pos_fname, vel_fname
 
-
-def save_pinocchio_nbody(outdir, rho, fvel, pos_fname, vel_fname, z, save_particles=False):
+def save_pinocchio_nbody(outdir, rho, fvel, reader, z, save_particles=False,
+                         storage=None):
 
     if save_particles:
-        posfile = h5py.File(pos_fname, 'r')
-        velfile = h5py.File(vel_fname, 'r')
-        pos = posfile['POS']
-        vel = [velfile['VELX'], velfile['VELY'], velfile['VELZ']]
+        pos, vel = reader.read(0, len(reader))
     else:
         pos, vel = None, None
 
@@ -265,45 +196,89 @@ def save_pinocchio_nbody(outdir, rho, fvel, pos_fname, vel_fname, z, save_partic
 
     # Save nbody-type outputs
     af = 1 / (1 + z)
-    save_nbody(outdir, af, rho, fvel, pos, vel, mode='a')
+    save_nbody(outdir, af, rho, fvel, pos, vel, mode='a', storage=storage)
 
-    if save_particles:
-        posfile.close()
-        velfile.close()
+    return
 
-    # Delete temporary position and velocity files
-    for fname in [pos_fname, vel_fname]:
-        os.remove(fname)
 
-    return
+# Columns of the halo catalog
+#    0) group ID
+#    1) group mass (Msun/h)
+# 2- 4) initial position (Mpc/h)
+# 5- 7) final position (Mpc/h)
+# 8-10) velocity (km/s)
+#   11) number of particles
+# Positions and velocities are stored z, y, x
+CATALOG_COLUMNS = {'mass': [1], 'pos': [7, 6, 5], 'vel': [10, 9, 8]}
+
+
+def load_catalog(filename, cache=True):
+    """Load the halo mass, position and velocity columns of a catalog.
+
+    The ASCII catalog is parsed once, reading only the needed columns with
+    the pandas C engine. The result is cached in a binary columnar file
+    (filename + '.h5'), which is reused while it is newer than the source.
+
+    Args:
+        filename (str): path to the pinocchio.*.catalog.out file
+        cache (bool, optional): read and write the binary cache
+
+    Returns:
+        columns (dict): 'mass' (Nh,), 'pos' (Nh, 3) and 'vel' (Nh, 3)
+    """
+    cachefile = filename + '.h5'
+    if (cache and os.path.isfile(cachefile) and
+            os.path.getmtime(cachefile) >= os.path.getmtime(filename)):
+        logging.info(f'Loading cached catalog {cachefile}...')
+        with h5py.File(cachefile, 'r') as f:
+            return {key: f[key][...] for key in CATALOG_COLUMNS}
+
+    usecols = sorted(sum(CATALOG_COLUMNS.values(), []))
+    table = pd.read_csv(
+        filename, sep=r'\s+', comment='#', header=None,
+        usecols=usecols, dtype=np.float64, engine='c')
+    columns = {key: table[cols].to_numpy()
+               for key, cols in CATALOG_COLUMNS.items()}
+    columns['mass'] = columns['mass'][:, 0]
 
+    if cache:
+        tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+        with h5py.File(tmpfile, 'w') as f:
+            for key, val in columns.items():
+                f.create_dataset(key, data=val)
+        os.replace(tmpfile, cachefile)
 
+    return columns
 
-def process_halos(outdir, z, L, N, lhid):
+
+def load_halos(outdir, z, L, N, lhid):
 
     # Load halo data
-    #    0) group ID
-    #    1) group mass (Msun/h)
-    # 2- 4) initial position (Mpc/h)
-    # 5- 7) final position (Mpc/h)
-    # 8-10) velocity (km/s)
-    #   11) number of particles
     halo_filename = join(
         outdir, f'pinocchio.{z:.4f}.pinocchio-L{L}-'
                 f'N{N}-{lhid}.catalog.out')
-    hmass = np.log10(np.loadtxt(halo_filename, unpack=False, usecols=(1,)))
-    hpos = np.loadtxt(halo_filename, unpack=False, usecols=(7, 6, 5))
-    hvel = np.loadtxt(halo_filename, unpack=False, usecols=(10, 9, 8))
+    columns = load_catalog(halo_filename)
+    hmass = np.log10(columns['mass'])
+    return columns['pos'], columns['vel'], hmass
+
+
+def save_halos(outdir, z, hpos, hvel, hmass, storage=None, L=None):
 
     # Save bias-type outputs
     af = 1 / (1 + z)
     outpath = join(outdir, 'halos.h5')
     logging.info('Saving cube to ' + outpath)
-    save_snapshot(outdir, af, hpos, hvel, hmass)
+    save_snapshot(outdir, af, hpos, hvel, hmass, storage=storage, L=L)
 
     return
 
 
+def process_halos(outdir, z, L, N, lhid, storage=None):
+    save_halos(outdir, z, *load_halos(outdir, z, L, N, lhid),
+               storage=storage, L=L)
+    return
+
+
 def main():
 
     from mpi4py import MPI
@@ -331,6 +306,8 @@ def main():
     h = data['h']
     supersampling = data['supersampling']
     save_particles = data['save_particles']
+    storage = data.get('storage')
+    halo_storage = data.get('halo_storage')
 
     # Delete output files if they already exists
     for fname in ['halos.h5', 'nbody.h5']:
@@ -344,20 +321,22 @@ def main():
         if i < len(asave):
             a = asave[i]
             z = 1 / a - 1
-            rho, fvel, pos_fname, vel_fname =  process_snapshot(
+            rho, fvel, reader = process_snapshot(
                 outdir, z, L, N, lhid, omega_m, h, 
                 supersampling=supersampling)
+
+            # Process halos
+            halos = load_halos(outdir, z, L, N, lhid)
         comm.Barrier()
 
         # Print results rank-by-rank to avoid simultaneous
         # writing to the same file
-        # Also process halos
         for r in range(size):
             if (r == rank) and (i < len(asave)):
                 logging.info(f'Outputting results for a = {a:.6f}')
-                save_pinocchio_nbody(outdir, rho, fvel, pos_fname, vel_fname, z, 
-                    save_particles=save_particles)
-                process_halos(outdir, z, L, N, lhid)
+                save_pinocchio_nbody(outdir, rho, fvel, reader, z,
+                    save_particles=save_particles, storage=storage)
+                save_halos(outdir, z, *halos, storage=halo_storage, L=L)
             comm.Barrier()
 
         logging.info(f'Completed a = {a}')
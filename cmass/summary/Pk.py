@@ -45,8 +45,8 @@ def compute_Pk(
     cosmo = cosmo_to_astropy(cosmo)
 
     # convert ra, dec, z to cartesian coordinates
-    gpos = sky_to_xyz(grdz, cosmo)
-    rpos = sky_to_xyz(rrdz, cosmo)
+    gpos = sky_to_xyz(grdz, cosmo, dtype=np.float32)
+    rpos = sky_to_xyz(rrdz, cosmo, dtype=np.float32)
 
     # note: FKP weights are automatically included in CatalogFFTPower
 
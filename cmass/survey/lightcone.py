@@ -35,6 +35,7 @@ from omegaconf import DictConfig, OmegaConf
 from ..utils import get_source_path, timing_decorator, save_cfg
 from ..nbody.tools import parse_nbody_config
 from .tools import save_lightcone, load_galaxies
+from ..bias.tools.catalog import read_catalog_dataset
 try:
     from ..lightcone import lc
 except ImportError:
@@ -47,7 +48,7 @@ def load_halo_velocities(source_dir, a):
     filepath = join(source_dir, 'halos.h5')
     with h5py.File(filepath, 'r') as f:
         key = f'{a:.6f}'
-        vel = f[key]['vel'][...]
+        vel = read_catalog_dataset(f[key]['vel'])
     return vel
 
 
@@ -75,8 +75,9 @@ def main(cfg: DictConfig) -> None:
     pos, vel = random_rotate_translate(
         pos, L=cfg.nbody.L, vel=vel, seed=aug_seed)
 
-    # Calculate sky coordinates
-    rdz = xyz_to_sky(pos, vel, cfg.nbody.cosmo)
+    # Calculate sky coordinates in float64, in place if pos is float64
+    rdz = xyz_to_sky(pos, vel, cfg.nbody.cosmo, dtype=np.float64,
+                     out=pos if pos.dtype == np.float64 else None)
 
     # Custom cuts
     rdz = custom_cuts(rdz, cfg)
@@ -194,8 +194,9 @@ def main(cfg: DictConfig) -> None:
     pos, vel = move_to_footprint(
         pos, vel, cfg.survey.mid_rdz, cfg.nbody.cosmo, cfg.nbody.L)
 
-    # Calculate sky coordinates
-    rdz = xyz_to_sky(pos, vel, cfg.nbody.cosmo)
+    # Calculate sky coordinates in float64, in place if pos is float64
+    rdz = xyz_to_sky(pos, vel, cfg.nbody.cosmo, dtype=np.float64,
+                     out=pos if pos.dtype == np.float64 else None)
 
     # Apply mask
     rdz = apply_mask(rdz, cfg.meta.wdir, is_North, cfg.survey.fibermode)
@@ -11,76 +11,174 @@ import pandas as pd
 from copy import deepcopy
 import logging
 import h5py
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 from astropy.io import fits
 from astropy.coordinates import search_around_sky
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 from astropy.constants import c
-from scipy.interpolate import interp1d
+from astropy.cosmology import Cosmology
+from scipy.interpolate import InterpolatedUnivariateSpline as IUS
 from scipy.spatial.transform import Rotation as R
 
-from ..utils import timing_decorator, cosmo_to_astropy
+from ..utils import timing_decorator, cosmo_to_astropy, get_nthreads
+from ..bias.tools.catalog import read_catalog_dataset
 
 
 # cosmo functions
 
 
-def xyz_to_sky(pos, vel=None, cosmo=None):
+# Redshift grid of the astropy comoving distances, and size of the uniform
+# lookup tables interpolated from them
+ZGRID = np.concatenate([[0.], np.logspace(-8, 1.5, 2048)])
+DISTANCE_TABLE_SIZE = 2**16
+
+# Number of points per thread task of the coordinate transforms
+COORD_CHUNK_SIZE = 2**16
+
+
+@lru_cache(maxsize=16)
+def _comoving_distance_tables(cosmo):
+    # cosmo is a tuple of parameters, or an astropy cosmology in yaml
+    if isinstance(cosmo, str):
+        cosmo = Cosmology.from_format(cosmo, format='yaml')
+    else:
+        cosmo = cosmo_to_astropy(cosmo)
+    chi = cosmo.comoving_distance(ZGRID).value * cosmo.h  # Mpc/h
+    zgrid = np.linspace(0, ZGRID[-1], DISTANCE_TABLE_SIZE)
+    chigrid = np.linspace(0, chi[-1], DISTANCE_TABLE_SIZE)
+    return (zgrid, IUS(ZGRID, chi)(zgrid)), (chigrid, IUS(chi, ZGRID)(chigrid))
+
+
+def comoving_distance_tables(cosmo):
+    """Lookup tables of the comoving distance chi(z) in Mpc/h and of its
+    inverse z(chi), cached on the cosmological parameters.
+
+    Cubic splines of the astropy comoving distance, tabulated on uniform
+    grids so that lookups need no search (see interp_uniform).
+
+    Args:
+        cosmo (array or astropy.cosmology.Cosmology): Cosmological
+            parameters [Omega_m, Omega_b, h, n_s, sigma8], or cosmology.
+
+    Returns:
+        chi_of_z (tuple): uniform redshift grid, and chi on it
+        z_of_chi (tuple): uniform chi grid, and redshifts on it
+    """
+    if isinstance(cosmo, Cosmology):
+        return _comoving_distance_tables(cosmo.to_format('yaml'))
+    return _comoving_distance_tables(tuple(float(p) for p in cosmo))
+
+
+def interp_uniform(q, grid, table):
+    """Linear interpolation in a table on a uniform grid.
+
+    Raises a ValueError if q is outside of the grid, as interp1d did.
+    NaNs are propagated.
+    """
+    with np.errstate(invalid='ignore'):
+        if np.any(q < grid[0]) or np.any(q > grid[-1]):
+            raise ValueError(
+                f'Values outside of the interpolation range [{grid[0]}, '
+                f'{grid[-1]}]: [{np.nanmin(q)}, {np.nanmax(q)}].')
+    t = np.clip((q - grid[0]) / (grid[1] - grid[0]), 0, len(grid) - 1)
+    with np.errstate(invalid='ignore'):  # nan propagates through t
+        i = np.clip(t.astype(np.int64), 0, len(grid) - 2)
+    return table[i] + (t - i) * (table[i + 1] - table[i])
+
+
+def xyz_to_sky(pos, vel=None, cosmo=None, dtype=np.float64, out=None,
+               nthreads=None):
     """Converts cartesian coordinates to sky coordinates (ra, dec, z).
     Inspired by nbodykit.transform.CartesianToSky.
+
+    Points are converted in chunks of COORD_CHUNK_SIZE, in parallel.
+
+    Args:
+        pos (array): (N, 3) comoving positions in Mpc/h.
+        vel (array, optional): (N, 3) peculiar velocities in km/s.
+        cosmo (array or astropy.cosmology.Cosmology): Cosmological
+            parameters [Omega_m, Omega_b, h, n_s, sigma8], or cosmology.
+        dtype (np.dtype, optional): Output dtype, if out is not given.
+        out (array, optional): (N, 3) output array. May be pos itself,
+            to convert in place.
+        nthreads (int, optional): Number of threads. Defaults to all cores.
+
+    Returns:
+        rdz (array): (N, 3) right ascension [deg], declination [deg] and
+            redshift.
     """
-    if vel is None:
-        vel = np.zeros_like(pos)  # no peculiar velocity
     if cosmo is None:
         raise ValueError('cosmo must be provided.')
+    pos = np.atleast_2d(pos)  # ensure 2D arrays
+    vel = None if vel is None else np.atleast_2d(vel)
+    if out is None:
+        out = np.empty(pos.shape, dtype=dtype)
+    _, z_of_chi = comoving_distance_tables(cosmo)
+    ckms = c.to(u.km/u.s).value
 
-    pos, vel = map(deepcopy, [pos, vel])  # avoid modifying input
-    pos, vel = map(np.atleast_2d, [pos, vel])  # ensure 2D arrays
-    cosmo = cosmo_to_astropy(cosmo)
-
-    pos /= cosmo.h  # convert from Mpc/h to Mpc
-    pos *= u.Mpc  # label as Mpc
-    vel *= u.km / u.s  # label as km/s
+    def convert(start):
+        sl = slice(start, start + COORD_CHUNK_SIZE)
+        x, y, zc = pos[sl].astype(np.float64).T  # copy, before writing out
+        rxy = np.hypot(x, y)
+        R = np.hypot(rxy, zc)
+        ra = np.degrees(np.arctan2(y, x)) % 360
+        dec = np.degrees(np.arctan2(zc, rxy))
 
-    # get ra, dec
-    coord_cart = SkyCoord(
-        x=pos[:, 0], y=pos[:, 1], z=pos[:, 2],
-        representation_type='cartesian')
-    coord_sphe = coord_cart.represent_as('spherical')
-    ra = coord_sphe.lon.to(u.deg)
-    dec = coord_sphe.lat.to(u.deg)
+        # convert comoving distance to redshift, and add peculiar velocity
+        z = interp_uniform(R, *z_of_chi)
+        if vel is not None:
+            vx, vy, vz = vel[sl].astype(np.float64).T
+            vpec = (x*vx + y*vy + zc*vz) / R
+            z += vpec / ckms * (1 + z)
 
-    # get redshift
-    R = np.linalg.norm(pos, axis=-1)
+        out[sl, 0], out[sl, 1], out[sl, 2] = ra, dec, z
 
-    def z_from_comoving_distance(d):
-        zgrid = np.logspace(-8, 1.5, 2048)
-        zgrid = np.concatenate([[0.], zgrid])
-        dgrid = cosmo.comoving_distance(zgrid)
-        return interp1d(dgrid, zgrid)(d)
+    with ThreadPoolExecutor(get_nthreads(nthreads)) as pool:
+        list(pool.map(convert, range(0, len(pos), COORD_CHUNK_SIZE)))
+    return out
 
-    # Convert comoving distance to redshift
-    z = z_from_comoving_distance(R)
 
-    vpec = (pos*vel).sum(axis=-1) / R
-    z += vpec / c.to(u.km/u.s)*(1+z)
+def sky_to_xyz(rdz, cosmo, dtype=np.float64, out=None, nthreads=None):
+    """Converts sky coordinates (ra, dec, z) to cartesian coordinates.
 
-    return np.array([ra, dec, z]).T
+    Points are converted in chunks of COORD_CHUNK_SIZE, in parallel.
 
+    Args:
+        rdz (array): (N, 3) or (3,) right ascension [deg], declination [deg]
+            and redshift.
+        cosmo (array or astropy.cosmology.Cosmology): Cosmological
+            parameters [Omega_m, Omega_b, h, n_s, sigma8], or cosmology.
+        dtype (np.dtype, optional): Output dtype, if out is not given.
+        out (array, optional): (N, 3) output array. May be rdz itself,
+            to convert in place.
+        nthreads (int, optional): Number of threads. Defaults to all cores.
 
-def sky_to_xyz(rdz, cosmo):
-    """Converts sky coordinates (ra, dec, z) to cartesian coordinates."""
+    Returns:
+        pos (array): (N, 3) or (3,) comoving positions in Mpc/h.
+    """
     rdz = np.asarray(rdz)
-    cosmo = cosmo_to_astropy(cosmo)
-
-    ra, dec, z = rdz.T
-    pos = SkyCoord(ra=ra*u.deg, dec=dec*u.deg,
-                   distance=cosmo.comoving_distance(z))
-    pos = pos.cartesian.xyz
-    pos *= cosmo.h  # convert from Mpc to Mpc/h
-
-    return pos.value.T
+    single = rdz.ndim == 1
+    rdz = np.atleast_2d(rdz)
+    if out is None:
+        out = np.empty(rdz.shape, dtype=dtype)
+    chi_of_z, _ = comoving_distance_tables(cosmo)
+
+    def convert(start):
+        sl = slice(start, start + COORD_CHUNK_SIZE)
+        ra, dec, z = rdz[sl].astype(np.float64).T  # copy, before writing out
+        ra, dec = np.radians(ra), np.radians(dec)
+        chi = interp_uniform(z, *chi_of_z)
+        cos_dec = np.cos(dec)
+        out[sl, 0] = chi * cos_dec * np.cos(ra)
+        out[sl, 1] = chi * cos_dec * np.sin(ra)
+        out[sl, 2] = chi * np.sin(dec)
+
+    with ThreadPoolExecutor(get_nthreads(nthreads)) as pool:
+        list(pool.map(convert, range(0, len(rdz), COORD_CHUNK_SIZE)))
+    return out[0] if single else out
 
 # Geometry functions
 
@@ -302,9 +400,11 @@ def load_galaxies(source_dir, a, seed):
                 f'Snapshot a={key} not found in {filepath}. Ensure you are '
                 'using the appropriate single-snapshot ngc_selection or the '
                 'multi-snapshot ngc_lightcone.')
-        pos = f[key]['pos'][...]  # comoving positions [Mpc/h]
-        vel = f[key]['vel'][...]  # physical velocities [km/s]
-        hostid = f[key]['hostid'][...]
+        # comoving positions [Mpc/h]
+        pos = read_catalog_dataset(f[key]['pos'])
+        # physical velocities [km/s]
+        vel = read_catalog_dataset(f[key]['vel'])
+        hostid = read_catalog_dataset(f[key]['hostid'])
     return pos, vel, hostid
 
 
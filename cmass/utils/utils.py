@@ -40,6 +40,31 @@ def timing_decorator(func, *args, **kwargs):
     return wrapper
 
 
+def get_nthreads(nthreads=None):
+    """Number of threads to use for threaded numerical kernels.
+
+    Defaults to OMP_NUM_THREADS if set (e.g. under MPI), else all cores.
+    """
+    if nthreads is None:
+        nthreads = os.environ.get('OMP_NUM_THREADS', os.cpu_count())
+    return max(int(nthreads), 1)
+
+
+def get_available_memory():
+    """Available system memory in bytes, or None if it cannot be found."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
 def save_cfg(source_path, cfg, field=None):
     if os.path.isfile(join(source_path, 'config.yaml')):
         old_cfg = OmegaConf.load(join(source_path, 'config.yaml'))
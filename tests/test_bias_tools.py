@@ -0,0 +1,313 @@
+"""Unit tests of the bias tools, on small synthetic inputs."""
+
+import os
+os.environ['JAX_ENABLE_X64'] = '1'  # noqa, as in fit_halo_bias
+import numpy as np
+import h5py
+import pytest
+from scipy.integrate import quad
+from scipy.interpolate import InterpolatedUnivariateSpline as IUS
+
+from cmass.bias.tools.halo_sampling import sample_3d_batch, draw_linear
+from cmass.bias.tools.halo_models import PowerLaw, TruncatedPowerLaw
+from cmass.bias.tools import hod
+from cmass.bias.tools.catalog import (
+    create_catalog_dataset, read_catalog_dataset, save_catalog_snapshot,
+    CATALOG_SCHEMA_VERSION)
+from cmass.bias.rho_to_halo import mass_cdf, sample_masses
+
+
+# Halo positions
+
+def sample_3d_reference(phi, Nt):
+    # the original sample_3d (without radial noise), in grid units
+    N = phi.shape[0]
+    mean = sum(np.roll(phi, (-a, -b, -c), axis=(0, 1, 2))
+               for a in (0, 1) for b in (0, 1) for c in (0, 1))
+    prob = mean.flatten() / mean.sum()
+    i, j, k = np.unravel_index(np.random.choice(N**3, Nt, p=prob), (N,)*3)
+
+    def p(a, b, c):
+        return phi[(i + a) % N, (j + b) % N, (k + c) % N]
+
+    xd = draw_linear(Nt, p(0, 0, 0) + p(0, 0, 1) + p(0, 1, 0) + p(0, 1, 1),
+                     p(1, 0, 0) + p(1, 0, 1) + p(1, 1, 0) + p(1, 1, 1), 0, 1)
+    phi00 = p(0, 0, 0) * (1 - xd) + p(1, 0, 0) * xd
+    phi01 = p(0, 0, 1) * (1 - xd) + p(1, 0, 1) * xd
+    phi10 = p(0, 1, 0) * (1 - xd) + p(1, 1, 0) * xd
+    phi11 = p(0, 1, 1) * (1 - xd) + p(1, 1, 1) * xd
+    yd = draw_linear(Nt, phi00 + phi01, phi10 + phi11, 0, 1)
+    zd = draw_linear(Nt, phi00 * (1 - yd) + phi10 * yd,
+                     phi01 * (1 - yd) + phi11 * yd, 0, 1)
+    return np.stack([i + xd, j + yd, k + zd], axis=-1)
+
+
+def cell_statistics(x, N):
+    # number of points and mean offset along each axis, in every cell
+    cell = np.floor(x).astype(int) % N
+    index = np.ravel_multi_index(cell.T, (N,)*3)
+    counts = np.bincount(index, minlength=N**3)
+    offsets = np.stack([
+        np.bincount(index, weights=x[:, i] - np.floor(x[:, i]),
+                    minlength=N**3) for i in range(3)], axis=-1)
+    return counts, offsets / counts[:, None]
+
+
+def test_sample_3d_batch():
+    N, Nt, L = 6, 200_000, 60.
+    rng = np.random.default_rng(0)
+    phi = rng.gamma(2., size=(N, N, N))
+
+    np.random.seed(0)
+    ref = sample_3d_reference(phi, Nt)
+    pos = sample_3d_batch(phi[..., None], [Nt], L, seed=1, nthreads=2)[0]
+    assert pos.shape == (Nt, 3)
+    assert np.all((pos >= 0) & (pos < L))
+
+    # cell occupations match the expected ones (chi2 within 5 sigma)
+    mean = sum(np.roll(phi, (-a, -b, -c), axis=(0, 1, 2))
+               for a in (0, 1) for b in (0, 1) for c in (0, 1))
+    expected = Nt * mean.ravel() / mean.sum()
+    counts, offsets = cell_statistics(pos / (L / N), N)
+    counts_ref, offsets_ref = cell_statistics(ref, N)
+    for c in (counts, counts_ref):
+        chi2 = np.sum((c - expected)**2 / expected)
+        assert chi2 < N**3 + 5 * np.sqrt(2 * N**3)
+
+    # mean positions within cells agree with the original sampler, within
+    # 6 sigma of their difference (offsets have a std of about 0.29)
+    sigma = 0.29 * np.sqrt(1 / counts + 1 / counts_ref)
+    assert np.all(np.abs(offsets - offsets_ref) < 6 * sigma[:, None])
+
+    # the result does not depend on the number of threads
+    pos1 = sample_3d_batch(phi[..., None], [Nt], L, seed=1, nthreads=1)[0]
+    assert np.array_equal(pos, pos1)
+
+
+# Halo masses
+
+def mass_cdf_reference(medg, Nsamp, order):
+    # the CDF of the original sample_masses, integrated with scipy quad
+    mcen = (medg[1:] + medg[:-1])/2
+    mask = Nsamp > 0
+    l, r = mask.argmax(), mask.size - (mask[::-1].argmax())
+    pdf = IUS(mcen[l:r], np.log(Nsamp[l:r]), k=order, ext=0)
+
+    def integrate(x):
+        cdf = np.cumsum([0] + [quad(lambda m: np.exp(pdf(m)), a, b)[0]
+                               for a, b in zip(x[:-1], x[1:])])
+        return cdf / cdf[-1]
+
+    maskedg = medg[l:r]
+    be = np.linspace(maskedg[0], maskedg[-1], 1000)
+    return be, integrate(be), integrate(medg)
+
+
+@pytest.mark.parametrize('order', [1, 3])
+def test_mass_cdf(order):
+    medg = np.linspace(12.8, 15.8, 11)
+    Nsamp = np.array([0, 5000, 3000, 1500, 600, 200, 60, 10, 2, 0])
+
+    be, cdf, perc = mass_cdf(medg, Nsamp, order)
+    be_ref, cdf_ref, perc_ref = mass_cdf_reference(medg, Nsamp, order)
+    assert np.allclose(be, be_ref)
+    assert np.allclose(cdf, cdf_ref, rtol=0, atol=1e-8)
+    assert np.allclose(perc, perc_ref, rtol=0, atol=1e-8)
+
+    # samples match the original sampler, with the same random draws
+    invcdf = IUS(cdf_ref, be_ref, k=order, ext=3)
+    np.random.seed(0)
+    ref = [invcdf(np.random.uniform(low=perc_ref[i], high=perc_ref[i+1],
+                                    size=n)) if n > 0 else []
+           for i, n in enumerate(Nsamp)]
+    np.random.seed(0)
+    hmass = sample_masses(Nsamp, medg, order)
+    assert len(hmass) == len(Nsamp)
+    for m, m_ref, n in zip(hmass, ref, Nsamp):
+        assert len(m) == n
+        assert np.allclose(m, m_ref, rtol=0, atol=1e-6)
+
+
+# Bias models
+
+@pytest.mark.parametrize('law', [PowerLaw(), TruncatedPowerLaw()])
+def test_fit_bins(law):
+    # Poisson counts in 3 mass bins of a lognormal field, and an empty bin
+    rng = np.random.default_rng(0)
+    N, Nm = 24, 4
+    delta = (rng.lognormal(0, 0.7, (N,)*3) - 1).astype(np.float32)
+    true = np.array([-1.5, 0.8, 0.3, 0.1])[:len(law.get_default())]
+    lam = np.stack([law.predict(delta, true - 0.7*i*np.eye(len(true))[0])
+                    for i in range(Nm)], axis=-1)
+    counts = rng.poisson(lam)
+    counts[..., -1] = 0
+
+    np.random.seed(0)
+    popt = law.fit_bins(delta, counts, attempts=5)
+    assert popt.shape == (Nm, len(true))
+
+    np.random.seed(0)
+    for i in range(Nm):
+        ref, _ = law.fit(delta.ravel(), counts[..., i].ravel(), attempts=5)
+        assert np.allclose(popt[i], ref, rtol=0, atol=1e-3)
+        if counts[..., i].sum() == 0:
+            continue
+        # the loss at the minimum matches that of the per-bin fit
+        c = counts[..., i].ravel().astype(np.float64)
+        d = delta.ravel().astype(np.float64)
+        loss, loss_ref = law._loss(popt[i], d, c), law._loss(ref, d, c)
+        assert np.isclose(loss, loss_ref, rtol=1e-6)
+
+
+# HOD models
+
+HOD_MODELS = [
+    ('zheng07', hod.Zheng07, 'reid2014_cmass'),
+    ('leauthaud11', hod.Leauthaud11, 'behroozi10'),
+    ('zu_mandelbaum15', hod.Zu_mandelbaum15, 'zu_mandelbaum15'),
+]
+
+
+@pytest.fixture(scope='module')
+def halo_table():
+    from astropy.cosmology import FlatLambdaCDM
+    cosmo = FlatLambdaCDM(H0=67.7, Om0=0.3, Ob0=0.049)
+    rng = np.random.default_rng(0)
+    n, L = 2000, 100.
+    mass = 10**rng.uniform(11, 15.5, n)
+    pos = rng.uniform(0, L, (n, 3))
+    vel = rng.normal(0, 300, (n, 3))
+    halocat = hod.build_halo_catalog(pos, vel, mass, 0.5, L, cosmo)
+    return cosmo, halocat.halo_table
+
+
+@pytest.mark.parametrize('name, model, defaults', HOD_MODELS)
+def test_hod_occupation(halo_table, name, model, defaults):
+    # the native mean occupations match those of the halotools model
+    cosmo, table = halo_table
+    z = 0.5
+    model = model()
+    getattr(model, defaults)()
+    theta = model.get_parameters()
+    hod_model = hod.build_HOD_model(cosmo, name, theta, z, mdef='vir')
+    cenocc = hod_model.model_dictionary['centrals_occupation']
+    satocc = hod_model.model_dictionary['satellites_occupation']
+    ncen_ref = np.asarray(cenocc.mean_occupation(table=table))
+    nsat_ref = np.asarray(satocc.mean_occupation(table=table))
+
+    ncen, nsat = hod.OCCUPATION_MODELS[name](
+        np.asarray(table['halo_mvir']), theta, z)
+    assert np.allclose(ncen, ncen_ref, rtol=1e-8, atol=1e-12)
+    assert np.allclose(nsat, nsat_ref, rtol=1e-8, atol=1e-12)
+    assert nsat.max() > 1  # satellites are tested
+
+
+@pytest.mark.parametrize('name, model, defaults', HOD_MODELS[:2])
+def test_hod_modulate_with_cenocc(halo_table, name, model, defaults):
+    # satellites are the unmodulated halotools occupation times the mean
+    # number of centrals
+    from halotools.empirical_models import (
+        Zheng07Sats, Leauthaud11Cens, Leauthaud11Sats)
+    cosmo, table = halo_table
+    z = 0.5
+    model = model()
+    getattr(model, defaults)()
+    theta = model.get_parameters()
+    if name == 'zheng07':
+        satocc = Zheng07Sats(
+            prim_haloprop_key='halo_mvir', modulate_with_cenocc=False)
+    else:
+        # the central model still sets the knee of the satellite occupation,
+        # and it is at z=0 unless given
+        cenocc = Leauthaud11Cens(prim_haloprop_key='halo_mvir', redshift=z)
+        with pytest.warns(UserWarning):
+            satocc = Leauthaud11Sats(
+                prim_haloprop_key='halo_mvir', redshift=z,
+                cenocc_model=cenocc, modulate_with_cenocc=False)
+    satocc.param_dict.update(theta)
+    nsat_ref = np.asarray(satocc.mean_occupation(table=table))
+
+    ncen, nsat = hod.OCCUPATION_MODELS[name](
+        np.asarray(table['halo_mvir']), theta, z)
+    assert np.any((ncen < 0.9) & (nsat_ref > 1e-3))  # modulation matters
+    assert np.allclose(nsat, ncen * nsat_ref, rtol=1e-8, atol=1e-12)
+
+
+def test_leauthaud11_littleh():
+    # the stellar-to-halo mass relation is in h=1 units, with parameters
+    # quoted for h=0.72
+    from halotools.empirical_models import Leauthaud11Cens
+    from halotools.empirical_models.occupation_models import (
+        leauthaud11_components)
+    assert hod.L11_LITTLEH == leauthaud11_components.L11_LITTLEH
+
+    z = 0.5
+    model = hod.Leauthaud11()
+    model.behroozi10()
+    theta = model.get_parameters()
+    cenocc = Leauthaud11Cens(redshift=z)
+    cenocc.param_dict.update(theta)
+    log_stellar_mass = np.linspace(9, 12, 31)
+    assert np.allclose(
+        hod.leauthaud11_log_halo_mass(log_stellar_mass, theta, z),
+        cenocc.mean_log_halo_mass(log_stellar_mass), rtol=0, atol=1e-10)
+
+
+# Catalog storage
+
+@pytest.mark.parametrize('storage', [None, 'compressed', 'compressed_fixed'])
+def test_catalog_roundtrip(tmp_path, storage):
+    rng = np.random.default_rng(0)
+    n, L = 10000, 1000.
+    pos = rng.uniform(-10, L + 10, (n, 3))  # some outside the box
+    vel = rng.normal(0, 500, (n, 3))
+    mass = 10**rng.uniform(12, 15, n)
+    hostid = rng.integers(0, 5000, n)
+    gal_type = np.where(rng.random(n) < 0.8, 'centrals', 'satellites')
+    gal_type = gal_type.astype(object)
+
+    filepath = tmp_path / 'galaxies.h5'
+    save_catalog_snapshot(
+        filepath, 0.5, storage=storage, L=L, pos=pos, vel=vel, mass=mass,
+        hostid=hostid, gal_type=gal_type)
+
+    with h5py.File(filepath, 'r') as f:
+        group = f['0.500000']
+        out = {k: read_catalog_dataset(group[k]) for k in group}
+        assert ('schema_version' in group.attrs) == (storage is not None)
+        if storage is not None:
+            assert group.attrs['schema_version'] == CATALOG_SCHEMA_VERSION
+        # row selections decode as the full dataset
+        sel = read_catalog_dataset(group['pos'], slice(10, 20))
+        assert np.array_equal(sel, out['pos'][10:20])
+
+    assert np.array_equal(out['hostid'], hostid)
+    assert out['gal_type'].dtype == object
+    assert np.array_equal(
+        out['gal_type'], np.char.encode(gal_type.astype(str), 'ascii'))
+
+    if storage is None:
+        for k, v in (('pos', pos), ('vel', vel), ('mass', mass)):
+            assert np.array_equal(out[k], v)
+        return
+
+    assert np.allclose(out['mass'], mass, rtol=1e-7, atol=0)
+    if storage == 'compressed':
+        assert np.allclose(out['pos'], pos, rtol=1e-7, atol=0)
+        assert np.allclose(out['vel'], vel, rtol=1e-7, atol=0)
+    else:
+        # fixed point positions are wrapped into the box, and within half a
+        # cell of L / 2^16 from the input
+        assert out['pos'].dtype == np.float32
+        assert np.all((out['pos'] >= 0) & (out['pos'] < L))
+        err = np.mod(out['pos'] - pos + L/2, L) - L/2
+        assert np.max(np.abs(err)) <= (L / 2**16) / 2 * (1 + 1e-3)
+        assert np.allclose(out['vel'], vel, rtol=2.**-11, atol=0)
+
+
+def test_catalog_unknown_gal_type(tmp_path):
+    with h5py.File(tmp_path / 'galaxies.h5', 'w') as f:
+        with pytest.raises(ValueError):
+            create_catalog_dataset(
+                f, 'gal_type', np.array(['centrals', 'field']),
+                storage='compressed')